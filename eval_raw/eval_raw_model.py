@@ -1,5 +1,6 @@
+import os
+import sys
 import torch
-import json
 import argparse
 import numpy as np
 
@@ -8,6 +9,10 @@ from deepspeed.pipe import PipelineModule
 from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
 from torch.utils.data import DataLoader, Dataset, random_split
 
+# the routing recorder is in the local modeling code (pipeline/), not in the hub's `trust_remote_code` one
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pipeline"))
+from modeling_deepseek import DeepseekForCausalLM
+
 parser = argparse.ArgumentParser(description="LLAMAMOE")
 parser.add_argument("data", type=str, default="glue", help="input the datasets")
 parser.add_argument("dataset", type=str, default="wnli", help="input the sub-dataset")
@@ -30,12 +35,12 @@ device = torch.device("cuda")
 
 model_name = "deepseek-ai/deepseek-moe-16b-base"
 tokenizer = AutoTokenizer.from_pretrained(model_name)
-model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16, device_map="auto", trust_remote_code=True)
+model = DeepseekForCausalLM.from_checkpoint(model_name, torch_dtype=torch.bfloat16)
 model.generation_config = GenerationConfig.from_pretrained(model_name)
 model.generation_config.pad_token_id = model.generation_config.eos_token_id
 
-# model.to(device)
-# model.eval()
+model.to(device)
+model.eval()
 
 
 class GLUEDataset(Dataset):
@@ -57,11 +62,6 @@ def collate_fn(batch):
     return inputs
 
 
-def get_layer_output(module, input, output):
-    expert_idx = output[0].detach().cpu().tolist()
-    layer_outputs.append(expert_idx)
-
-
 type_name = args.dataset 
 dataset = load_dataset(args.data, type_name) if type_name != 'none' else load_dataset(args.data)
 test_data = dataset[args.subset]
@@ -95,32 +95,17 @@ ax_dataloader = DataLoader(
     ax_dataset, batch_size=1, shuffle=False, collate_fn=collate_fn
 )
 
-full_expert_dict = {}
+# the routing of every sample is flushed to a columnar trace (see pipeline/routing_trace.py), read back by
+# pipeline/eval_qd_model.py; a rerun replaces the trace of the earlier one
+recorder = model.model.start_routing_trace(
+    flush_dir=f"/mnt/deepseek/eval_raw/results/raw/mmlu/{output_name}", overwrite=True
+)
 with torch.no_grad():
     for idx, inputs in enumerate(ax_dataloader):
         inputs = inputs.to(device)
-        layer_outputs = []
-        hooks = []
-        for decoder_layer in model.model.layers[1:]:
-            hook = decoder_layer.mlp.gate.register_forward_hook(
-                get_layer_output
-            )
-            hooks.append(hook)
-
+        recorder.new_sample()
         result = model.generate(**inputs.to(model.device), max_new_tokens=1)
-        full_expert_dict[idx] = layer_outputs
-
-        for hook in hooks:
-            hook.remove()
-
-
-output_name = type_name if type_name != "none" else args.data
-output_name = output_name if "/" not in output_name else output_name.split("/")[-1]
-
-with open(
-    f"/mnt/deepseek/eval_raw/resutls/raw/mmlu/{output_name}.json", "w"
-) as fw:
-    json.dump(full_expert_dict, fw, indent=4)
+model.model.stop_routing_trace()
 
 
 
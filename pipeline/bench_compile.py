@@ -0,0 +1,80 @@
+import time
+import argparse
+
+import torch
+from transformers.cache_utils import DynamicCache
+
+from configuration_deepseek import DeepseekConfig
+from modeling_deepseek import DeepseekForCausalLM
+
+
+parser = argparse.ArgumentParser(description="DEEPSEEK")
+parser.add_argument("--batch_size", type=int, default=1, help="input the number of sequences")
+parser.add_argument("--prompt_len", type=int, default=32, help="input the prompt length")
+parser.add_argument("--steps", type=int, default=32, help="input the number of timed decode steps")
+parser.add_argument("--warmup", type=int, default=4, help="input the number of untimed decode steps")
+args = parser.parse_args()
+torch.manual_seed(0)
+
+
+# tiny random model with the layout of deepseek-moe-16b (dense layer 0, shared + routed experts)
+config = DeepseekConfig(
+    vocab_size=1024,
+    hidden_size=256,
+    intermediate_size=704,
+    moe_intermediate_size=64,
+    num_hidden_layers=4,
+    num_attention_heads=8,
+    num_key_value_heads=8,
+    n_shared_experts=2,
+    n_routed_experts=64,
+    num_experts_per_tok=6,
+    first_k_dense_replace=1,
+    max_position_embeddings=512,
+    moe_static_routing=True,
+    attn_implementation="sdpa",
+)
+model = DeepseekForCausalLM(config).eval()
+
+
+def prefill():
+    input_ids = torch.randint(0, config.vocab_size, (args.batch_size, args.prompt_len))
+    outputs = model(input_ids=input_ids, past_key_values=DynamicCache(), use_cache=True)
+    return outputs.past_key_values, outputs.logits[:, -1:].argmax(-1)
+
+
+def decode(step_fn, cache, next_token):
+    """Runs warmup + timed greedy decode steps, returns the mean step time in ms."""
+    for step in range(args.warmup + args.steps):
+        if step == args.warmup:
+            start = time.perf_counter()
+        position_ids = torch.full((args.batch_size, 1), cache.get_seq_length(), dtype=torch.long)
+        logits = step_fn(input_ids=next_token, position_ids=position_ids, past_key_values=cache, use_cache=True).logits
+        next_token = logits[:, -1:].argmax(-1)
+    return (time.perf_counter() - start) / args.steps * 1000
+
+
+with torch.no_grad():
+    # `torch.compile(model)` captures one decode step as a single graph once the prefill has sized the RoPE cache
+    cache, next_token = prefill()
+    explanation = torch._dynamo.explain(model)(
+        input_ids=next_token,
+        position_ids=torch.full((args.batch_size, 1), args.prompt_len, dtype=torch.long),
+        past_key_values=cache,
+        use_cache=True,
+    )
+    print(f"decode step: {explanation.graph_count} graph(s), {explanation.graph_break_count} graph break(s)")
+    for reason in explanation.break_reasons:
+        print(reason.reason)
+
+    eager_ms = decode(model, *prefill())
+    compiled_ms = decode(torch.compile(model), *prefill())
+
+print(f"eager:    {eager_ms:.2f} ms/step")
+print(f"compiled: {compiled_ms:.2f} ms/step")
+print(f"speedup:  {eager_ms / compiled_ms:.2f}x")
+
+
+"""
+python bench_compile.py --batch_size 1 --prompt_len 32 --steps 32
+"""
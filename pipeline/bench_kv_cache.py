@@ -0,0 +1,105 @@
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+from transformers.cache_utils import DynamicCache
+
+from configuration_deepseek import DeepseekConfig
+from modeling_deepseek import DeepseekForCausalLM, DeepseekQuantizedCache
+
+
+parser = argparse.ArgumentParser(description="DEEPSEEK")
+parser.add_argument("--model_name", type=str, default=None, help="input the checkpoint, a tiny random model if unset")
+parser.add_argument("--num_tokens", type=int, default=1024, help="input the number of evaluated tokens")
+parser.add_argument("--chunk_len", type=int, default=64, help="input the tokens fed per forward pass")
+parser.add_argument("--block_size", type=int, default=64, help="input the tokens per quantization block")
+parser.add_argument("--max_new_tokens", type=int, default=64, help="input the number of generated tokens")
+args = parser.parse_args()
+torch.manual_seed(0)
+
+
+if args.model_name is not None:
+    from datasets import load_dataset
+    from transformers import AutoTokenizer, AutoModelForCausalLM
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    model = AutoModelForCausalLM.from_pretrained(
+        args.model_name, torch_dtype=torch.bfloat16, device_map="auto", trust_remote_code=True
+    ).eval()
+    text = "\n\n".join(load_dataset("wikitext", "wikitext-2-raw-v1", split="test")["text"])
+    input_ids = tokenizer(text, return_tensors="pt").input_ids[:, : args.num_tokens].to(model.device)
+else:
+    # tiny random model with the layout of deepseek-moe-16b (dense layer 0, shared + routed experts)
+    config = DeepseekConfig(
+        vocab_size=1024,
+        hidden_size=256,
+        intermediate_size=704,
+        moe_intermediate_size=64,
+        num_hidden_layers=4,
+        num_attention_heads=8,
+        num_key_value_heads=8,
+        n_shared_experts=2,
+        n_routed_experts=64,
+        num_experts_per_tok=6,
+        first_k_dense_replace=1,
+        max_position_embeddings=4096,
+        attn_implementation="sdpa",
+    )
+    model = DeepseekForCausalLM(config).eval()
+    input_ids = torch.randint(0, config.vocab_size, (1, args.num_tokens))
+
+
+def cache_bytes(cache):
+    if isinstance(cache, DeepseekQuantizedCache):
+        return cache.nbytes()
+    return sum(tensor.numel() * tensor.element_size() for tensor in cache.key_cache + cache.value_cache)
+
+
+def perplexity(cache):
+    """Feeds the tokens `chunk_len` at a time, so that every chunk attends to the cached (quantized) states before it."""
+    nll, count = 0.0, 0
+    for start in range(0, input_ids.shape[1], args.chunk_len):
+        logits = model(input_ids=input_ids[:, start:start + args.chunk_len], past_key_values=cache, use_cache=True).logits
+        targets = input_ids[:, start + 1:start + args.chunk_len + 1]
+        logits = logits[:, : targets.shape[1]].float()
+        nll += F.cross_entropy(logits.reshape(-1, logits.shape[-1]), targets.reshape(-1), reduction="sum").item()
+        count += targets.numel()
+    return float(torch.exp(torch.tensor(nll / count))), cache_bytes(cache)
+
+
+def throughput(cache):
+    prompt = input_ids[:, : args.num_tokens - args.max_new_tokens]
+    start = time.perf_counter()
+    model.generate(
+        prompt,
+        past_key_values=cache,
+        max_new_tokens=args.max_new_tokens,
+        min_new_tokens=args.max_new_tokens,
+        do_sample=False,
+        pad_token_id=model.config.eos_token_id,
+    )
+    return args.max_new_tokens / (time.perf_counter() - start)
+
+
+with torch.no_grad():
+    results = {}
+    for name, make_cache in (
+        (str(model.dtype).split(".")[-1], DynamicCache),
+        ("int8", lambda: DeepseekQuantizedCache(args.block_size)),
+    ):
+        ppl, nbytes = perplexity(make_cache())
+        results[name] = (ppl, nbytes, throughput(make_cache()))
+
+baseline = next(iter(results.values()))
+for name, (ppl, nbytes, tokens_per_s) in results.items():
+    print(
+        f"{name}: perplexity {ppl:.4f} ({ppl - baseline[0]:+.4f}), cache {nbytes / 2 ** 20:.2f} MiB for "
+        f"{args.num_tokens} tokens ({nbytes / baseline[1]:.2f}x), decode {tokens_per_s:.1f} tokens/s"
+    )
+
+
+"""
+python bench_kv_cache.py --num_tokens 1024 --chunk_len 64 --block_size 64
+python bench_kv_cache.py --model_name deepseek-ai/deepseek-moe-16b-base --num_tokens 4096 --chunk_len 256
+"""
@@ -0,0 +1,106 @@
+import time
+import argparse
+import tempfile
+
+import torch
+import torch.multiprocessing as mp
+
+from configuration_deepseek import DeepseekConfig
+from modeling_deepseek import DeepseekForCausalLM, _checkpoint_files, _load_checkpoint_file
+
+
+def load(method, path, dtype):
+    if method == "init_and_load":
+        # random init of every module, then the checkpoint copied over it
+        config = DeepseekConfig.from_pretrained(path)
+        default_dtype = torch.get_default_dtype()
+        torch.set_default_dtype(dtype)
+        model = DeepseekForCausalLM(config)
+        torch.set_default_dtype(default_dtype)
+        for file in _checkpoint_files(path):
+            model.load_state_dict(_load_checkpoint_file(file, dtype), strict=False)
+        return model.eval()
+    if method == "from_pretrained":
+        return DeepseekForCausalLM.from_pretrained(path, torch_dtype=dtype).eval()
+    return DeepseekForCausalLM.from_checkpoint(path, torch_dtype=dtype)
+
+
+def peak_rss():
+    # the high-water mark of this process's own address space, unlike `ru_maxrss` it is not inherited across exec
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+
+
+def run(method, path, dtype, input_ids, queue):
+    """
+    Loads the model in a fresh process, so that its peak RSS only counts this method, and runs the first forward
+    pass: memory-mapped checkpoint pages are only read once touched.
+    """
+    baseline = peak_rss()
+    start = time.perf_counter()
+    model = load(method, path, dtype)
+    load_seconds = time.perf_counter() - start
+    with torch.no_grad():
+        logits = model(input_ids).logits.float()
+    first_token_seconds = time.perf_counter() - start
+    # sent by value, the process exits right after
+    queue.put((load_seconds, first_token_seconds, peak_rss() - baseline, logits.numpy()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DEEPSEEK")
+    parser.add_argument("--model_path", type=str, default=None, help="input the checkpoint, a random one if unset")
+    parser.add_argument("--dtype", type=str, default="bfloat16", help="input the dtype of the weights")
+    parser.add_argument("--num_hidden_layers", type=int, default=4, help="input the layers of the random checkpoint")
+    parser.add_argument("--hidden_size", type=int, default=1024, help="input the hidden size of the random checkpoint")
+    args = parser.parse_args()
+    dtype = getattr(torch, args.dtype)
+
+    path = args.model_path
+    if path is None:
+        # random checkpoint with the layout of deepseek-moe-16b (dense layer 0, shared + routed experts)
+        path = tempfile.mkdtemp()
+        config = DeepseekConfig(
+            vocab_size=4096,
+            hidden_size=args.hidden_size,
+            intermediate_size=args.hidden_size * 11 // 4,
+            moe_intermediate_size=args.hidden_size * 11 // 32,
+            num_hidden_layers=args.num_hidden_layers,
+            num_attention_heads=16,
+            num_key_value_heads=16,
+            n_shared_experts=2,
+            n_routed_experts=64,
+            num_experts_per_tok=6,
+            first_k_dense_replace=1,
+            max_position_embeddings=512,
+            torch_dtype=args.dtype,
+        )
+        DeepseekForCausalLM(config).to(dtype).save_pretrained(path, max_shard_size="200MB")
+        del config
+    num_params = sum(
+        tensor.numel() for file in _checkpoint_files(path) for tensor in _load_checkpoint_file(file).values()
+    )
+    print(f"{path}: {num_params / 1e6:.1f}M parameters, {num_params * dtype.itemsize / 2 ** 30:.2f} GiB in {args.dtype}")
+
+    ctx = mp.get_context("spawn")
+    input_ids = torch.randint(0, 1024, (1, 16), generator=torch.Generator().manual_seed(0))
+    reference = None
+    for method in ("init_and_load", "from_pretrained", "from_checkpoint"):
+        queue = ctx.Queue()
+        process = ctx.Process(target=run, args=(method, path, dtype, input_ids, queue))
+        process.start()
+        load_seconds, first_token_seconds, peak, logits = queue.get()
+        process.join()
+        logits = torch.from_numpy(logits)
+        reference = logits if reference is None else reference
+        print(
+            f"{method:16s} load {load_seconds:6.2f} s, first token {first_token_seconds:6.2f} s, "
+            f"peak RSS +{peak / 2 ** 30:.2f} GiB, "
+            f"max logit diff {(logits - reference).abs().max().item():.2e}"
+        )
+
+
+"""
+python bench_startup.py --num_hidden_layers 4 --hidden_size 1024
+python bench_startup.py --model_path deepseek-ai/deepseek-moe-16b-base --dtype bfloat16
+"""
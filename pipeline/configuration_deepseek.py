@@ -47,6 +47,67 @@ class DeepseekConfig(PretrainedConfig):
             Auxiliary loss weight coefficient.
         seq_aux = (`bool`, *optional*, defaults to True):
             Whether to compute the auxiliary loss for each individual sample.
+        moe_grouped_gemm (`bool`, *optional*, defaults to `False`):
+            Whether to store the routed experts of each MoE layer as stacked `[n_routed_experts, ...]` weight tensors
+            and run all active experts with a few batched matmuls instead of one `nn.Linear` call per expert. The
+            checkpoint layout is unchanged.
+        moe_static_routing (`bool`, *optional*, defaults to `False`):
+            Whether to evaluate the routed experts of small batches (at most `n_routed_experts` token-expert pairs, e.g.
+            a decode step) without host synchronization or data-dependent control flow, so that `torch.compile` can
+            capture a whole decode step of [`DeepseekForCausalLM`] as a single graph. Implies `moe_grouped_gemm`.
+        fuse_gate_up_proj (`bool`, *optional*, defaults to `False`):
+            Whether [`DeepseekMLP`] (dense layers, shared and routed experts) keeps `gate_proj` and `up_proj` as one
+            `[2 * intermediate_size, hidden_size]` projection. Checkpoints with separate `gate_proj`/`up_proj` weights
+            are fused on load and split again on save.
+        moe_capacity_factor (`float`, *optional*):
+            Caps the token-expert assignments each routed expert processes per forward pass at
+            `ceil(moe_capacity_factor * num_tokens * num_experts_per_tok / n_routed_experts)`, admitting assignments by
+            descending gate weight. `None` disables the cap.
+        moe_overflow_policy (`str`, *optional*, defaults to `"drop"`):
+            What happens to assignments over capacity: `"drop"` skips them (the token keeps its other routed experts
+            and the shared experts), `"reroute"` sends them to the token's next-best expert that still has room and
+            drops them if there is none. Each `MoEGate` keeps the number of token-expert assignments it dropped in its
+            last forward pass in `dropped_assignments`, and the number of tokens left without any routed expert in
+            `dropped_tokens`.
+        moe_offload_dir (`str`, *optional*):
+            Directory of a [`DeepseekExpertStore`] (written with `DeepseekExpertStore.save` or `save_from_checkpoint`)
+            to serve the routed experts from instead of keeping them resident. The store is memory-mapped and the
+            active experts are materialized through an LRU cache in RAM. Routed-expert weights of a checkpoint are then
+            not loaded. Inference only, a forward pass in training mode raises.
+        moe_offload_max_bytes (`int`, *optional*):
+            Byte budget of the RAM cache of offloaded experts, shared by all layers. `None` keeps every expert once
+            materialized. Prefetched experts (`expert_prefetch.py`) only take room the budget has left.
+        moe_expert_parallel (`bool`, *optional*, defaults to `False`):
+            Whether to shard the routed experts of every MoE layer across the ranks of the default `torch.distributed`
+            process group, see [`DeepseekShardedExperts`]. Each rank then holds about `1 / world_size` of the routed
+            experts and runs the rest of the model on its own tokens.
+        tensor_parallel (`bool`, *optional*, defaults to `False`):
+            Whether to shard the model across the ranks of the default `torch.distributed` process group (tensor
+            parallelism): every rank holds `1 / world_size` of the attention heads (`q/k/v_proj` split over their output
+            features, `o_proj` over its input features) and of the intermediate features of every [`DeepseekMLP`]
+            (dense layers, shared and routed experts), and one all-reduce per attention and MLP/MoE block sums the
+            partial outputs. Full checkpoints are sliced on load. All ranks must run the same inputs. Inference only,
+            with `nn.ModuleList` routed experts.
+        kv_cache_dtype (`str`, *optional*):
+            Storage of the KV cache `generate` creates: `None` keeps keys and values in the model dtype, `"int8"` uses a
+            [`DeepseekQuantizedCache`] with per-head, per-block scales.
+        expert_replicas (`Dict[int, Dict[int, int]]`, *optional*):
+            Extra copies of hot routed experts, `{layer_idx: {expert_idx: num_replicas}}`. The copies of a layer are
+            appended after its `n_routed_experts` experts (in expert order) and hold the same weights, which are loaded
+            from the original expert and not saved. The gate spreads an expert's assignments over the original and its
+            copies according to `expert_replica_policy`.
+        expert_replica_policy (`str`, *optional*, defaults to `"hash"`):
+            How the copy of a replicated expert is chosen for each assignment, deterministically from the current
+            batch alone: `"hash"` hashes the row and position id of the token, `"least_loaded"` hands the assignments
+            of the expert out to its copies round-robin.
+        expert_precisions (`Dict[int, Dict[int, str]]`, *optional*):
+            Routed experts not kept in the model dtype, `{layer_idx: {expert_idx: precision}}` with precision `"int8"` or
+            `"int4"` ([`DeepseekQuantLinear`] projections, whose packed weights, scales and zero points are what the
+            checkpoint holds) or `"pruned"` (no weights, never selected). Indices from `n_routed_experts` on are the
+            copies of `expert_replicas`. Written by `save_pretrained` from the experts of the model.
+        expert_quant_group_size (`int`, *optional*):
+            Group size of the quantized experts of `expert_precisions`. `None` uses per-channel scales for int8 and
+            groups of 128 for int4.
         num_key_value_heads (`int`, *optional*):
             This is the number of key_value heads that should be used to implement Grouped Query Attention. If
             `num_key_value_heads=num_attention_heads`, the model will use Multi Head Attention (MHA), if
@@ -122,6 +183,20 @@ class DeepseekConfig(PretrainedConfig):
         scoring_func = 'softmax',
         aux_loss_alpha = 0.001,
         seq_aux = True,
+        moe_grouped_gemm = False,
+        moe_static_routing = False,
+        fuse_gate_up_proj = False,
+        moe_capacity_factor = None,
+        moe_overflow_policy = 'drop',
+        moe_offload_dir = None,
+        moe_offload_max_bytes = None,
+        moe_expert_parallel = False,
+        tensor_parallel = False,
+        kv_cache_dtype = None,
+        expert_replicas = None,
+        expert_replica_policy = 'hash',
+        expert_precisions = None,
+        expert_quant_group_size = None,
         hidden_act="silu",
         max_position_embeddings=2048,
         initializer_range=0.02,
@@ -154,6 +229,47 @@ class DeepseekConfig(PretrainedConfig):
         self.scoring_func = scoring_func
         self.aux_loss_alpha = aux_loss_alpha
         self.seq_aux = seq_aux
+        self.moe_grouped_gemm = moe_grouped_gemm
+        self.moe_static_routing = moe_static_routing
+        self.fuse_gate_up_proj = fuse_gate_up_proj
+        self.moe_capacity_factor = moe_capacity_factor
+        self.moe_overflow_policy = moe_overflow_policy
+        self.moe_offload_dir = moe_offload_dir
+        self.moe_offload_max_bytes = moe_offload_max_bytes
+        self.moe_expert_parallel = moe_expert_parallel
+        self.tensor_parallel = tensor_parallel
+        self.kv_cache_dtype = kv_cache_dtype
+        # JSON turns the integer keys into strings
+        self.expert_replicas = None if expert_replicas is None else {
+            int(layer_idx): {int(expert_idx): int(num) for expert_idx, num in replicas.items()}
+            for layer_idx, replicas in expert_replicas.items()
+        }
+        self.expert_replica_policy = expert_replica_policy
+        self.expert_precisions = None if expert_precisions is None else {
+            int(layer_idx): {int(expert_idx): precision for expert_idx, precision in precisions.items()}
+            for layer_idx, precisions in expert_precisions.items()
+        }
+        self.expert_quant_group_size = expert_quant_group_size
+        if moe_overflow_policy not in ['drop', 'reroute']:
+            raise ValueError(f"`moe_overflow_policy` must be one of ['drop', 'reroute'], got {moe_overflow_policy}")
+        if kv_cache_dtype not in [None, 'int8']:
+            raise ValueError(f"`kv_cache_dtype` must be one of [None, 'int8'], got {kv_cache_dtype}")
+        if tensor_parallel and (
+            moe_grouped_gemm or moe_static_routing or moe_offload_dir is not None or moe_expert_parallel
+            or pretraining_tp > 1 or attention_bias
+        ):
+            raise ValueError(
+                "`tensor_parallel` cannot be combined with grouped, static, offloaded or expert-parallel routed experts, "
+                "`pretraining_tp > 1` or `attention_bias`"
+            )
+        if expert_replica_policy not in ['hash', 'least_loaded']:
+            raise ValueError(f"`expert_replica_policy` must be one of ['hash', 'least_loaded'], got {expert_replica_policy}")
+        for replicas in (self.expert_replicas or {}).values():
+            if n_routed_experts is None or any(not 0 <= expert_idx < n_routed_experts or num < 0 for expert_idx, num in replicas.items()):
+                raise ValueError(f"`expert_replicas` must map routed experts to non-negative counts, got {replicas}")
+        for precisions in (self.expert_precisions or {}).values():
+            if any(precision not in ['bf16', 'int8', 'int4', 'pruned'] for precision in precisions.values()):
+                raise ValueError(f"`expert_precisions` must be one of ['bf16', 'int8', 'int4', 'pruned'], got {precisions}")
         # for backward compatibility
         if num_key_value_heads is None:
             num_key_value_heads = num_attention_heads
@@ -5,15 +5,11 @@ import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 
-import bitsandbytes as bnb
-from bitsandbytes.nn import Linear4bit
-
 from datasets import load_dataset
 from deepspeed.pipe import PipelineModule
-from transformers.activations import ACT2FN
 from transformers import AutoTokenizer, AutoModelForCausalLM, GenerationConfig
 from torch.utils.data import DataLoader, Dataset, random_split
-from configuration_deepseek import DeepseekConfig
+from modeling_deepseek import DeepseekForCausalLM
 
 
 parser = argparse.ArgumentParser(description="LLAMAMOE")
@@ -33,58 +29,21 @@ parser.add_argument(
     "--sub_three", type=str, default="sentence", help="input the sub-type"
 )
 args = parser.parse_args()
-device = torch.device("cuda")
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 model_name = "deepseek-ai/deepseek-moe-16b-base"
 tokenizer = AutoTokenizer.from_pretrained(model_name)
-model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.bfloat16, device_map="auto", trust_remote_code=True)
+# the local modeling code, the hub's `trust_remote_code` model cannot quantize its experts
+model = DeepseekForCausalLM.from_checkpoint(model_name, torch_dtype=torch.bfloat16)
 model.generation_config = GenerationConfig.from_pretrained(model_name)
 model.generation_config.pad_token_id = model.generation_config.eos_token_id
 model_dict  = model.state_dict()
-# model.to(device)
-# model.eval()
-
-class QuantDeepseekMLP(nn.Module):
-    def __init__(self, config, hidden_size = None, intermediate_size = None):
-        super().__init__()
-        self.config = config
-        self.hidden_size = config.hidden_size if hidden_size is None else hidden_size
-        self.intermediate_size = config.intermediate_size if intermediate_size is None else intermediate_size
-
-        self.gate_proj = Linear4bit(self.hidden_size, self.intermediate_size, bias=False)
-        self.up_proj = Linear4bit(self.hidden_size, self.intermediate_size, bias=False)
-        self.down_proj = Linear4bit(self.intermediate_size, self.hidden_size, bias=False)
-
-        self.act_fn = ACT2FN[config.hidden_act]
-
-    def forward(self, x):
-        if self.config.pretraining_tp > 1:
-            slice = self.intermediate_size // self.config.pretraining_tp
-            gate_proj_slices = self.gate_proj.weight.split(slice, dim=0)
-            up_proj_slices = self.up_proj.weight.split(slice, dim=0)
-            down_proj_slices = self.down_proj.weight.split(slice, dim=1)
-
-            gate_proj = torch.cat(
-                [F.linear(x, gate_proj_slices[i]) for i in range(self.config.pretraining_tp)], dim=-1
-            )
-            up_proj = torch.cat([F.linear(x, up_proj_slices[i]) for i in range(self.config.pretraining_tp)], dim=-1)
-
-            intermediate_states = (self.act_fn(gate_proj) * up_proj).split(slice, dim=2)
-            down_proj = [
-                F.linear(intermediate_states[i], down_proj_slices[i]) for i in range(self.config.pretraining_tp)
-            ]
-            down_proj = sum(down_proj)
-        else:
-            down_proj = self.down_proj(self.act_fn(self.gate_proj(x)) * self.up_proj(x))
-
-        return down_proj
-
-for layer in model.model.layers[1: 27]:
-    config = DeepseekConfig()
-    hidden_size = layer.mlp.experts[0].hidden_size
-    intermediate_size = layer.mlp.experts[0].intermediate_size
-    layer.mlp.experts[0] = QuantDeepseekMLP(config=config, hidden_size=hidden_size, intermediate_size=intermediate_size)
+model.to(device)
+model.eval()
+
+# int4 expert 0 of the MoE layers 1 to 26, recorded in `config.expert_precisions` so that a saved model reloads as is
+model.model.quantize_experts({layer_idx: [0] for layer_idx in range(1, 27)}, bits=4)
 
 print(model)
 
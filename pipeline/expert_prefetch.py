@@ -0,0 +1,156 @@
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from routing_trace import RoutingTrace
+
+
+def load_routing_traces(paths):
+    """
+    Reads routing traces, columnar trace directories (see `routing_trace.py`) or older
+    `{sample: [moe_layer][token][top_k]}` JSON files, and yields one `(num_moe_layers, num_tokens, top_k)` array of
+    expert ids per sample.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for routing in RoutingTrace(path):
+                yield routing.astype(np.int64)
+            continue
+        with open(path) as f:
+            traces = json.load(f)
+        for routing in traces.values():
+            yield np.asarray(routing, dtype=np.int64)
+
+
+class CoactivationPredictor:
+    """
+    Guesses the experts MoE layer `l + 1` will select from the experts a token selected at MoE layer `l`.
+    `counts[l, i, j]` is how often a token routed to expert `i` at layer `l` was routed to expert `j` at layer `l + 1`;
+    the candidates for layer `l + 1` are ranked by the summed rows of the experts selected at layer `l`.
+    """
+
+    def __init__(self, num_layers, num_experts):
+        self.num_experts = num_experts
+        self.counts = np.zeros((num_layers - 1, num_experts, num_experts), dtype=np.int64)
+
+    def fit(self, samples):
+        """Accumulates the table over `(num_layers, num_tokens, top_k)` routing arrays."""
+        num_experts = self.num_experts
+        layer_offsets = np.arange(len(self.counts)).reshape(-1, 1, 1, 1) * num_experts * num_experts
+        for routing in samples:
+            # every (expert at l, expert at l + 1) pair of a token, flattened into the table
+            pairs = layer_offsets + routing[:-1, :, :, None] * num_experts + routing[1:, :, None, :]
+            self.counts += np.bincount(pairs.ravel(), minlength=self.counts.size).reshape(self.counts.shape)
+        return self
+
+    def scores(self, layer, expert_ids):
+        """
+        Args:
+            layer (`int`): MoE layer position whose routing is known.
+            expert_ids (`np.ndarray`): `(num_tokens, top_k)` experts selected at `layer`. Ids of dropped assignments
+                (`>= num_experts`) are ignored.
+
+        Returns `(num_tokens, num_experts)` co-activation scores for layer `layer + 1`.
+        """
+        valid = expert_ids < self.num_experts
+        rows = self.counts[layer][np.where(valid, expert_ids, 0)]
+        return (rows * valid[..., None]).sum(axis=1)
+
+    def predict(self, layer, expert_ids, num_predicted):
+        """The `num_predicted` experts of layer `layer + 1` most likely to be used by the tokens of `expert_ids`."""
+        scores = self.scores(layer, expert_ids).sum(axis=0)
+        return np.argsort(-scores, kind="stable")[:num_predicted]
+
+    def evaluate(self, samples, num_predicted):
+        """
+        Per-token precision and recall of the top-`num_predicted` guesses against the experts actually selected at
+        the next layer, over `(num_layers, num_tokens, top_k)` routing arrays.
+        """
+        hits = predicted = selected = 0
+        for routing in samples:
+            for layer in range(len(self.counts)):
+                guesses = np.argsort(-self.scores(layer, routing[layer]), axis=-1, kind="stable")[:, :num_predicted]
+                hits += (guesses[:, :, None] == routing[layer + 1][:, None, :]).any(axis=-1).sum()
+                predicted += guesses.size
+                selected += routing[layer + 1].size
+        return {"precision": hits / max(predicted, 1), "recall": hits / max(selected, 1)}
+
+    def save(self, path):
+        np.save(path, self.counts)
+
+    @classmethod
+    def load(cls, path):
+        counts = np.load(path)
+        predictor = cls(len(counts) + 1, counts.shape[-1])
+        predictor.counts = counts
+        return predictor
+
+
+class ExpertPrefetcher:
+    """
+    Loads the experts a [`CoactivationPredictor`] expects the next MoE layer to select into the expert cache of a model
+    with offloaded experts (`config.moe_offload_dir`). A forward hook on each `MoEGate` hands the guesses to a
+    background thread, so the loads overlap with the current layer's expert computation. Guesses for a layer that were
+    not started by the time the next gate fires are cancelled, and guesses that do not fit in the cache budget are
+    skipped, so leave `moe_offload_max_bytes` some headroom over the working set.
+    """
+
+    def __init__(self, model, predictor, num_predicted):
+        self.predictor = predictor
+        self.num_predicted = num_predicted
+        self.moe_layers = [layer.mlp for layer in model.model.layers if hasattr(layer.mlp, "gate")]
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        self.hooks = [
+            moe.gate.register_forward_hook(self._make_hook(position))
+            for position, moe in enumerate(self.moe_layers[:-1])
+        ]
+
+    def _make_hook(self, position):
+        def hook(module, input, output):
+            for future in self.pending:
+                future.cancel()
+            experts = self.moe_layers[position + 1].experts
+            expert_ids = output[0].detach().cpu().numpy()
+            self.pending = [
+                self.executor.submit(experts.store.prefetch, experts.layer_idx, int(expert_idx))
+                for expert_idx in self.predictor.predict(position, expert_ids, self.num_predicted)
+            ]
+        return hook
+
+    def close(self):
+        for hook in self.hooks:
+            hook.remove()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DEEPSEEK")
+    parser.add_argument("traces", type=str, nargs="+", help="input the routing trace files")
+    parser.add_argument("--output", type=str, default="./coactivation.npy", help="input the path of the table")
+    parser.add_argument("--num_experts", type=int, default=64, help="input the number of routed experts")
+    parser.add_argument("--num_predicted", type=int, nargs="+", default=[6, 12, 24], help="input the prefetch sizes")
+    parser.add_argument("--holdout", type=float, default=0.1, help="input the fraction of samples held out")
+    args = parser.parse_args()
+
+    samples = list(load_routing_traces(args.traces))
+    num_train = len(samples) - max(int(len(samples) * args.holdout), 1)
+    predictor = CoactivationPredictor(samples[0].shape[0], args.num_experts).fit(samples[:num_train])
+    predictor.save(args.output)
+    for num_predicted in args.num_predicted:
+        metrics = predictor.evaluate(samples[num_train:], num_predicted)
+        print(f"prefetch {num_predicted}: precision {metrics['precision']:.4f}, recall {metrics['recall']:.4f}")
+
+
+"""
+python expert_prefetch.py /mnt/deepseek/eval_raw/results/raw/mmlu/*/ --output ./coactivation.npy --num_predicted 6 12 24
+"""
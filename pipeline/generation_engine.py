@@ -0,0 +1,410 @@
+import time
+import queue
+import argparse
+import itertools
+import threading
+from collections import deque
+
+import torch
+
+from configuration_deepseek import DeepseekConfig
+from modeling_deepseek import DeepseekForCausalLM, DeepseekPagedCache
+from prefix_cache import PrefixCache
+
+
+class GenerationRequest:
+    """One prompt in the engine: its tokens so far (prompt + generated), how many are in the KV cache, and timings."""
+
+    def __init__(self, request_id, prompt_ids, max_new_tokens, temperature):
+        self.request_id = request_id
+        self.token_ids = list(prompt_ids)
+        self.prompt_len = len(self.token_ids)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.num_computed = 0
+        self.finished = False
+        self.cancelled = False
+        self.outputs = queue.Queue()
+        self.arrival_time = time.perf_counter()
+        self.scheduled_time = None
+        self.first_token_time = None
+        self.finish_time = None
+
+    @property
+    def output_ids(self):
+        return self.token_ids[self.prompt_len:]
+
+
+class GenerationEngine:
+    """
+    Continuous-batching generation around [`DeepseekForCausalLM`]. Every `step()` is one forward pass over all running
+    requests: decode tokens of the running requests first, then prefill chunks of waiting requests while the
+    `max_batch_tokens` budget and `max_num_seqs` allow, all packed into a single row of a [`DeepseekPagedCache`]. New
+    requests join the batch at the next step and finished ones leave it (and free their blocks) right after the step
+    that finished them. When the cache runs out of blocks the most recently admitted request is preempted and later
+    recomputed from its tokens so far.
+
+    With `prefix_cache=True` the blocks of computed prompts are kept in a [`PrefixCache`] of at most
+    `prefix_cache_max_bytes`, and a new request only prefills what follows its longest cached prefix.
+
+    Requests are driven either by a background thread (`start()`) or by `stream()` itself.
+    """
+
+    def __init__(
+        self,
+        model,
+        num_blocks,
+        block_size = 16,
+        max_batch_tokens = 512,
+        max_num_seqs = 64,
+        eos_token_id = None,
+        prefix_cache = False,
+        prefix_cache_max_bytes = None,
+        seed = 0,
+    ):
+        self.model = model
+        self.max_batch_tokens = max_batch_tokens
+        self.max_num_seqs = max_num_seqs
+        self.eos_token_id = model.config.eos_token_id if eos_token_id is None else eos_token_id
+        self.cache = DeepseekPagedCache(
+            model.config,
+            num_blocks,
+            block_size,
+            device=[layer.self_attn.o_proj.weight.device for layer in model.model.layers],
+            dtype=model.dtype,
+        )
+        self.prefix_cache = PrefixCache(self.cache, prefix_cache_max_bytes) if prefix_cache else None
+        self.generator = torch.Generator().manual_seed(seed)
+        self.requests = {}
+        self.waiting = deque()
+        self.running = []
+        self.lock = threading.Condition()
+        self.request_ids = itertools.count()
+        self._thread = None
+        self._stopped = False
+        # submitted and cancelled requests, so that an idle background loop knows when to try scheduling again
+        self._num_events = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_steps = 0
+        self.busy_time = 0.0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.queue_latencies = []
+        self.first_token_latencies = []
+
+    def submit(self, prompt_ids, max_new_tokens = 128, temperature = 0.0):
+        """Queues a prompt (a list of token ids) and returns its request id."""
+        with self.lock:
+            request = GenerationRequest(next(self.request_ids), prompt_ids, max_new_tokens, temperature)
+            self.requests[request.request_id] = request
+            self.waiting.append(request)
+            self._num_events += 1
+            self.lock.notify()
+        return request.request_id
+
+    def cancel(self, request_id):
+        """Stops a request; its stream ends and its blocks are freed at the next step."""
+        with self.lock:
+            if request_id in self.requests and not self.requests[request_id].finished:
+                self.requests[request_id].cancelled = True
+                self._num_events += 1
+                self.lock.notify()
+
+    def stream(self, request_id):
+        """Yields the generated token ids of a request as they are produced. The engine forgets it once it ends."""
+        request = self.requests[request_id]
+        while True:
+            try:
+                token_id = request.outputs.get(timeout=None if self._thread is not None else 0)
+            except queue.Empty:
+                self.step()
+                continue
+            if token_id is None:
+                with self.lock:
+                    del self.requests[request_id]
+                return
+            yield token_id
+
+    def generate(self, prompts, max_new_tokens = 128, temperature = 0.0):
+        """Runs a list of prompts to completion, returns the generated token ids of each."""
+        request_ids = [self.submit(prompt_ids, max_new_tokens, temperature) for prompt_ids in prompts]
+        return [list(self.stream(request_id)) for request_id in request_ids]
+
+    def _finish(self, request):
+        request.finished = True
+        request.finish_time = time.perf_counter()
+        request.outputs.put(None)
+        if request.request_id in self.cache.block_tables:
+            self.cache.free_sequence(request.request_id)
+            if self.prefix_cache is not None:
+                self.prefix_cache.trim()
+
+    def _preempt(self, request):
+        """Drops a running request back to the front of the queue, returns how many blocks that freed."""
+        num_free_blocks = self.cache.num_free_blocks
+        self.running.remove(request)
+        self.cache.free_sequence(request.request_id)
+        request.num_computed = 0
+        self.waiting.appendleft(request)
+        return self.cache.num_free_blocks - num_free_blocks
+
+    def _evict(self, num_blocks):
+        return self.prefix_cache.evict(num_blocks) if self.prefix_cache is not None else 0
+
+    def _admit(self, request):
+        """Starts the sequence of a waiting request on top of its longest cached prefix."""
+        prefix_blocks = []
+        if self.prefix_cache is not None:
+            # the last token is always computed, its hidden state gives the next token
+            prefix_blocks = self.prefix_cache.match(
+                request.token_ids, (len(request.token_ids) - 1) // self.cache.block_size
+            )
+        self.cache.add_sequence(request.request_id, prefix_blocks)
+        request.num_computed = len(prefix_blocks) * self.cache.block_size
+
+    def _schedule(self):
+        """Picks the `(request, num_tokens)` pairs of the next forward pass."""
+        for request in [request for request in self.running if request.cancelled]:
+            self.running.remove(request)
+            self._finish(request)
+        for request in [request for request in self.waiting if request.cancelled]:
+            self.waiting.remove(request)
+            self._finish(request)
+
+        batch, budget, free_blocks = [], self.max_batch_tokens, self.cache.num_free_blocks
+        idx = 0
+        while idx < len(self.running) and budget > 0:
+            request = self.running[idx]
+            num_tokens = min(len(request.token_ids) - request.num_computed, budget)
+            needed = self.cache.blocks_needed(request.request_id, num_tokens)
+            if needed > free_blocks:
+                free_blocks += self._evict(needed - free_blocks)
+            while needed > free_blocks and self.running[-1] is not request:
+                free_blocks += self._preempt(self.running[-1])
+            if needed > free_blocks:
+                if idx == 0:
+                    raise RuntimeError(f"request {request.request_id} needs more blocks than the cache has")
+                free_blocks += self._preempt(request)
+                break
+            batch.append((request, num_tokens))
+            budget -= num_tokens
+            free_blocks -= needed
+            idx += 1
+
+        while self.waiting and budget > 0 and len(self.running) < self.max_num_seqs:
+            request = self.waiting[0]
+            self._admit(request)
+            num_tokens = min(len(request.token_ids) - request.num_computed, budget)
+            needed = self.cache.blocks_needed(request.request_id, num_tokens)
+            if needed > free_blocks:
+                free_blocks += self._evict(needed - free_blocks)
+            if needed > free_blocks:
+                self.cache.free_sequence(request.request_id)
+                if not self.running and needed > self.cache.num_blocks:
+                    raise RuntimeError(f"request {request.request_id} needs more blocks than the cache has")
+                break
+            self.waiting.popleft()
+            if self.prefix_cache is not None:
+                self.prefix_cache.record(len(request.token_ids), request.num_computed)
+            self.running.append(request)
+            if request.scheduled_time is None:
+                request.scheduled_time = time.perf_counter()
+                self.queue_latencies.append(request.scheduled_time - request.arrival_time)
+            batch.append((request, num_tokens))
+            budget -= num_tokens
+            free_blocks -= needed
+        return batch
+
+    def _sample(self, logits, temperatures):
+        next_tokens = logits.argmax(-1)
+        sampled = temperatures > 0
+        if sampled.any():
+            probs = torch.softmax(logits[sampled] / temperatures[sampled, None], dim=-1)
+            next_tokens[sampled] = torch.multinomial(probs.cpu(), 1, generator=self.generator).squeeze(-1).to(
+                next_tokens.device
+            )
+        return next_tokens.tolist()
+
+    @torch.no_grad()
+    def step(self):
+        """Runs one forward pass of continuous batching. Returns the number of tokens it processed."""
+        with self.lock:
+            batch = self._schedule()
+        if not batch:
+            return 0
+        start = time.perf_counter()
+        device = self.model.model.embed_tokens.weight.device
+        input_ids = torch.tensor(
+            [[token_id for request, num_tokens in batch
+              for token_id in request.token_ids[request.num_computed:request.num_computed + num_tokens]]],
+            device=device,
+        )
+        attention_mask, position_ids = self.cache.begin_step(
+            [request.request_id for request, _ in batch], [num_tokens for _, num_tokens in batch], packed=True
+        )
+        hidden_states = self.model.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.cache,
+            use_cache=True,
+        )[0]
+
+        # only requests whose tokens are all in the cache now produce a token, from the hidden state of their last one
+        ends = torch.tensor([num_tokens for _, num_tokens in batch]).cumsum(0) - 1
+        sampling = []
+        for (request, num_tokens), end in zip(batch, ends.tolist()):
+            request.num_computed += num_tokens
+            if request.num_computed == len(request.token_ids):
+                sampling.append((request, end))
+                if self.prefix_cache is not None and request.num_computed - num_tokens < request.prompt_len:
+                    self.prefix_cache.insert(request.token_ids, self.cache.block_tables[request.request_id])
+            if request.num_computed <= request.prompt_len:
+                self.prompt_tokens += num_tokens
+        if sampling:
+            logits = self.model.lm_head(hidden_states[0, [end for _, end in sampling]]).float()
+            temperatures = torch.tensor([request.temperature for request, _ in sampling], device=logits.device)
+            next_tokens = self._sample(logits, temperatures)
+        else:
+            next_tokens = []
+
+        now = time.perf_counter()
+        with self.lock:
+            for (request, _), token_id in zip(sampling, next_tokens):
+                request.token_ids.append(token_id)
+                self.generated_tokens += 1
+                if request.first_token_time is None:
+                    request.first_token_time = now
+                    self.first_token_latencies.append(now - request.arrival_time)
+                if not request.cancelled:
+                    request.outputs.put(token_id)
+                if token_id == self.eos_token_id or len(request.output_ids) >= request.max_new_tokens or request.cancelled:
+                    self.running.remove(request)
+                    self._finish(request)
+        self.num_steps += 1
+        self.busy_time += now - start
+        return len(input_ids[0])
+
+    def _loop(self):
+        while True:
+            with self.lock:
+                while not self._stopped and not self.waiting and not self.running:
+                    self.lock.wait()
+                if self._stopped:
+                    return
+                num_events = self._num_events
+            if self.step() == 0:
+                # nothing running and the waiting requests do not fit in the free blocks: nothing changes until a
+                # request comes or goes
+                with self.lock:
+                    while not self._stopped and self._num_events == num_events:
+                        self.lock.wait()
+
+    def start(self):
+        """Runs `step()` in a background thread whenever there is work."""
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self.lock:
+            self._stopped = True
+            self.lock.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self):
+        """Throughput (tokens/s over the time spent in forward passes) and per-request latencies in seconds."""
+        busy_time = max(self.busy_time, 1e-9)
+        return {
+            "steps": self.num_steps,
+            "prompt_tokens": self.prompt_tokens,
+            "generated_tokens": self.generated_tokens,
+            "tokens_per_s": (self.prompt_tokens + self.generated_tokens) / busy_time,
+            "generated_tokens_per_s": self.generated_tokens / busy_time,
+            "mean_queue_latency": sum(self.queue_latencies) / max(len(self.queue_latencies), 1),
+            "mean_first_token_latency": sum(self.first_token_latencies) / max(len(self.first_token_latencies), 1),
+            "prefix_hit_rate": self.prefix_cache.hit_rate if self.prefix_cache is not None else 0.0,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DEEPSEEK")
+    parser.add_argument("--num_requests", type=int, default=32, help="input the number of prompts")
+    parser.add_argument("--prompt_len", type=int, nargs=2, default=[16, 128], help="input the min and max prompt length")
+    parser.add_argument("--max_new_tokens", type=int, default=32, help="input the number of generated tokens")
+    parser.add_argument("--max_batch_tokens", type=int, default=512, help="input the token budget of a step")
+    parser.add_argument("--num_blocks", type=int, default=1024, help="input the number of KV cache blocks")
+    parser.add_argument("--shared_prefix_len", type=int, default=0, help="input the length of a prefix all prompts share")
+    parser.add_argument("--prefix_cache", action="store_true", help="input whether to reuse cached prompt prefixes")
+    args = parser.parse_args()
+    torch.manual_seed(0)
+
+    # tiny random model with the layout of deepseek-moe-16b (dense layer 0, shared + routed experts)
+    config = DeepseekConfig(
+        vocab_size=1024,
+        hidden_size=256,
+        intermediate_size=704,
+        moe_intermediate_size=64,
+        num_hidden_layers=4,
+        num_attention_heads=8,
+        num_key_value_heads=8,
+        n_shared_experts=2,
+        n_routed_experts=64,
+        num_experts_per_tok=6,
+        first_k_dense_replace=1,
+        max_position_embeddings=512,
+        attn_implementation="sdpa",
+    )
+    model = DeepseekForCausalLM(config).eval()
+    shared_prefix = torch.randint(0, config.vocab_size, (args.shared_prefix_len,)).tolist()
+    prompts = [
+        shared_prefix
+        + torch.randint(0, config.vocab_size, (int(torch.randint(args.prompt_len[0], args.prompt_len[1] + 1, ())),)).tolist()
+        for _ in range(args.num_requests)
+    ]
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        for prompt_ids in prompts:
+            model.generate(
+                torch.tensor([prompt_ids]),
+                max_new_tokens=args.max_new_tokens,
+                min_new_tokens=args.max_new_tokens,
+                do_sample=False,
+                pad_token_id=config.eos_token_id,
+            )
+    sequential_time = time.perf_counter() - start
+
+    # ignore eos so both runs generate the same number of tokens
+    engine = GenerationEngine(
+        model, args.num_blocks, max_batch_tokens=args.max_batch_tokens, eos_token_id=-1, prefix_cache=args.prefix_cache
+    )
+    start = time.perf_counter()
+    engine.generate(prompts, max_new_tokens=args.max_new_tokens)
+    engine_time = time.perf_counter() - start
+
+    stats = engine.stats()
+    num_generated = args.num_requests * args.max_new_tokens
+    print(f"generate, batch size 1: {num_generated / sequential_time:.1f} generated tokens/s")
+    print(f"engine: {num_generated / engine_time:.1f} generated tokens/s, {stats['tokens_per_s']:.1f} tokens/s in {stats['steps']} steps")
+    print(f"engine: mean queueing latency {stats['mean_queue_latency'] * 1000:.1f} ms, "
+          f"mean time to first token {stats['mean_first_token_latency'] * 1000:.1f} ms")
+    if args.prefix_cache:
+        print(f"engine: prefix cache hit rate {stats['prefix_hit_rate']:.4f}, {stats['prompt_tokens']} prompt tokens computed")
+
+
+"""
+python generation_engine.py --num_requests 32 --prompt_len 16 128 --max_new_tokens 32 --max_batch_tokens 512
+python generation_engine.py --num_requests 32 --prompt_len 16 64 --shared_prefix_len 512 --prefix_cache
+"""
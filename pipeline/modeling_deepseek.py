@@ -18,10 +18,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """ PyTorch DeepSeek model."""
+import contextlib
+import copy
+import glob
+import json
 import math
+import os
+import re
+import threading
 import warnings
+import weakref
+from collections import OrderedDict
 from typing import List, Optional, Tuple, Union
 
+import numpy as np
 import torch
 import torch.nn.functional as F
 import torch.utils.checkpoint
@@ -40,7 +50,12 @@ from transformers.modeling_outputs import BaseModelOutputWithPast, CausalLMOutpu
 from transformers.modeling_utils import PreTrainedModel
 from transformers.pytorch_utils import ALL_LAYERNORM_LAYERS, is_torch_greater_or_equal_than_1_13
 from transformers.utils import (
+    SAFE_WEIGHTS_INDEX_NAME,
+    SAFE_WEIGHTS_NAME,
+    WEIGHTS_INDEX_NAME,
+    WEIGHTS_NAME,
     add_start_docstrings,
+    cached_file,
     add_start_docstrings_to_model_forward,
     is_flash_attn_2_available,
     is_flash_attn_greater_or_equal_2_10,
@@ -150,7 +165,8 @@ class DeepseekRotaryEmbedding(nn.Module):
     def forward(self, x, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
         if self.max_seq_len_cached is None or seq_len > self.max_seq_len_cached:
-            self._set_cos_sin_cache(seq_len=seq_len, device=x.device, dtype=x.dtype)
+            # size the cache for the whole context at once so that decoding does not rebuild it at every step
+            self._set_cos_sin_cache(seq_len=max(seq_len, self.max_position_embeddings), device=x.device, dtype=x.dtype)
 
         return (
             self.cos_cached[:seq_len].to(dtype=x.dtype),
@@ -242,23 +258,330 @@ def apply_rotary_pos_emb(q, k, cos, sin, position_ids, unsqueeze_dim=1):
     return q_embed, k_embed
 
 
+def _tensor_parallel_world(config):
+    """`(rank, world_size)` of tensor parallelism (`config.tensor_parallel`), over the default process group."""
+    if not getattr(config, "tensor_parallel", False):
+        return 0, 1
+    return torch.distributed.get_rank(), torch.distributed.get_world_size()
+
+
+def _tensor_parallel_shard_state_dict(state_dict, prefix, shards, rank, world_size):
+    """
+    Slices the full checkpoint weights `{prefix}{name}.weight` of `shards` (`{name: (dim, full_size, chunks)}`) to this
+    rank's shard along `dim`: column-parallel projections are split over their output features (`dim=0`), row-parallel
+    ones over their input features (`dim=1`). A weight of `chunks` stacked blocks (the fused gate and up projections)
+    is split block by block. Weights that are not `full_size` along `dim` are left alone.
+    """
+    for name, (dim, full_size, chunks) in shards.items():
+        key = f"{prefix}{name}.weight"
+        if key in state_dict and state_dict[key].shape[dim] == full_size:
+            blocks = state_dict[key].chunk(chunks, dim=dim)
+            state_dict[key] = torch.cat([block.chunk(world_size, dim=dim)[rank] for block in blocks], dim=dim).clone()
+
+
+class DeepseekQuantLinear(nn.Module):
+    """
+    Weight-only quantized replacement of a bias-free `nn.Linear`, in plain PyTorch so it runs on CPU. The weight is
+    quantized asymmetrically in groups of `group_size` input features, each group of each output row with its own fp16
+    scale and integer zero point, `weight = (q - zero) * scale`. `group_size=None` picks per-channel scales (one group of
+    `in_features`) for 8 bits and groups of 128 for 4 bits:
+
+        bits=8: `qweight` int8 `[num_groups, out_features, group_size]` holding `q - 128`, `zeros` likewise shifted
+        bits=4: `qweight` uint8 `[out_features, in_features // 2]`, two values per byte (low nibble first)
+        `scales`, `zeros`: `[num_groups, out_features]`
+
+    For bf16 inputs on CPU with at most `kernel_rows` rows, `forward` uses the packed int8/int4 matmul kernels of
+    PyTorch (`_weight_int8pack_mm`, one call per group, and `_weight_int4pack_mm`, for which a copy of the 4-bit weight
+    in the kernel's layout is built on first use and kept next to `qweight`). These read the whole weight once per input
+    row, so for larger inputs (and on other devices) the weight is dequantized instead, `block_rows` output rows at a
+    time so the full precision weight is never materialized, and multiplied in the input dtype.
+    """
+
+    # above this many input rows (half of it for the per-group int8 loop) dequantizing beats the packed kernels
+    kernel_rows = 32
+
+    def __init__(self, in_features, out_features, bits = 8, group_size = None, block_rows = 256, device = None):
+        super().__init__()
+        if bits not in (4, 8):
+            raise ValueError(f"DeepseekQuantLinear supports 4 or 8 bits, got {bits}")
+        group_size = self.resolve_group_size(group_size, bits, in_features)
+        if in_features % group_size:
+            raise ValueError(f"in_features ({in_features}) must be a multiple of group_size ({group_size})")
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        self.block_rows = block_rows
+        self.num_groups = in_features // group_size
+        if bits == 8:
+            qweight = torch.zeros(self.num_groups, out_features, group_size, dtype=torch.int8, device=device)
+        else:
+            qweight = torch.zeros(out_features, in_features // 2, dtype=torch.uint8, device=device)
+        self.register_buffer("qweight", qweight)
+        self.register_buffer("scales", torch.ones(self.num_groups, out_features, dtype=torch.float16, device=device))
+        self.register_buffer("zeros", torch.zeros(self.num_groups, out_features, dtype=qweight.dtype, device=device))
+        # kernel layout of a 4-bit weight, None until first needed, False if the kernel cannot take this shape
+        self._int4pack = None
+
+    @staticmethod
+    def resolve_group_size(group_size, bits, in_features):
+        """The group size used for `group_size=None`: per-channel for 8 bits, 128 (at most) for 4 bits."""
+        if group_size is None:
+            return in_features if bits == 8 else min(128, in_features)
+        return group_size
+
+    @staticmethod
+    def quantize_weight(weight, bits = 8, group_size = None):
+        """Returns the `(qweight, scales, zeros)` buffers of a `[out_features, in_features]` weight."""
+        out_features, in_features = weight.shape
+        group_size = DeepseekQuantLinear.resolve_group_size(group_size, bits, in_features)
+        groups = weight.detach().float().view(out_features, in_features // group_size, group_size).transpose(0, 1)
+        low = groups.amin(dim=-1).clamp(max=0)
+        high = groups.amax(dim=-1).clamp(min=0)
+        max_q = 2 ** bits - 1
+        scales = ((high - low) / max_q).clamp(min=1e-8).half()
+        zeros = (-low / scales.float()).round().clamp(0, max_q)
+        qweight = (groups / scales.float().unsqueeze(-1) + zeros.unsqueeze(-1)).round().clamp(0, max_q)
+        # contiguous, as safetensors only saves dense tensors
+        scales = scales.contiguous()
+        if bits == 8:
+            return (qweight - 128).to(torch.int8).contiguous(), scales, (zeros - 128).to(torch.int8).contiguous()
+        qweight = qweight.transpose(0, 1).reshape(out_features, in_features).to(torch.uint8)
+        return (qweight[:, 0::2] | (qweight[:, 1::2] << 4)).contiguous(), scales, zeros.to(torch.uint8).contiguous()
+
+    @classmethod
+    def from_linear(cls, linear, bits = 8, group_size = None):
+        module = cls(linear.in_features, linear.out_features, bits, group_size, device=linear.weight.device)
+        module.qweight, module.scales, module.zeros = cls.quantize_weight(linear.weight, bits, group_size)
+        return module
+
+    def _pack_int4(self):
+        if self._int4pack is None and self.group_size not in (32, 64, 128, 256):
+            # the group sizes the kernel takes
+            self._int4pack = False
+        if self._int4pack is None:
+            qweight = torch.stack([self.qweight & 0xF, self.qweight >> 4], dim=-1).view(self.out_features, -1)
+            try:
+                self._int4pack = torch._convert_weight_to_int4pack(qweight.to(torch.int32).cpu(), 2)
+            except (AttributeError, RuntimeError):
+                self._int4pack = False
+        return self._int4pack is not False
+
+    def _apply(self, fn, *args, **kwargs):
+        # the kernel copy is rebuilt from `qweight` where it is next needed
+        self._int4pack = None
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._int4pack = None
+        super()._load_from_state_dict(*args, **kwargs)
+
+    def dequantize(self, rows = slice(None), dtype = torch.float32):
+        """The full precision weight (of a slice of output rows)."""
+        if self.bits == 8:
+            groups = self.qweight[:, rows].transpose(0, 1)
+        else:
+            qweight = self.qweight[rows]
+            groups = torch.stack([qweight & 0xF, qweight >> 4], dim=-1).view(qweight.shape[0], self.num_groups, -1)
+        scales = self.scales[:, rows].t().to(dtype).unsqueeze(-1)
+        zeros = self.zeros[:, rows].t().to(dtype).unsqueeze(-1)
+        return ((groups.to(dtype) - zeros) * scales).reshape(groups.shape[0], -1)
+
+    def forward(self, x):
+        shape = x.shape
+        x = x.reshape(-1, self.in_features)
+        use_kernel = x.device.type == "cpu" and x.dtype == torch.bfloat16
+        if (
+            use_kernel
+            and self.bits == 8
+            and x.shape[0] <= (self.kernel_rows if self.num_groups == 1 else self.kernel_rows // 2)
+            and hasattr(torch, "_weight_int8pack_mm")
+        ):
+            groups = x.view(x.shape[0], self.num_groups, self.group_size)
+            scales = self.scales.to(x.dtype)
+            y = torch.zeros(x.shape[0], self.out_features, dtype=torch.float32, device=x.device)
+            for group_idx in range(self.num_groups):
+                y += torch._weight_int8pack_mm(groups[:, group_idx].contiguous(), self.qweight[group_idx], scales[group_idx])
+            # the zero points, `sum(x) * scale * zero` per group
+            y -= groups.float().sum(dim=-1) @ (self.scales.float() * self.zeros.float())
+            y = y.to(x.dtype)
+        elif use_kernel and self.bits == 4 and x.shape[0] <= self.kernel_rows and self._pack_int4():
+            # the kernel computes `(q - 8) * scale + offset`, so the zero point becomes `offset = (8 - zero) * scale`
+            scales_and_zeros = torch.stack(
+                [self.scales.float(), (8 - self.zeros.float()) * self.scales.float()], dim=-1
+            ).to(x.dtype)
+            y = torch._weight_int4pack_mm(x.contiguous(), self._int4pack, self.group_size, scales_and_zeros)
+        else:
+            y = torch.cat(
+                [
+                    F.linear(x, self.dequantize(slice(start, start + self.block_rows), x.dtype))
+                    for start in range(0, self.out_features, self.block_rows)
+                ],
+                dim=-1,
+            )
+        return y.view(*shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}, group_size={self.group_size}"
+
+
+_EXPERT_WEIGHT_PATTERN = re.compile(r"(.*layers\.(\d+)\.mlp\.experts\.(\d+)\.(?:gate_proj|up_proj|down_proj))\.weight$")
+
+
+def quantize_expert_state_dict(state_dict, bits = 8, group_size = None, experts = None):
+    """
+    Converts the routed-expert projection weights of a state dict (e.g. the bf16 checkpoint) into
+    [`DeepseekQuantLinear`] buffers, to load into a model whose experts were quantized with
+    `DeepseekMoE.quantize_experts` with the same arguments. `experts` maps layer indices to the expert ids to convert,
+    `None` converts every routed expert.
+    """
+    quantized = {}
+    for key, value in state_dict.items():
+        match = _EXPERT_WEIGHT_PATTERN.match(key)
+        if match is None or (experts is not None and int(match.group(3)) not in experts.get(int(match.group(2)), ())):
+            quantized[key] = value
+            continue
+        prefix = match.group(1)
+        qweight, scales, zeros = DeepseekQuantLinear.quantize_weight(value, bits, group_size)
+        quantized.update({f"{prefix}.qweight": qweight, f"{prefix}.scales": scales, f"{prefix}.zeros": zeros})
+    return quantized
+
+
+def _expert_precision(expert):
+    """`"pruned"`, `"int8"`, `"int4"` or `"bf16"` (the model dtype) for a routed expert, as in `config.expert_precisions`."""
+    if isinstance(expert, nn.Identity):
+        return "pruned"
+    bits = {module.bits for module in expert.modules() if isinstance(module, DeepseekQuantLinear)}
+    return f"int{max(bits)}" if bits else "bf16"
+
+
+def _materialize_parameter(module, name, like):
+    """
+    Allocates `module.{name}` with the dtype and device of the checkpoint tensor `like` if it is still on the meta
+    device (see [`empty_parameters`]), for the load hooks that fill parameters in place.
+    """
+    param = getattr(module, name)
+    if param.device.type == "meta":
+        param = nn.Parameter(torch.empty(param.shape, dtype=like.dtype, device=like.device), requires_grad=param.requires_grad)
+        setattr(module, name, param)
+    return param
+
+
 class DeepseekMLP(nn.Module):
     def __init__(self, config, hidden_size = None, intermediate_size = None):
         super().__init__()
         self.config = config
         self.hidden_size = config.hidden_size if hidden_size is None else hidden_size
         self.intermediate_size = config.intermediate_size if intermediate_size is None else intermediate_size
-
-        self.gate_proj = nn.Linear(self.hidden_size, self.intermediate_size, bias=False)
-        self.up_proj = nn.Linear(self.hidden_size, self.intermediate_size, bias=False)
-        self.down_proj = nn.Linear(self.intermediate_size, self.hidden_size, bias=False)
+        # tensor parallelism: gate/up column-parallel, down row-parallel, the decoder layer sums over the ranks
+        self.tp_rank, self.tp_size = _tensor_parallel_world(config)
+        if self.intermediate_size % self.tp_size:
+            raise ValueError(f"intermediate_size ({self.intermediate_size}) must be divisible by the tensor-parallel size ({self.tp_size})")
+        intermediate_size = self.intermediate_size // self.tp_size
+
+        if config.fuse_gate_up_proj:
+            self.gate_up_proj = nn.Linear(self.hidden_size, 2 * intermediate_size, bias=False)
+        else:
+            self.gate_proj = nn.Linear(self.hidden_size, intermediate_size, bias=False)
+            self.up_proj = nn.Linear(self.hidden_size, intermediate_size, bias=False)
+        self.down_proj = nn.Linear(intermediate_size, self.hidden_size, bias=False)
         self.act_fn = ACT2FN[config.hidden_act]
 
+        if self.tp_size > 1:
+            self._register_load_state_dict_pre_hook(self._shard_state_dict)
+        # `gate_proj`/`up_proj` checkpoint tensors waiting for their other half, see `_fuse_gate_up_state_dict`
+        self._gate_up_halves = {}
+        self._register_state_dict_hook(self._split_gate_up_state_dict)
+        self._register_load_state_dict_pre_hook(self._fuse_gate_up_state_dict)
+
+    @staticmethod
+    def _split_gate_up_state_dict(module, state_dict, prefix, local_metadata):
+        # the fused projection is saved under the original `gate_proj`/`up_proj` keys
+        if prefix + "gate_up_proj.weight" in state_dict:
+            gate_proj, up_proj = state_dict.pop(prefix + "gate_up_proj.weight").chunk(2, dim=0)
+            state_dict[prefix + "gate_proj.weight"] = gate_proj.clone()
+            state_dict[prefix + "up_proj.weight"] = up_proj.clone()
+        # as are the buffers of a quantized one, whose output rows are quantized independently
+        for name, dim in DeepseekMLP._quantized_row_dims(module):
+            gate_proj, up_proj = state_dict.pop(prefix + "gate_up_proj." + name).chunk(2, dim=dim)
+            state_dict[prefix + "gate_proj." + name] = gate_proj.clone()
+            state_dict[prefix + "up_proj." + name] = up_proj.clone()
+        return state_dict
+
+    @staticmethod
+    def _quantized_row_dims(module):
+        """The buffers of a quantized `gate_up_proj` with their output-row dimension."""
+        if not isinstance(getattr(module, "gate_up_proj", None), DeepseekQuantLinear):
+            return ()
+        return (("qweight", 1 if module.gate_up_proj.bits == 8 else 0), ("scales", 1), ("zeros", 1))
+
+    def _shard_state_dict(self, state_dict, prefix, *args):
+        shards = {
+            "gate_proj": (0, self.intermediate_size, 1),
+            "up_proj": (0, self.intermediate_size, 1),
+            "gate_up_proj": (0, 2 * self.intermediate_size, 2),
+            "down_proj": (1, self.intermediate_size, 1),
+        }
+        _tensor_parallel_shard_state_dict(state_dict, prefix, shards, self.tp_rank, self.tp_size)
+
+    def _fuse_gate_up_state_dict(self, state_dict, prefix, *args):
+        # fused only once both halves are at hand: a half that comes alone stays under its own key, so that strict
+        # loading reports it, and is kept until the other one arrives (e.g. from the next checkpoint shard)
+        if not hasattr(self, "gate_up_proj"):
+            return
+        for name, dim in self._quantized_row_dims(self) or (("weight", 0),):
+            keys = [prefix + half + "." + name for half in ("gate_proj", "up_proj")]
+            halves = [state_dict.get(key, self._gate_up_halves.get(key)) for key in keys]
+            if any(half is None for half in halves):
+                self._gate_up_halves.update({key: state_dict[key] for key in keys if key in state_dict})
+                continue
+            for key in keys:
+                state_dict.pop(key, None)
+                self._gate_up_halves.pop(key, None)
+            state_dict[prefix + "gate_up_proj." + name] = torch.cat(halves, dim=dim)
+
+    def fuse_gate_up_proj(self):
+        """
+        Converts separately loaded `gate_proj`/`up_proj` weights to the fused `[2 * intermediate_size, hidden_size]`
+        layout in place, e.g. after `from_pretrained(..., device_map="auto")` which bypasses the state dict hooks.
+        """
+        if not hasattr(self, "gate_up_proj"):
+            gate_up_proj = nn.Linear(self.hidden_size, 2 * self.gate_proj.out_features, bias=False)
+            gate_up_proj.to(device=self.gate_proj.weight.device, dtype=self.gate_proj.weight.dtype)
+            with torch.no_grad():
+                torch.cat([self.gate_proj.weight, self.up_proj.weight], out=gate_up_proj.weight.data)
+            self.gate_up_proj = gate_up_proj
+            del self.gate_proj, self.up_proj
+        return self
+
+    def quantize(self, bits = 8, group_size = None, empty = False):
+        """
+        Replaces the projections by [`DeepseekQuantLinear`] modules quantized from their current weights, or with
+        `empty=True` left unset, to load a quantized checkpoint into.
+        """
+        for name, module in list(self.named_children()):
+            if isinstance(module, nn.Linear):
+                if empty:
+                    quantized = DeepseekQuantLinear(
+                        module.in_features, module.out_features, bits, group_size, device=module.weight.device
+                    )
+                else:
+                    quantized = DeepseekQuantLinear.from_linear(module, bits, group_size)
+                setattr(self, name, quantized)
+        return self
+
+    def gate_up_weights(self):
+        """The `gate_proj` and `up_proj` weights, as views of the fused weight if the projections are fused."""
+        if hasattr(self, "gate_up_proj"):
+            return self.gate_up_proj.weight.chunk(2, dim=0)
+        return self.gate_proj.weight, self.up_proj.weight
+
     def forward(self, x):
         if self.config.pretraining_tp > 1:
             slice = self.intermediate_size // self.config.pretraining_tp
-            gate_proj_slices = self.gate_proj.weight.split(slice, dim=0)
-            up_proj_slices = self.up_proj.weight.split(slice, dim=0)
+            gate_proj_weight, up_proj_weight = self.gate_up_weights()
+            gate_proj_slices = gate_proj_weight.split(slice, dim=0)
+            up_proj_slices = up_proj_weight.split(slice, dim=0)
             down_proj_slices = self.down_proj.weight.split(slice, dim=1)
 
             gate_proj = torch.cat(
@@ -271,12 +594,401 @@ class DeepseekMLP(nn.Module):
                 F.linear(intermediate_states[i], down_proj_slices[i]) for i in range(self.config.pretraining_tp)
             ]
             down_proj = sum(down_proj)
+        elif hasattr(self, "gate_up_proj"):
+            gate_proj, up_proj = self.gate_up_proj(x).chunk(2, dim=-1)
+            down_proj = self.down_proj(self.act_fn(gate_proj) * up_proj)
         else:
             down_proj = self.down_proj(self.act_fn(self.gate_proj(x)) * self.up_proj(x))
 
         return down_proj
 
 
+class DeepseekGroupedExperts(nn.Module):
+    """
+    The routed experts of a [`DeepseekMoE`] layer with their projections stacked along a leading expert dimension, so
+    that they run over one expert-sorted token buffer, with one batched matmul per projection over the active experts.
+    With `config.fuse_gate_up_proj` the gate and up projections are stacked together as one
+    `[num_experts, 2 * intermediate_size, hidden_size]` tensor. The state dict keeps the per-expert
+    `{expert_idx}.{gate,up,down}_proj.weight` layout of a `nn.ModuleList` of [`DeepseekMLP`], so existing checkpoints
+    load and save unchanged.
+    """
+
+    # devices on which the active experts run one at a time on views of the stacked weights unless every expert is
+    # active: there a host read is free and gathering their weights for a batched matmul is only a copy
+    per_expert_devices = ("cpu",)
+
+    def __init__(self, config, num_experts, hidden_size = None, intermediate_size = None):
+        super().__init__()
+        self.config = config
+        self.num_experts = num_experts
+        self.hidden_size = config.hidden_size if hidden_size is None else hidden_size
+        self.intermediate_size = config.moe_intermediate_size if intermediate_size is None else intermediate_size
+
+        if config.fuse_gate_up_proj:
+            self.gate_up_proj = nn.Parameter(torch.empty(num_experts, 2 * self.intermediate_size, self.hidden_size))
+        else:
+            self.gate_proj = nn.Parameter(torch.empty(num_experts, self.intermediate_size, self.hidden_size))
+            self.up_proj = nn.Parameter(torch.empty(num_experts, self.intermediate_size, self.hidden_size))
+        self.down_proj = nn.Parameter(torch.empty(num_experts, self.hidden_size, self.intermediate_size))
+        self.act_fn = ACT2FN[config.hidden_act]
+
+        self._register_state_dict_hook(self._unstack_state_dict)
+        self._register_load_state_dict_pre_hook(self._stack_state_dict)
+
+    @classmethod
+    def from_experts(cls, experts):
+        """Builds the stacked layout from a `nn.ModuleList` of [`DeepseekMLP`] experts."""
+        first = experts[0]
+        grouped = cls(first.config, len(experts), first.hidden_size, first.intermediate_size)
+        grouped.to(device=first.down_proj.weight.device, dtype=first.down_proj.weight.dtype)
+        with torch.no_grad():
+            for i, expert in enumerate(experts):
+                gate_proj, up_proj = expert.gate_up_weights()
+                grouped._expert_weight("gate_proj", i).copy_(gate_proj)
+                grouped._expert_weight("up_proj", i).copy_(up_proj)
+                grouped._expert_weight("down_proj", i).copy_(expert.down_proj.weight)
+        return grouped
+
+    def __len__(self):
+        return self.num_experts
+
+    @staticmethod
+    def _unstack_state_dict(module, state_dict, prefix, local_metadata):
+        for name in ("gate_up_proj", "gate_proj", "up_proj", "down_proj"):
+            if prefix + name not in state_dict:
+                continue
+            stacked = state_dict.pop(prefix + name)
+            for i, weight in enumerate(stacked.unbind(0)):
+                # clone so that serializers which refuse shared storage (safetensors) see independent tensors
+                if name == "gate_up_proj":
+                    gate_proj, up_proj = weight.chunk(2, dim=0)
+                    state_dict[f"{prefix}{i}.gate_proj.weight"] = gate_proj.clone()
+                    state_dict[f"{prefix}{i}.up_proj.weight"] = up_proj.clone()
+                else:
+                    state_dict[f"{prefix}{i}.{name}.weight"] = weight.clone()
+        return state_dict
+
+    def _expert_weight(self, name, expert_idx):
+        """The slice of the stacked storage holding `experts.{expert_idx}.{name}.weight`."""
+        if name != "down_proj" and hasattr(self, "gate_up_proj"):
+            return self.gate_up_proj.data[expert_idx].chunk(2, dim=0)[1 if name == "up_proj" else 0]
+        return getattr(self, name).data[expert_idx]
+
+    def _stack_state_dict(self, state_dict, prefix, *args):
+        # every per-expert weight is copied straight into its slice, as a layer may span several checkpoint shards
+        for name in ("gate_proj", "up_proj", "down_proj"):
+            for i in range(self.num_experts):
+                key = f"{prefix}{i}.{name}.weight"
+                if key in state_dict:
+                    stacked_name = "gate_up_proj" if name != "down_proj" and hasattr(self, "gate_up_proj") else name
+                    _materialize_parameter(self, stacked_name, state_dict[key])
+                    self._expert_weight(name, i).copy_(state_dict.pop(key))
+                    state_dict[prefix + stacked_name] = getattr(self, stacked_name).data
+
+    def _gate_up_params(self):
+        if hasattr(self, "gate_up_proj"):
+            return (self.gate_up_proj,)
+        return self.gate_proj, self.up_proj
+
+    def forward(self, hidden_states):
+        """
+        Args:
+            hidden_states (`torch.Tensor`): padded token buffer of shape `(num_experts, capacity, hidden_size)`, row
+                `i` holding the tokens routed to expert `i`.
+        """
+        return self._experts_bmm(hidden_states, *self._gate_up_params(), self.down_proj)
+
+    def expert_forward(self, hidden_states, expert_idx):
+        """Runs a single expert on `hidden_states` through views of the stacked weights."""
+        gate_up_proj = [F.linear(hidden_states, weight[expert_idx]) for weight in self._gate_up_params()]
+        gate_proj, up_proj = gate_up_proj if len(gate_up_proj) == 2 else gate_up_proj[0].chunk(2, dim=-1)
+        return F.linear(self.act_fn(gate_proj) * up_proj, self.down_proj[expert_idx])
+
+    def gathered_forward(self, hidden_states, expert_ids):
+        """
+        Args:
+            hidden_states (`torch.Tensor`): tokens of shape `(len(expert_ids), capacity, hidden_size)`.
+            expert_ids (`torch.LongTensor`): the expert whose weights are gathered for each row of `hidden_states`.
+        """
+        weights = [weight.index_select(0, expert_ids) for weight in self._gate_up_params() + (self.down_proj,)]
+        return self._experts_bmm(hidden_states, *weights)
+
+    def _experts_bmm(self, hidden_states, *weights):
+        *gate_up_weights, down_proj = weights
+        gate_up_proj = [torch.bmm(hidden_states, weight.transpose(1, 2)) for weight in gate_up_weights]
+        gate_proj, up_proj = gate_up_proj if len(gate_up_proj) == 2 else gate_up_proj[0].chunk(2, dim=-1)
+        return torch.bmm(self.act_fn(gate_proj) * up_proj, down_proj.transpose(1, 2))
+
+
+class DeepseekExpertCache:
+    """
+    LRU cache of materialized routed experts, bounded by the total bytes of the weights it holds. Shared by all the
+    [`DeepseekOffloadedExperts`] layers reading from one [`DeepseekExpertStore`]; `hits`, `misses` and `evictions`
+    count lookups since the last `reset_stats()`. Safe to fill from a background thread with `prefetch()`.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._experts = OrderedDict()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._experts)
+
+    def __contains__(self, key):
+        return key in self._experts
+
+    def get(self, key, load_fn):
+        """Returns the weights cached under `key`, calling `load_fn()` to materialize them on a miss."""
+        with self._lock:
+            weights = self._experts.get(key)
+            if weights is not None:
+                self.hits += 1
+                self._experts.move_to_end(key)
+                return weights
+            self.misses += 1
+        return self._insert(key, load_fn())
+
+    def prefetch(self, key, load_fn):
+        """
+        Materializes `key` ahead of use, without counting a hit or a miss. A guess never displaces a used expert: it
+        is skipped when the cache has no room left for it, and goes in at the least recently used end, so a wrong one
+        is the first out.
+        """
+        with self._lock:
+            if key in self._experts or (self.max_bytes is not None and self.num_bytes >= self.max_bytes):
+                return
+        self._insert(key, load_fn(), prefetch=True)
+
+    def _insert(self, key, weights, prefetch = False):
+        # loading runs outside the lock, if another thread got there first its copy wins
+        with self._lock:
+            if key in self._experts:
+                return self._experts[key]
+            num_bytes = sum(weight.numel() * weight.element_size() for weight in weights.values())
+            if prefetch and self.max_bytes is not None and self.num_bytes + num_bytes > self.max_bytes:
+                return weights
+            self._experts[key] = weights
+            if prefetch:
+                self._experts.move_to_end(key, last=False)
+            self.num_bytes += num_bytes
+            # the expert just loaded is returned even if it alone exceeds the budget, it is then the next one out
+            while self.max_bytes is not None and self.num_bytes > self.max_bytes and len(self._experts) > 1:
+                _, evicted = self._experts.popitem(last=False)
+                self.num_bytes -= sum(weight.numel() * weight.element_size() for weight in evicted.values())
+                self.evictions += 1
+            return weights
+
+
+class DeepseekExpertStore:
+    """
+    Routed-expert weights kept on local disk as one `torch.save` file per MoE layer, holding the
+    `[n_routed_experts, ...]` stacked `gate_proj`, `up_proj` and `down_proj` weights. The files are opened
+    memory-mapped, so an expert is only paged in when it is materialized into the shared [`DeepseekExpertCache`].
+    Stores are shared per directory and cache budget while a model uses them, see `open()`.
+    """
+
+    # held weakly, a store is freed with the last model whose offloaded experts use it
+    _stores = weakref.WeakValueDictionary()
+
+    def __init__(self, path, max_bytes = None):
+        self.path = path
+        self.cache = DeepseekExpertCache(max_bytes)
+        self._layers = {}
+
+    @classmethod
+    def open(cls, path, max_bytes = None):
+        """
+        Returns the store of `path` whose expert cache is bounded by `max_bytes`, opening it if no live model uses one
+        already. Models with different budgets get stores, and caches, of their own.
+        """
+        key = (os.path.abspath(path), max_bytes)
+        store = cls._stores.get(key)
+        if store is None:
+            store = cls._stores[key] = cls(key[0], max_bytes)
+        return store
+
+    @staticmethod
+    def layer_file(path, layer_idx):
+        return os.path.join(path, f"layer_{layer_idx}.pt")
+
+    @classmethod
+    def save(cls, path, model):
+        """Writes the routed experts of every [`DeepseekMoE`] layer of a loaded `model` to the store directory `path`."""
+        os.makedirs(path, exist_ok=True)
+        for module in model.modules():
+            if not isinstance(module, DeepseekMoE) or isinstance(module.experts, DeepseekOffloadedExperts):
+                continue
+            if isinstance(module.experts, DeepseekGroupedExperts):
+                weights = {
+                    name: torch.stack([module.experts._expert_weight(name, i) for i in range(len(module.experts))])
+                    for name in ("gate_proj", "up_proj", "down_proj")
+                }
+            else:
+                gate_proj, up_proj = zip(*[expert.gate_up_weights() for expert in module.experts])
+                down_proj = [expert.down_proj.weight for expert in module.experts]
+                weights = {"gate_proj": torch.stack(gate_proj), "up_proj": torch.stack(up_proj), "down_proj": torch.stack(down_proj)}
+            torch.save({name: weight.detach().cpu() for name, weight in weights.items()}, cls.layer_file(path, module.layer_idx))
+
+    @classmethod
+    def save_from_checkpoint(cls, path, checkpoint_dir):
+        """
+        Writes the store straight from the `*.safetensors` shards of a checkpoint directory, one layer at a time, so
+        that the full model never has to be resident.
+        """
+        from safetensors import safe_open
+
+        pattern = re.compile(r"model\.layers\.(\d+)\.mlp\.experts\.(\d+)\.(gate_proj|up_proj|down_proj)\.weight")
+        locations = {}
+        for shard in sorted(glob.glob(os.path.join(checkpoint_dir, "*.safetensors"))):
+            with safe_open(shard, framework="pt") as f:
+                for key in f.keys():
+                    match = pattern.fullmatch(key)
+                    if match is not None:
+                        layer_idx, expert_idx, name = int(match[1]), int(match[2]), match[3]
+                        locations.setdefault(layer_idx, {}).setdefault(name, {})[expert_idx] = (shard, key)
+        os.makedirs(path, exist_ok=True)
+        with contextlib.ExitStack() as stack:
+            shards = {}
+            for layer_idx, names in locations.items():
+                weights = {}
+                for name, experts in names.items():
+                    tensors = []
+                    for expert_idx in range(len(experts)):
+                        shard, key = experts[expert_idx]
+                        if shard not in shards:
+                            shards[shard] = stack.enter_context(safe_open(shard, framework="pt"))
+                        tensors.append(shards[shard].get_tensor(key))
+                    weights[name] = torch.stack(tensors)
+                torch.save(weights, cls.layer_file(path, layer_idx))
+
+    def layer(self, layer_idx):
+        """The memory-mapped stacked weights of a layer."""
+        if layer_idx not in self._layers:
+            weights = torch.load(self.layer_file(self.path, layer_idx), mmap=True, weights_only=True)
+            self._layers.setdefault(layer_idx, weights)
+        return self._layers[layer_idx]
+
+    def _load_expert(self, layer_idx, expert_idx):
+        return {name: weight[expert_idx].clone() for name, weight in self.layer(layer_idx).items()}
+
+    def expert(self, layer_idx, expert_idx):
+        """The weights of one expert, materialized in RAM through the cache."""
+        return self.cache.get((layer_idx, expert_idx), lambda: self._load_expert(layer_idx, expert_idx))
+
+    def prefetch(self, layer_idx, expert_idx):
+        """Materializes one expert into the cache ahead of use, e.g. from a background thread."""
+        self.cache.prefetch((layer_idx, expert_idx), lambda: self._load_expert(layer_idx, expert_idx))
+
+
+class DeepseekOffloadedExperts(nn.Module):
+    """
+    The routed experts of a [`DeepseekMoE`] layer served from a [`DeepseekExpertStore`] (`config.moe_offload_dir`):
+    the module holds no parameters, each active expert is fetched from the store's RAM cache, or paged in from disk on
+    a miss, when it runs. Inference only, `DeepseekMoE` raises in training mode.
+    """
+
+    def __init__(self, config, num_experts, layer_idx):
+        super().__init__()
+        self.num_experts = num_experts
+        self.layer_idx = layer_idx
+        self.store = DeepseekExpertStore.open(config.moe_offload_dir, config.moe_offload_max_bytes)
+        self.act_fn = ACT2FN[config.hidden_act]
+
+    def __len__(self):
+        return self.num_experts
+
+    def expert_forward(self, hidden_states, expert_idx):
+        weights = self.store.expert(self.layer_idx, expert_idx)
+        gate_proj = F.linear(hidden_states, weights["gate_proj"].to(hidden_states.device, hidden_states.dtype))
+        up_proj = F.linear(hidden_states, weights["up_proj"].to(hidden_states.device, hidden_states.dtype))
+        return F.linear(self.act_fn(gate_proj) * up_proj, weights["down_proj"].to(hidden_states.device, hidden_states.dtype))
+
+
+class DeepseekShardedExperts(nn.ModuleDict):
+    """
+    The routed experts of a [`DeepseekMoE`] layer sharded across the ranks of a `torch.distributed` process group
+    (expert parallelism, `config.moe_expert_parallel`): rank `r` holds the [`DeepseekMLP`] experts
+    `[r * experts_per_rank, (r + 1) * experts_per_rank)`, keyed by expert index so that the state dict keeps the
+    `{expert_idx}.*` layout of a `nn.ModuleList`; the other ranks' experts are skipped on load.
+
+    Everything else is replicated: each rank runs attention, gates and shared experts on its own tokens, and in every
+    MoE layer sends each token-expert assignment to the rank holding the expert and gets the output back, with
+    `all_to_all_single` exchanges (differentiable, so this also trains). Every rank must therefore run the same MoE
+    layers the same number of times, e.g. generate the same number of tokens.
+    """
+
+    def __init__(self, config, num_experts, group = None, experts = None):
+        world_size = torch.distributed.get_world_size(group)
+        rank = torch.distributed.get_rank(group)
+        experts_per_rank = math.ceil(num_experts / world_size)
+        start, end = rank * experts_per_rank, min((rank + 1) * experts_per_rank, num_experts)
+        if experts is None:
+            experts = {
+                expert_idx: DeepseekMLP(config, intermediate_size = config.moe_intermediate_size)
+                for expert_idx in range(start, end)
+            }
+        super().__init__({str(expert_idx): experts[expert_idx] for expert_idx in range(start, end)})
+        self.num_experts = num_experts
+        self.group = group
+        self.world_size = world_size
+        self.experts_per_rank = experts_per_rank
+        self.start = start
+        self._register_load_state_dict_pre_hook(self._drop_remote_state_dict)
+
+    @classmethod
+    def from_experts(cls, experts, group = None):
+        """Keeps this rank's shard of a `nn.ModuleList` of [`DeepseekMLP`] experts."""
+        return cls(experts[0].config, len(experts), group, experts)
+
+    def __len__(self):
+        return self.num_experts
+
+    def _drop_remote_state_dict(self, state_dict, prefix, *args):
+        for key in list(state_dict):
+            if key.startswith(prefix) and key[len(prefix):].split(".")[0] not in self._modules:
+                del state_dict[key]
+
+    def _exchange(self, tensor, output_splits, input_splits):
+        from torch.distributed.nn.functional import all_to_all_single
+
+        output = tensor.new_empty((sum(output_splits),) + tensor.shape[1:])
+        return all_to_all_single(output, tensor, output_splits, input_splits, group=self.group)
+
+    def forward(self, x, flat_expert_indices, flat_expert_weights):
+        num_experts_per_tok = flat_expert_indices.numel() // max(x.shape[0], 1)
+        # assignments by destination rank, dropped ones (index `num_experts`) last and never sent
+        idxs = flat_expert_indices.argsort(stable=True)
+        expert_ids = flat_expert_indices[idxs]
+        ranks = torch.where(expert_ids < self.num_experts, expert_ids // self.experts_per_rank, self.world_size)
+        send_counts = ranks.bincount(minlength=self.world_size + 1)[:self.world_size]
+        recv_counts = torch.empty_like(send_counts)
+        torch.distributed.all_to_all_single(recv_counts, send_counts, group=self.group)
+        send_splits, recv_splits = send_counts.tolist(), recv_counts.tolist()
+        idxs = idxs[:sum(send_splits)]
+        token_idxs = idxs // num_experts_per_tok
+
+        recv_tokens = self._exchange(x[token_idxs], recv_splits, send_splits)
+        recv_ids = self._exchange(expert_ids[:len(idxs)], recv_splits, send_splits)
+        # the received assignments come grouped by source rank, run them grouped by local expert
+        local_order = recv_ids.argsort()
+        counts = (recv_ids - self.start).bincount(minlength=len(self._modules)).tolist()
+        outputs = torch.empty_like(recv_tokens)
+        for expert, order in zip(self.values(), local_order.split(counts)):
+            if order.numel():
+                outputs[order] = expert(recv_tokens[order])
+
+        expert_out = self._exchange(outputs, send_splits, recv_splits) * flat_expert_weights[idxs]
+        return torch.zeros_like(x).index_add_(0, token_idxs, expert_out.to(x.dtype))
+
+
 class MoEGate(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -294,11 +1006,27 @@ class MoEGate(nn.Module):
         self.weight = nn.Parameter(torch.empty((self.n_routed_experts, self.gating_dim)))
         self.reset_parameters()
 
+        # expert capacity, `dropped_assignments` counts the token-expert assignments dropped by the last forward pass
+        # and `dropped_tokens` the tokens that lost all of them (left with the shared experts only)
+        self.capacity_factor = config.moe_capacity_factor
+        self.overflow_policy = config.moe_overflow_policy
+        self.dropped_assignments = None
+        self.dropped_tokens = None
+
+        # routed experts removed by `DeepseekMoE.prune_experts`, never selected
+        self.register_buffer("expert_mask", None, persistent=False)
+
+        # copies of hot experts, see `set_replicas`
+        self.replica_policy = config.expert_replica_policy
+        self.num_replicas = 0
+        self.register_buffer("replica_table", None, persistent=False)
+        self.register_buffer("replica_counts", None, persistent=False)
+
     def reset_parameters(self) -> None:
         import torch.nn.init  as init
         init.kaiming_uniform_(self.weight, a=math.sqrt(5))
     
-    def forward(self, hidden_states):
+    def forward(self, hidden_states, position_ids = None):
         bsz, seq_len, h = hidden_states.shape        
         ### compute gating score
         hidden_states = hidden_states.view(-1, h)
@@ -307,6 +1035,9 @@ class MoEGate(nn.Module):
             scores = logits.softmax(dim=-1)
         else:
             raise NotImplementedError(f'insupportable scoring function for MoE gating: {self.scoring_func}')
+        if self.expert_mask is not None:
+            # the remaining experts keep their unpruned weights
+            scores = scores.masked_fill(self.expert_mask, 0)
         
         ### select top-k experts
         topk_weight, topk_idx = torch.topk(scores, k=self.top_k, dim=-1, sorted=False)
@@ -335,8 +1066,123 @@ class MoEGate(nn.Module):
                 aux_loss = (Pi * fi).sum() * self.alpha
         else:
             aux_loss = None
+
+        ### cap the assignments per expert
+        if self.capacity_factor is not None:
+            topk_idx, topk_weight = self.apply_capacity(scores, topk_idx, topk_weight)
+        if self.replica_table is not None:
+            topk_idx = self.route_replicas(topk_idx, position_ids, bsz)
         return topk_idx, topk_weight, aux_loss
 
+    def set_replicas(self, replicas):
+        """
+        Gives the experts of `replicas` (`{expert_idx: num_replicas}`) extra copies with expert indices from
+        `n_routed_experts` on, in expert order, and returns the expert each copy replicates. Dropped assignments then get
+        index `n_routed_experts + num_replicas`.
+        """
+        sources = [expert_idx for expert_idx in sorted(replicas) for _ in range(replicas[expert_idx])]
+        self.num_replicas = len(sources)
+        if not sources:
+            self.replica_table = self.replica_counts = None
+            return sources
+        # built at construction, when the weight may still be on the meta device (`empty_parameters`)
+        device = self.weight.device if self.weight.device.type != "meta" else None
+        counts = torch.ones(self.n_routed_experts, dtype=torch.long)
+        table = torch.arange(self.n_routed_experts).unsqueeze(1).repeat(1, 1 + max(replicas.values()))
+        for replica_idx, expert_idx in enumerate(sources, start=self.n_routed_experts):
+            table[expert_idx, counts[expert_idx]] = replica_idx
+            counts[expert_idx] += 1
+        self.replica_table = table.to(device)
+        self.replica_counts = counts.to(device)
+        return sources
+
+    def route_replicas(self, topk_idx, position_ids = None, batch_size = 1):
+        """
+        Moves assignments of replicated experts to one of their copies, deterministically and without host
+        synchronization. The choice only depends on the current inputs, never on earlier forward passes, so the same
+        batch is always routed the same way. `"hash"` picks the copy from a multiplicative hash of the token's row in
+        the batch and its position id (of its index in the batch without `position_ids`), so a token takes the same
+        copy with or without a KV cache. `"least_loaded"` hands each expert's assignments out round-robin in token
+        order, which keeps the copies of an expert within one assignment of each other in every forward pass.
+        """
+        num_experts = self.n_routed_experts
+        num_tokens = topk_idx.shape[0]
+        flat_idx = topk_idx.view(-1)
+        expert_idx = flat_idx.clamp(max=num_experts - 1)
+        counts = self.replica_counts[expert_idx]
+        if self.replica_policy == 'hash':
+            if position_ids is None:
+                keys = torch.arange(num_tokens, device=topk_idx.device)
+            else:
+                rows = torch.arange(batch_size, device=topk_idx.device).unsqueeze(1)
+                keys = ((rows << 20) + position_ids.to(topk_idx.device).expand(batch_size, -1)).reshape(-1)
+            hashed = ((keys * 2654435761) % (1 << 32)) >> 16
+            copy = hashed.repeat_interleave(topk_idx.shape[1]) % counts
+        else:
+            # rank of every assignment among those of its expert, in token order
+            order = flat_idx.argsort(stable=True)
+            assigned = flat_idx.bincount(minlength=num_experts + 1)
+            starts = assigned.cumsum(0) - assigned
+            rank = torch.empty_like(flat_idx)
+            rank[order] = torch.arange(flat_idx.numel(), device=flat_idx.device) - starts[flat_idx[order]]
+            copy = rank % counts
+        # dropped assignments keep pointing past the last expert
+        replica_idx = self.replica_table[expert_idx, copy]
+        replica_idx = replica_idx.masked_fill(flat_idx >= num_experts, num_experts + self.num_replicas)
+        return replica_idx.view_as(topk_idx)
+
+    def apply_capacity(self, scores, topk_idx, topk_weight):
+        """
+        Lets every expert admit at most `ceil(capacity_factor * num_tokens * top_k / n_routed_experts)` token-expert
+        assignments, highest gate weight first. With `overflow_policy="reroute"` an assignment over capacity moves to
+        the token's next-best expert outside its top-k if that one still has room. Assignments left over are dropped:
+        they get the out-of-range expert index `n_routed_experts` and weight 0, which [`DeepseekMoE`] skips. Runs on
+        device without host synchronization.
+        """
+        num_experts = self.n_routed_experts
+        capacity = math.ceil(self.capacity_factor * topk_idx.shape[0] * self.top_k / num_experts)
+        room = torch.full((num_experts + 1,), capacity, dtype=torch.long, device=topk_idx.device)
+        room[-1] = 0
+        dropped = ~self._admit(topk_idx, topk_weight, room)
+
+        num_spare = min(self.top_k, num_experts - self.top_k)
+        if self.overflow_policy == 'reroute' and num_spare > 0:
+            # the j-th overflowing assignment of a token falls back to its j-th best expert outside the top-k
+            spare_weight, spare_idx = torch.topk(scores.scatter(1, topk_idx, -1.0), k=num_spare, dim=-1)
+            if self.top_k > 1 and self.norm_topk_prob:
+                spare_weight = spare_weight / (scores.gather(1, topk_idx).sum(dim=-1, keepdim=True) + 1e-20)
+            ordinal = (dropped.cumsum(dim=1) - 1).clamp(0, num_spare - 1)
+            reroute_idx = spare_idx.gather(1, ordinal)
+            reroute_idx = reroute_idx.masked_fill(~dropped | (dropped.cumsum(dim=1) > num_spare), num_experts)
+            reroute_weight = spare_weight.gather(1, ordinal)
+            # what the admitted top-k assignments left over of each expert's capacity
+            load = torch.zeros_like(room).scatter_add_(
+                0, topk_idx.masked_fill(dropped, num_experts).view(-1), torch.ones_like(topk_idx).view(-1)
+            )
+            rerouted = self._admit(reroute_idx, reroute_weight, (room - load).clamp(min=0))
+            topk_idx = torch.where(rerouted, reroute_idx, topk_idx)
+            topk_weight = torch.where(rerouted, reroute_weight, topk_weight)
+            dropped = dropped & ~rerouted
+
+        self.dropped_assignments = dropped.sum()
+        self.dropped_tokens = dropped.all(dim=1).sum()
+        return topk_idx.masked_fill(dropped, num_experts), topk_weight.masked_fill(dropped, 0.0)
+
+    def _admit(self, topk_idx, topk_weight, room):
+        """
+        Returns the mask of the assignments that fit into `room[expert]`, admitting each expert's assignments by
+        descending weight. Index `n_routed_experts` marks padding and must have no room.
+        """
+        flat_idx = topk_idx.view(-1)
+        # a stable sort by expert of the weight-ordered assignments gives each expert's queue in priority order
+        order = topk_weight.view(-1).argsort(descending=True, stable=True)
+        order = order[flat_idx[order].argsort(stable=True)]
+        counts = flat_idx.bincount(minlength=self.n_routed_experts + 1)
+        starts = counts.cumsum(0) - counts
+        rank = torch.empty_like(flat_idx)
+        rank[order] = torch.arange(flat_idx.numel(), device=flat_idx.device) - starts[flat_idx[order]]
+        return (rank < room[flat_idx]).view_as(topk_idx)
+
 
 class AddAuxiliaryLoss(torch.autograd.Function):
     """
@@ -358,59 +1204,950 @@ class AddAuxiliaryLoss(torch.autograd.Function):
         return grad_output, grad_loss
     
     
+class RoutingRecorder:
+    """
+    Records the routing of every [`DeepseekMoE`] layer of a [`DeepseekModel`] into preallocated NumPy buffers: one row
+    per token holding its position id, the `(num_moe_layers, top_k)` selected experts as `uint8` and their gate weights
+    as `float16`. The buffers double when full. With `flush_dir`, the buffered rows are appended to a columnar trace in
+    that directory once `flush_tokens` of them are pending, and on `close()`: one raw `expert_ids.{layer_idx}.bin` and
+    `weights.{layer_idx}.bin` file of `(num_tokens, top_k)` per layer, `positions.bin`, `sample_offsets.npy` and a
+    `manifest.json` with shapes and dtypes, read back by `routing_trace.RoutingTrace`. Created by
+    `DeepseekModel.start_routing_trace()`.
+
+    Rows are appended per forward pass (`begin_step()`); call `new_sample()` before the forward passes of each sample
+    to record where it starts. `num_experts` counts every expert slot, the copies of replicated experts
+    (`config.expert_replicas`) included, so the traffic of a copy is recorded under its own id. Dropped assignments and
+    the rows of a layer that did not route (e.g. a skipped layer) get expert id `num_experts` and weight 0.
+
+    A non-empty `flush_dir` is refused unless `overwrite=True`, which then removes the files of a previous trace
+    there (and only those).
+    """
+
+    # the files of a trace in `flush_dir`
+    trace_files = ("manifest.json", "positions.bin", "sample_offsets.npy", "expert_ids.*.bin", "weights.*.bin")
+
+    def __init__(
+        self, layer_ids, top_k, num_experts, capacity = 4096, flush_dir = None, flush_tokens = 1 << 20, overwrite = False
+    ):
+        self.layer_ids = list(layer_ids)
+        self.top_k = top_k
+        self.num_experts = num_experts
+        self.flush_dir = flush_dir
+        self.flush_tokens = flush_tokens
+        self._columns = {layer_idx: column for column, layer_idx in enumerate(self.layer_ids)}
+        self._id_dtype = np.uint8 if num_experts < 256 else np.int16
+        self._expert_ids = np.empty((capacity, len(self.layer_ids), top_k), dtype=self._id_dtype)
+        self._weights = np.empty((capacity, len(self.layer_ids), top_k), dtype=np.float16)
+        self._positions = np.empty(capacity, dtype=np.int32)
+        self.num_tokens = 0
+        # rows already flushed to `flush_dir`, global token indices are offset by it
+        self.token_offset = 0
+        self.num_chunks = 0
+        self.sample_offsets = []
+        self._step = slice(0, 0)
+        if flush_dir is not None:
+            os.makedirs(flush_dir, exist_ok=True)
+            if os.listdir(flush_dir) and not overwrite:
+                raise ValueError(f"{flush_dir} is not empty, pass `overwrite=True` to replace the routing trace in it")
+            # the columns are appended to, start from an empty trace
+            for pattern in self.trace_files:
+                for path in glob.glob(os.path.join(flush_dir, pattern)):
+                    os.remove(path)
+
+    @property
+    def expert_ids(self):
+        return self._expert_ids[:self.num_tokens]
+
+    @property
+    def weights(self):
+        return self._weights[:self.num_tokens]
+
+    @property
+    def positions(self):
+        return self._positions[:self.num_tokens]
+
+    def _reserve(self, num_tokens):
+        capacity = len(self._positions)
+        if self.num_tokens + num_tokens <= capacity:
+            return
+        capacity = max(2 * capacity, self.num_tokens + num_tokens)
+        for name in ("_expert_ids", "_weights", "_positions"):
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.num_tokens] = old[:self.num_tokens]
+            setattr(self, name, new)
+
+    def new_sample(self):
+        self.sample_offsets.append(self.token_offset + self.num_tokens)
+
+    def begin_step(self, position_ids):
+        """Appends the rows of one forward pass, `position_ids` of shape `(batch_size, seq_length)`."""
+        if self.flush_dir is not None and self.num_tokens >= self.flush_tokens:
+            self.flush()
+        position_ids = position_ids.reshape(-1)
+        start = self.num_tokens
+        self._reserve(len(position_ids))
+        self.num_tokens += len(position_ids)
+        self._step = slice(start, self.num_tokens)
+        self._positions[self._step] = position_ids.to("cpu", torch.int32).numpy()
+        self._expert_ids[self._step] = self.num_experts
+        self._weights[self._step] = 0
+
+    def record(self, layer_idx, topk_idx, topk_weight, num_slots = None):
+        """
+        Fills the current step's rows for one layer from the `(num_tokens, top_k)` outputs of its gate. Expert ids
+        from `num_slots` on (the layer's marker of dropped assignments) are stored as `num_experts`.
+        """
+        if num_slots is not None:
+            if num_slots > self.num_experts:
+                raise ValueError(
+                    f"layer {layer_idx} has {num_slots} expert slots but the trace records {self.num_experts}, "
+                    "start the trace after replicating experts"
+                )
+            topk_idx = topk_idx.masked_fill(topk_idx >= num_slots, self.num_experts)
+        column = self._columns[layer_idx]
+        self._expert_ids[self._step, column] = topk_idx.detach().to(torch.int16).cpu().numpy()
+        self._weights[self._step, column] = topk_weight.detach().to(torch.float16).cpu().numpy()
+
+    def sample(self, sample_idx):
+        """
+        The `(expert_ids, weights)` of a buffered sample, each of shape `(num_moe_layers, num_tokens, top_k)`, the
+        layout of the per-sample routing traces of `eval_raw/eval_raw_model.py`.
+        """
+        offsets = self.sample_offsets + [self.token_offset + self.num_tokens]
+        start, end = offsets[sample_idx] - self.token_offset, offsets[sample_idx + 1] - self.token_offset
+        if start < 0:
+            raise ValueError(f"sample {sample_idx} has already been flushed to {self.flush_dir}")
+        return self._expert_ids[start:end].transpose(1, 0, 2), self._weights[start:end].transpose(1, 0, 2)
+
+    def flush(self):
+        """Appends the buffered rows to the columnar trace in `flush_dir` and empties the buffers."""
+        columns = {"positions.bin": self.positions}
+        for column, layer_idx in enumerate(self.layer_ids):
+            columns[f"expert_ids.{layer_idx}.bin"] = self.expert_ids[:, column]
+            columns[f"weights.{layer_idx}.bin"] = self.weights[:, column]
+        for name, values in columns.items():
+            with open(os.path.join(self.flush_dir, name), "ab") as f:
+                np.ascontiguousarray(values).tofile(f)
+        self.token_offset += self.num_tokens
+        self.num_tokens = 0
+        self._step = slice(0, 0)
+        self._write_manifest()
+
+    def _write_manifest(self):
+        manifest = {
+            "layer_ids": self.layer_ids,
+            "top_k": self.top_k,
+            "num_experts": self.num_experts,
+            "num_tokens": self.token_offset,
+            "expert_ids_dtype": np.dtype(self._id_dtype).name,
+            "weights_dtype": "float16",
+            "positions_dtype": "int32",
+        }
+        with open(os.path.join(self.flush_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=4)
+
+    def close(self):
+        if self.flush_dir is not None:
+            self.flush()
+            np.save(os.path.join(self.flush_dir, "sample_offsets.npy"), np.asarray(self.sample_offsets, dtype=np.int64))
+
+
 class DeepseekMoE(nn.Module):
     """
     A mixed expert module containing shared experts.
     """
-    def __init__(self, config):
+    def __init__(self, config, layer_idx = None):
         super().__init__()
         self.config = config
+        self.layer_idx = layer_idx
         self.num_experts_per_tok = config.num_experts_per_tok
-        self.experts = nn.ModuleList([DeepseekMLP(config, intermediate_size = config.moe_intermediate_size) for i in range(config.n_routed_experts)])
+        self.routing_recorder = None
+        self.skip_routed_experts = False
         self.gate = MoEGate(config)
+        # the expert every extra copy (`config.expert_replicas`) replicates, by copy index from `n_routed_experts` on
+        self.replica_sources = self.gate.set_replicas((config.expert_replicas or {}).get(layer_idx, {}))
+        num_experts = config.n_routed_experts + len(self.replica_sources)
+        if config.moe_offload_dir is not None:
+            if self.replica_sources:
+                raise ValueError("`expert_replicas` cannot be combined with `moe_offload_dir`")
+            self.experts = DeepseekOffloadedExperts(config, config.n_routed_experts, layer_idx)
+        elif config.moe_expert_parallel:
+            if not torch.distributed.is_initialized():
+                raise ValueError("`moe_expert_parallel` requires an initialized `torch.distributed` process group")
+            self.experts = DeepseekShardedExperts(config, num_experts)
+        elif config.moe_grouped_gemm or config.moe_static_routing:
+            self.experts = DeepseekGroupedExperts(config, num_experts, intermediate_size = config.moe_intermediate_size)
+        else:
+            self.experts = nn.ModuleList([DeepseekMLP(config, intermediate_size = config.moe_intermediate_size) for i in range(num_experts)])
         if config.n_shared_experts is not None:
             intermediate_size = config.moe_intermediate_size * config.n_shared_experts
             self.shared_experts = DeepseekMLP(config=config, intermediate_size = intermediate_size)
+
+        # quantized and pruned experts of a saved variant, their buffers are loaded from the checkpoint as they are
+        precisions = (config.expert_precisions or {}).get(layer_idx, {})
+        if any(precision != "bf16" for precision in precisions.values()):
+            if not isinstance(self.experts, nn.ModuleList):
+                raise ValueError("`expert_precisions` requires an `nn.ModuleList` of routed experts")
+            for expert_idx, precision in precisions.items():
+                if precision in ("int8", "int4"):
+                    self.experts[expert_idx].quantize(int(precision[3:]), config.expert_quant_group_size, empty=True)
+            pruned = [expert_idx for expert_idx, precision in precisions.items() if precision == "pruned"]
+            if pruned:
+                self.prune_experts(pruned)
+
+        self._register_state_dict_hook(self._drop_replica_state_dict)
+        self._register_load_state_dict_pre_hook(self._copy_replica_state_dict)
+
+    def _replica_prefixes(self, prefix):
+        for replica_idx, expert_idx in enumerate(self.replica_sources, start=self.config.n_routed_experts):
+            # a copy at another precision than its expert has weights of its own
+            if isinstance(self.experts, nn.ModuleList) and (
+                _expert_precision(self.experts[replica_idx]) != _expert_precision(self.experts[expert_idx])
+            ):
+                continue
+            yield f"{prefix}experts.{replica_idx}.", f"{prefix}experts.{expert_idx}."
+
+    @staticmethod
+    def _drop_replica_state_dict(module, state_dict, prefix, local_metadata):
+        # the copies are rebuilt from their expert on load, checkpoints keep the `n_routed_experts` layout (plus the
+        # copies at another precision)
+        for replica_prefix, _ in module._replica_prefixes(prefix):
+            for key in [key for key in state_dict if key.startswith(replica_prefix)]:
+                del state_dict[key]
+        return state_dict
+
+    def _copy_replica_state_dict(self, state_dict, prefix, *args):
+        for replica_prefix, expert_prefix in self._replica_prefixes(prefix):
+            for key in [key for key in state_dict if key.startswith(expert_prefix)]:
+                # a copy of its own, `load_state_dict(..., assign=True)` would otherwise share the expert's storage
+                state_dict.setdefault(replica_prefix + key[len(expert_prefix):], state_dict[key].clone())
+
+    def _replica_copies(self):
+        """The extra copies of every replicated expert, `{expert_idx: [copy, ...]}`."""
+        copies = {}
+        for expert_idx, replica in zip(self.replica_sources, list(self.experts)[self.config.n_routed_experts:]):
+            copies.setdefault(expert_idx, []).append(replica)
+        return copies
+
+    def _set_replicas(self, experts, replicas, copies):
+        # copies still wanted are reused and the others released before any new one is made, one expert at a time
+        self.replica_sources = self.gate.set_replicas(replicas)
+        reused = [copies[expert_idx].pop() if copies.get(expert_idx) else None for expert_idx in self.replica_sources]
+        copies.clear()
+        self.experts = nn.ModuleList(experts)
+        for expert_idx, replica in zip(self.replica_sources, reused):
+            self.experts.append(copy.deepcopy(experts[expert_idx]) if replica is None else replica)
+
+    def replicate_experts(self, replicas):
+        """
+        Sets the copies of already loaded routed experts in place, `replicas` mapping expert indices to their number of
+        extra copies as in `config.expert_replicas`. Copies that are still wanted are kept, the others freed, and new
+        ones are deep copies of their expert.
+        """
+        if not isinstance(self.experts, nn.ModuleList):
+            raise ValueError("only an `nn.ModuleList` of routed experts can be replicated")
+        self._set_replicas(list(self.experts)[:self.config.n_routed_experts], replicas, self._replica_copies())
+        return self
+
+    def replace_expert(self, expert_idx, expert, gate_weight = None):
+        """
+        Replaces the routed expert `expert_idx` in place, by a module (e.g. a [`DeepseekMLP`], moved to the gate's
+        device) or by a state dict copied into the current expert's tensors (new ones for a pruned expert). Its copies
+        are replaced as well, and a pruned expert is selected again. With `gate_weight`, the expert's row of the gate weight is overwritten too.
+        """
+        if not isinstance(self.experts, nn.ModuleList):
+            raise ValueError("only an `nn.ModuleList` of routed experts can be replaced")
+        if not 0 <= expert_idx < self.config.n_routed_experts:
+            raise ValueError(f"expert {expert_idx} is not a routed expert, copies follow the expert they replicate")
+        if isinstance(expert, dict):
+            if isinstance(self.experts[expert_idx], nn.Identity):
+                # a pruned expert has no tensors to copy into, build them at the state dict's precision first
+                self.experts[expert_idx] = DeepseekMLP(self.config, intermediate_size = self.config.moe_intermediate_size).to(
+                    device=self.gate.weight.device, dtype=self.gate.weight.dtype
+                )
+                if "up_proj.qweight" in expert:
+                    bits = 8 if expert["up_proj.qweight"].dtype == torch.int8 else 4
+                    in_features = {"gate_proj": self.config.hidden_size, "up_proj": self.config.hidden_size,
+                                   "down_proj": self.config.moe_intermediate_size}
+                    group_size = None
+                    if any(
+                        expert[f"{name}.scales"].shape[0] * DeepseekQuantLinear.resolve_group_size(None, bits, size) != size
+                        for name, size in in_features.items()
+                    ):
+                        group_size = self.config.hidden_size // expert["up_proj.scales"].shape[0]
+                    self.experts[expert_idx].quantize(bits, group_size, empty=True)
+            self.experts[expert_idx].load_state_dict(expert)
+            expert = self.experts[expert_idx]
+        else:
+            self.experts[expert_idx] = expert.to(self.gate.weight.device)
+        for replica_idx, source_idx in enumerate(self.replica_sources, start=self.config.n_routed_experts):
+            if source_idx == expert_idx:
+                self.experts[replica_idx] = copy.deepcopy(expert)
+        if gate_weight is not None:
+            with torch.no_grad():
+                self.gate.weight[expert_idx].copy_(gate_weight)
+        if self.gate.expert_mask is not None:
+            self.gate.expert_mask[expert_idx] = False
+        return self
+
+    def reorder_experts(self, order):
+        """
+        Permutes the routed experts in place, expert `i` becoming the former expert `order[i]`. The gate weight rows,
+        pruned experts and copies are permuted along, so the layer computes the same function; only the gate weight
+        is copied.
+        """
+        if not isinstance(self.experts, nn.ModuleList):
+            raise ValueError("only an `nn.ModuleList` of routed experts can be reordered")
+        order = [int(expert_idx) for expert_idx in order]
+        if sorted(order) != list(range(self.config.n_routed_experts)):
+            raise ValueError(f"{order} is not a permutation of the {self.config.n_routed_experts} routed experts")
+        position = {expert_idx: new_idx for new_idx, expert_idx in enumerate(order)}
+        index = torch.tensor(order, device=self.gate.weight.device)
+        with torch.no_grad():
+            self.gate.weight.copy_(self.gate.weight[index])
+        if self.gate.expert_mask is not None:
+            self.gate.expert_mask = self.gate.expert_mask[index]
+
+        copies = {position[expert_idx]: replicas for expert_idx, replicas in self._replica_copies().items()}
+        replicas = {expert_idx: len(replicas) for expert_idx, replicas in copies.items()}
+        experts = list(self.experts)
+        self._set_replicas([experts[expert_idx] for expert_idx in order], replicas, copies)
+        return self
+
+    def group_experts(self):
+        """
+        Converts an already loaded `nn.ModuleList` of routed experts to the stacked [`DeepseekGroupedExperts`] layout
+        in place, e.g. after `from_pretrained(..., device_map="auto")` which bypasses the state dict hooks.
+        """
+        if isinstance(self.experts, nn.ModuleList):
+            self.experts = DeepseekGroupedExperts.from_experts(self.experts)
+        return self
+
+    def shard_experts(self, group = None):
+        """
+        Converts an already loaded `nn.ModuleList` of routed experts to this rank's [`DeepseekShardedExperts`] shard in
+        place, freeing the other ranks' experts. Every rank of `group` must do the same.
+        """
+        if isinstance(self.experts, nn.ModuleList):
+            self.experts = DeepseekShardedExperts.from_experts(self.experts, group)
+        return self
+
+    def quantize_experts(self, expert_ids = None, bits = 8, group_size = None):
+        """Quantizes the routed experts `expert_ids` (all by default) in place, see [`DeepseekMLP.quantize`]."""
+        if not isinstance(self.experts, nn.ModuleList):
+            raise ValueError("only an `nn.ModuleList` of routed experts can be quantized")
+        for expert_idx in range(len(self.experts)) if expert_ids is None else expert_ids:
+            self.experts[expert_idx].quantize(bits, group_size)
+        return self
+
+    def prune_experts(self, expert_ids):
+        """
+        Removes the routed experts `expert_ids` in place: the gate no longer selects them and their weights are freed.
+        Ids past the gate's experts (extra copies of an expert) are only freed.
+        """
+        if not isinstance(self.experts, nn.ModuleList):
+            raise ValueError("only an `nn.ModuleList` of routed experts can be pruned")
+        # also called at construction, when the gate weight may still be on the meta device (`empty_parameters`)
+        device = self.gate.weight.device if self.gate.weight.device.type != "meta" else None
+        expert_mask = torch.zeros(self.gate.n_routed_experts, dtype=torch.bool, device=device)
+        if getattr(self.gate, "expert_mask", None) is not None:
+            expert_mask |= self.gate.expert_mask
+        expert_mask[[expert_idx for expert_idx in expert_ids if expert_idx < len(expert_mask)]] = True
+        if len(expert_mask) - int(expert_mask.sum()) < self.num_experts_per_tok:
+            raise ValueError(f"pruning {list(expert_ids)} leaves fewer than {self.num_experts_per_tok} routed experts")
+        self.gate.expert_mask = expert_mask
+        for expert_idx in expert_ids:
+            self.experts[expert_idx] = nn.Identity()
+        return self
     
-    def forward(self, hidden_states):
+    def forward(self, hidden_states, position_ids = None):
+        if self.skip_routed_experts:
+            # draft of self-speculative decoding, see `DeepseekModel.draft_mode`
+            if self.config.n_shared_experts is None:
+                return torch.zeros_like(hidden_states)
+            return self.shared_experts(hidden_states)
         identity = hidden_states
         orig_shape = hidden_states.shape
-        topk_idx, topk_weight, aux_loss = self.gate(hidden_states)
+        topk_idx, topk_weight, aux_loss = self.gate(hidden_states, position_ids)
+        if self.routing_recorder is not None:
+            self.routing_recorder.record(
+                self.layer_idx, topk_idx, topk_weight, num_slots=self.gate.n_routed_experts + self.gate.num_replicas
+            )
         hidden_states = hidden_states.view(-1, hidden_states.shape[-1])
         flat_topk_idx = topk_idx.view(-1)
-        if self.training:
-            hidden_states = hidden_states.repeat_interleave(self.num_experts_per_tok, dim=0)
-            y = torch.empty_like(hidden_states)
-            for i, expert in enumerate(self.experts):
-                y[flat_topk_idx == i] = expert(hidden_states[flat_topk_idx == i])
-            y = (y.view(*topk_weight.shape, -1) * topk_weight.unsqueeze(-1)).sum(dim=1)
-            y =  y.view(*orig_shape)
+        if isinstance(self.experts, DeepseekShardedExperts):
+            y = self.experts(hidden_states, flat_topk_idx, topk_weight.view(-1, 1)).view(*orig_shape)
+            if self.training:
+                y = AddAuxiliaryLoss.apply(y, aux_loss)
+        elif self.training and isinstance(self.experts, DeepseekGroupedExperts):
+            y = self.grouped_experts_forward(hidden_states, flat_topk_idx, topk_weight.view(-1, 1)).view(*orig_shape)
+            y = AddAuxiliaryLoss.apply(y, aux_loss)
+        elif self.training and isinstance(self.experts, nn.ModuleList):
+            y = self.sorted_experts_forward(hidden_states, flat_topk_idx, topk_weight.view(-1, 1)).view(*orig_shape)
             y = AddAuxiliaryLoss.apply(y, aux_loss)
+        elif self.training and isinstance(self.experts, DeepseekOffloadedExperts):
+            raise ValueError("`moe_offload_dir` serves frozen expert weights and cannot be used in training mode")
         else:
             y = self.moe_infer(hidden_states, flat_topk_idx, topk_weight.view(-1, 1)).view(*orig_shape)
         if self.config.n_shared_experts is not None:
             y = y + self.shared_experts(identity)
         return y
     
+    def sorted_experts_forward(self, x, flat_expert_indices, flat_expert_weights):
+        """
+        Differentiable dispatch for a `nn.ModuleList` of experts. The token copies are sorted by expert once, each
+        expert gathers its own tokens straight from `x` and its weighted output is summed back with `index_add_`, so
+        the activations are never replicated `num_experts_per_tok` times.
+        """
+        idxs = flat_expert_indices.argsort()
+        token_idxs = idxs // self.num_experts_per_tok
+        # the trailing slice holds the assignments dropped by the capacity limit, `zip` leaves it out
+        counts = flat_expert_indices.bincount(minlength=len(self.experts) + 1).tolist()
+        y = torch.zeros_like(x)
+        for expert, exp_token_idx, exp_idxs in zip(self.experts, token_idxs.split(counts), idxs.split(counts)):
+            # idle experts still run on an empty slice so that every parameter takes part in the backward pass,
+            # as DDP/DeepSpeed expect
+            expert_out = expert(x[exp_token_idx]) * flat_expert_weights[exp_idxs]
+            y.index_add_(0, exp_token_idx, expert_out)
+        return y
+
+    def grouped_experts_forward(self, x, flat_expert_indices, flat_expert_weights):
+        """
+        Runs the routed experts in the stacked layout. The token copies are sorted by expert once and laid out in a
+        `(num_active, capacity, hidden_size)` buffer, one row per active expert, for a single batched matmul per
+        projection over the active experts' stacked weights; the weighted outputs are summed back into their tokens
+        with a single `index_add_`. Small batches (at most `len(self.experts)` token-expert pairs, e.g. a decode step)
+        bound the buffer by the batch itself, so there is no host synchronization. On the devices of
+        `DeepseekGroupedExperts.per_expert_devices` (the CPU), and always for offloaded experts, the active experts run
+        one at a time on views of their weights instead, unless every expert is active.
+        """
+        num_experts = len(self.experts)
+        num_pairs = flat_expert_indices.numel()
+        # assignments dropped by the capacity limit carry expert index `num_experts`, sort last and weigh 0
+        tokens_per_expert = flat_expert_indices.bincount(minlength=num_experts + 1)
+        idxs = flat_expert_indices.argsort()
+        token_idxs = idxs // self.num_experts_per_tok
+        active = tokens_per_expert[:num_experts] > 0
+        batched = isinstance(self.experts, DeepseekGroupedExperts)
+        per_expert = not batched or x.device.type in self.experts.per_expert_devices
+        if not per_expert and num_pairs <= num_experts:
+            # at most `num_pairs` experts are active, none with more assignments than there are tokens: the spare
+            # rows hold idle experts and get no tokens
+            num_active, capacity, all_active = num_pairs, x.shape[0], False
+        else:
+            counts = tokens_per_expert.tolist()
+            num_active, capacity = sum(count > 0 for count in counts[:-1]), max(counts[:-1])
+            all_active = num_active == num_experts
+            if not batched or (per_expert and not all_active):
+                idxs, token_idxs = idxs[:num_pairs - counts[-1]], token_idxs[:num_pairs - counts[-1]]
+                expert_out = torch.cat(
+                    [
+                        self.experts.expert_forward(tokens, i)
+                        for i, tokens in enumerate(x[token_idxs].split(counts[:-1]))
+                        if counts[i] > 0
+                    ]
+                )
+                return torch.zeros_like(x).index_add_(0, token_idxs, expert_out * flat_expert_weights[idxs])
+
+        sorted_expert_indices = flat_expert_indices[idxs]
+        expert_starts = tokens_per_expert.cumsum(0) - tokens_per_expert
+        cols = torch.arange(num_pairs, device=x.device) - expert_starts[sorted_expert_indices]
+        slots = (active.cumsum(0) - 1)[sorted_expert_indices.clamp(max=num_experts - 1)]
+        # row of every assignment in the flattened buffer, the dropped ones all go to a spare last row
+        rows = (slots * capacity + cols).masked_fill(sorted_expert_indices == num_experts, num_active * capacity)
+        padded_tokens = x.new_zeros(num_active * capacity + 1, x.shape[-1]).index_copy(0, rows, x[token_idxs])
+        padded_tokens = padded_tokens[:-1].view(num_active, capacity, x.shape[-1])
+        if all_active:
+            # straight on the stacked weights, nothing to gather
+            expert_out = self.experts(padded_tokens)
+        else:
+            # the active experts first, in order
+            expert_ids = (~active).byte().argsort(stable=True)[:num_active]
+            expert_out = self.experts.gathered_forward(padded_tokens, expert_ids)
+        expert_out = expert_out.view(num_active * capacity, x.shape[-1])[rows.clamp(max=num_active * capacity - 1)]
+        return torch.zeros_like(x).index_add_(0, token_idxs, expert_out * flat_expert_weights[idxs])
+
+    def static_experts_forward(self, x, flat_expert_indices, flat_expert_weights):
+        """
+        Runs the routed experts with shapes that depend only on the number of tokens: every token-expert pair gathers
+        its expert's stacked weights and the pairs run as one batched matmul per projection. There is no host
+        synchronization and no data-dependent control flow, so the whole step can be captured by `torch.compile`.
+        The gathered weights grow with the number of pairs, hence this path only serves small batches.
+        """
+        expert_tokens = x.repeat_interleave(self.num_experts_per_tok, dim=0).unsqueeze(1)
+        # dropped assignments (index `len(self.experts)`, weight 0) borrow the last expert and contribute nothing
+        expert_ids = flat_expert_indices.clamp(max=len(self.experts) - 1)
+        expert_out = self.experts.gathered_forward(expert_tokens, expert_ids).squeeze(1) * flat_expert_weights
+        return expert_out.view(-1, self.num_experts_per_tok, x.shape[-1]).sum(dim=1)
+
     @torch.no_grad()
     def moe_infer(self, x, flat_expert_indices, flat_expert_weights):
+        if (
+            self.config.moe_static_routing
+            and isinstance(self.experts, DeepseekGroupedExperts)
+            and flat_expert_indices.numel() <= len(self.experts)
+        ):
+            # at most one expert's worth of weights gathered per expert in the layer
+            return self.static_experts_forward(x, flat_expert_indices, flat_expert_weights)
+        if not isinstance(self.experts, nn.ModuleList):
+            return self.grouped_experts_forward(x, flat_expert_indices, flat_expert_weights)
         expert_cache = torch.zeros_like(x)
         idxs = flat_expert_indices.argsort()
-        tokens_per_expert = flat_expert_indices.bincount().cpu().numpy().cumsum(0)
         token_idxs = idxs // self.num_experts_per_tok
-        for i, end_idx in enumerate(tokens_per_expert):
-            start_idx = 0 if i == 0 else tokens_per_expert[i-1]
-            if start_idx == end_idx:
+        # a single host read of the per-expert sizes splits the sorted buffer, the trailing slice holds the
+        # assignments dropped by the capacity limit
+        counts = flat_expert_indices.bincount(minlength=len(self.experts) + 1).tolist()
+        for expert, exp_token_idx, exp_idxs in zip(self.experts, token_idxs.split(counts), idxs.split(counts)):
+            if exp_idxs.numel() == 0:
                 continue
-            expert = self.experts[i]
-            exp_token_idx = token_idxs[start_idx:end_idx]
             expert_tokens = x[exp_token_idx]
             expert_out = expert(expert_tokens)
-            expert_out.mul_(flat_expert_weights[idxs[start_idx:end_idx]])
-            expert_cache.scatter_reduce_(0, exp_token_idx.view(-1, 1).repeat(1, x.shape[-1]), expert_out, reduce='sum')
+            expert_out.mul_(flat_expert_weights[exp_idxs])
+            expert_cache.index_add_(0, exp_token_idx, expert_out)
         return expert_cache
 
 
+class DeepseekStaticCache(Cache):
+    """
+    KV cache preallocated per layer as `(max_batch_size, num_key_value_heads, max_cache_len, head_dim)` tensors, with
+    `max_cache_len` defaulting to `config.max_position_embeddings`. New keys and values are written in place into the
+    next free slots and attention runs over views of the filled prefix, so decoding never reallocates the cache. Pass
+    it as `past_key_values`, or let `generate(..., cache_implementation="static")` size one to `max_length`.
+
+    Parameters:
+        config ([`DeepseekConfig`]): the model configuration.
+        max_batch_size (`int`): the largest batch the cache will hold.
+        max_cache_len (`int`, *optional*): the longest sequence (prompt and generated tokens) the cache will hold.
+        device (`torch.device` or a list with one per layer, *optional*): where the cache of each layer lives.
+        dtype (`torch.dtype`, *optional*): the dtype of the cached states.
+    """
+
+    def __init__(self, config, max_batch_size, max_cache_len = None, device = None, dtype = None):
+        super().__init__()
+        self.max_batch_size = max_batch_size
+        self.max_cache_len = config.max_position_embeddings if max_cache_len is None else max_cache_len
+        head_dim = config.hidden_size // config.num_attention_heads
+        # a tensor-parallel rank caches its own heads
+        num_key_value_heads = config.num_key_value_heads // _tensor_parallel_world(config)[1]
+        cache_shape = (max_batch_size, num_key_value_heads, self.max_cache_len, head_dim)
+        devices = device if isinstance(device, (list, tuple)) else [device] * config.num_hidden_layers
+        self.key_cache = [torch.zeros(cache_shape, dtype=dtype, device=device) for device in devices]
+        self.value_cache = [torch.zeros(cache_shape, dtype=dtype, device=device) for device in devices]
+        self._lengths = [0] * config.num_hidden_layers
+        self._seen_tokens = 0
+
+    def __len__(self):
+        return len(self.key_cache)
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs = None):
+        start = self._lengths[layer_idx]
+        end = start + key_states.shape[-2]
+        if end > self.max_cache_len:
+            raise ValueError(f"DeepseekStaticCache holds {self.max_cache_len} tokens, {end} were requested")
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+        bsz = key_states.shape[0]
+        self.key_cache[layer_idx][:bsz, :, start:end] = key_states
+        self.value_cache[layer_idx][:bsz, :, start:end] = value_states
+        self._lengths[layer_idx] = end
+        return self.key_cache[layer_idx][:bsz, :, :end], self.value_cache[layer_idx][:bsz, :, :end]
+
+    def get_seq_length(self, layer_idx = 0):
+        return self._lengths[layer_idx]
+
+    def get_max_length(self):
+        # the cache never evicts, running out of slots is an error in `update` rather than a sliding window
+        return None
+
+    def reset(self):
+        """Empties the cache without releasing its memory."""
+        self._lengths = [0] * len(self._lengths)
+        self._seen_tokens = 0
+
+    def crop(self, max_length):
+        """Drops every cached position from `max_length` on."""
+        self._lengths = [min(length, max_length) for length in self._lengths]
+        self._seen_tokens = min(self._seen_tokens, max_length)
+
+    def reorder_cache(self, beam_idx):
+        """Reorders the cache for beam search, given the selected beam indices."""
+        for cache in self.key_cache + self.value_cache:
+            cache[: len(beam_idx)] = cache.index_select(0, beam_idx.to(cache.device))
+
+
+class DeepseekQuantizedCache(Cache):
+    """
+    KV cache stored in int8. The cached positions of each layer are grouped into blocks of `block_size` tokens and
+    every (sequence, head, block) is quantized symmetrically with its own fp32 scale, `absmax / 127`; keys also get one
+    scale per channel within the block, as a few key channels carry much larger magnitudes than the rest. The newest,
+    incomplete block stays in the model dtype until it fills up, so a block is quantized once and its scales never
+    change. The int8 blocks and their scales live in preallocated per-layer storage, sized for `max_length` tokens or
+    grown geometrically, so appending a block does not copy the cache.
+
+    [`DeepseekAttention`] and [`DeepseekSdpaAttention`] read the cache through `attend`, which dequantizes
+    `read_blocks` blocks at a time inside the attention computation, so the cached keys and values are never
+    materialized in the model dtype. `update`, used by the other attention implementations, returns them dequantized.
+
+    Holds about half the memory of a bf16 cache. Pass it as `past_key_values`, or set `config.kv_cache_dtype = "int8"`
+    to have `generate` use one.
+    """
+
+    def __init__(self, block_size = 64, max_length = None, read_blocks = 16):
+        super().__init__()
+        self.block_size = block_size
+        self.max_length = max_length
+        self.read_blocks = read_blocks
+        # int8 storage of the quantized blocks, the first `num_quantized[layer_idx]` positions hold tokens
+        self.key_cache = []
+        self.value_cache = []
+        self.key_scales = []
+        self.value_scales = []
+        self.key_residual = []
+        self.value_residual = []
+        self.num_quantized = []
+        self._seen_tokens = 0
+
+    def __len__(self):
+        return len(self.key_cache)
+
+    def _quantize(self, states, per_channel):
+        bsz, num_heads, seq_len, head_dim = states.shape
+        blocks = states.float().view(bsz, num_heads, seq_len // self.block_size, self.block_size, head_dim)
+        dims = -2 if per_channel else (-2, -1)
+        scales = blocks.abs().amax(dim=dims, keepdim=True).clamp(min=1e-8) / 127
+        quantized = (blocks / scales).round_().clamp_(-127, 127).to(torch.int8)
+        return quantized.view(bsz, num_heads, seq_len, head_dim), scales
+
+    def _dequantize(self, quantized, scales, dtype):
+        bsz, num_heads, seq_len, head_dim = quantized.shape
+        blocks = quantized.view(bsz, num_heads, seq_len // self.block_size, self.block_size, head_dim)
+        return (blocks * scales).to(dtype).view(bsz, num_heads, seq_len, head_dim)
+
+    @staticmethod
+    def _grow(tensor, dim, size):
+        """`tensor` with room for `size` entries along `dim`, reallocated to at least twice its size if full."""
+        if tensor.shape[dim] >= size:
+            return tensor
+        shape = list(tensor.shape)
+        shape[dim] = max(size, 2 * shape[dim])
+        grown = torch.empty(shape, dtype=tensor.dtype, device=tensor.device)
+        grown.narrow(dim, 0, tensor.shape[dim]).copy_(tensor)
+        return grown
+
+    def _append(self, key_states, value_states, layer_idx):
+        """Adds the new keys and values of a layer, quantizing the blocks they complete."""
+        if layer_idx == 0:
+            self._seen_tokens += key_states.shape[-2]
+        if len(self.key_cache) <= layer_idx:
+            bsz, num_heads, _, head_dim = key_states.shape
+            num_blocks = 0 if self.max_length is None else -(-self.max_length // self.block_size)
+            storage = dict(dtype=torch.int8, device=key_states.device)
+            self.key_cache.append(torch.empty(bsz, num_heads, num_blocks * self.block_size, head_dim, **storage))
+            self.value_cache.append(torch.empty(bsz, num_heads, num_blocks * self.block_size, head_dim, **storage))
+            self.key_scales.append(torch.empty(bsz, num_heads, num_blocks, 1, head_dim, device=key_states.device))
+            self.value_scales.append(torch.empty(bsz, num_heads, num_blocks, 1, 1, device=key_states.device))
+            self.key_residual.append(key_states[..., :0, :])
+            self.value_residual.append(value_states[..., :0, :])
+            self.num_quantized.append(0)
+
+        start = self.num_quantized[layer_idx]
+        for new_states, cache, scales, residual, per_channel in (
+            (key_states, self.key_cache, self.key_scales, self.key_residual, True),
+            (value_states, self.value_cache, self.value_scales, self.value_residual, False),
+        ):
+            residual[layer_idx] = torch.cat([residual[layer_idx], new_states], dim=-2)
+            num_new = residual[layer_idx].shape[-2] // self.block_size * self.block_size
+            if num_new:
+                end = start + num_new
+                cache[layer_idx] = self._grow(cache[layer_idx], 2, end)
+                scales[layer_idx] = self._grow(scales[layer_idx], 2, end // self.block_size)
+                quantized, block_scales = self._quantize(residual[layer_idx][..., :num_new, :], per_channel)
+                cache[layer_idx][:, :, start:end] = quantized
+                scales[layer_idx][:, :, start // self.block_size:end // self.block_size] = block_scales
+                residual[layer_idx] = residual[layer_idx][..., num_new:, :]
+        self.num_quantized[layer_idx] = start + num_new
+
+    def _read(self, cache, scales, layer_idx, start, end, dtype):
+        """Dequantized positions `[start, end)` of the quantized blocks of a layer, on block boundaries."""
+        block_scales = scales[layer_idx][:, :, start // self.block_size:end // self.block_size]
+        return self._dequantize(cache[layer_idx][:, :, start:end], block_scales, dtype)
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs = None):
+        self._append(key_states, value_states, layer_idx)
+        num_quantized = self.num_quantized[layer_idx]
+        keys = self._read(self.key_cache, self.key_scales, layer_idx, 0, num_quantized, key_states.dtype)
+        values = self._read(self.value_cache, self.value_scales, layer_idx, 0, num_quantized, value_states.dtype)
+        return (
+            torch.cat([keys, self.key_residual[layer_idx]], dim=-2),
+            torch.cat([values, self.value_residual[layer_idx]], dim=-2),
+        )
+
+    def attend(self, query_states, key_states, value_states, layer_idx, attention_mask = None, is_causal = False):
+        """
+        Appends the new keys and values of a layer as `update` does, and returns the attention output
+        `(bsz, num_heads, q_len, head_dim)` of `query_states` over all of its cached tokens. `attention_mask` is the
+        additive `(bsz, 1, q_len, kv_len)` mask of the eager attention; without one, `is_causal` masks the future of
+        every query.
+
+        Decoding steps (fewer than `block_size` queries) read the int8 blocks `read_blocks` at a time and only cast
+        them: the per-channel key scales of a block are folded into the queries and the value scales into the
+        attention probabilities, so the cache is never dequantized in full. Longer inputs, e.g. a prefill, attend to
+        their own keys and values before quantization, and to the cached past dequantized once for all their queries,
+        with `scaled_dot_product_attention`.
+        """
+        bsz, num_heads, q_len, head_dim = query_states.shape
+        if q_len >= self.block_size:
+            # the new keys and values are attended to as they are, only the cached past is read back from int8
+            keys, values = key_states, value_states
+            if len(self.key_cache) > layer_idx:
+                num_quantized = self.num_quantized[layer_idx]
+                keys, values = (
+                    torch.cat(
+                        [self._read(cache, scales, layer_idx, 0, num_quantized, states.dtype), residual[layer_idx], states],
+                        dim=-2,
+                    )
+                    for cache, scales, residual, states in (
+                        (self.key_cache, self.key_scales, self.key_residual, key_states),
+                        (self.value_cache, self.value_scales, self.value_residual, value_states),
+                    )
+                )
+            self._append(key_states, value_states, layer_idx)
+            groups = num_heads // keys.shape[1]
+            kv_len = keys.shape[-2]
+            if attention_mask is None and is_causal:
+                attention_mask = torch.ones(q_len, kv_len, dtype=torch.bool, device=query_states.device).tril(kv_len - q_len)
+            return F.scaled_dot_product_attention(
+                query_states, repeat_kv(keys, groups), repeat_kv(values, groups), attn_mask=attention_mask
+            )
+
+        self._append(key_states, value_states, layer_idx)
+        num_key_value_heads = self.key_cache[layer_idx].shape[1]
+        groups = num_heads // num_key_value_heads
+        num_quantized = self.num_quantized[layer_idx]
+        kv_len = num_quantized + self.key_residual[layer_idx].shape[-2]
+        if attention_mask is None and is_causal and q_len > 1:
+            attention_mask = torch.ones(q_len, kv_len, dtype=torch.bool, device=query_states.device).tril(kv_len - q_len)
+
+        block_size = self.block_size
+        chunks = [
+            (start, min(start + self.read_blocks * block_size, num_quantized))
+            for start in range(0, num_quantized, self.read_blocks * block_size)
+        ]
+        # the query heads sharing a key/value head attend together, as `repeat_kv` pairs them
+        query = query_states.float().reshape(bsz, num_key_value_heads, 1, groups * q_len, head_dim) / math.sqrt(head_dim)
+
+        scores = []
+        for start, end in chunks:
+            num_blocks = (end - start) // block_size
+            keys = self.key_cache[layer_idx][:, :, start:end].view(bsz, num_key_value_heads, num_blocks, block_size, head_dim)
+            block_queries = query * self.key_scales[layer_idx][:, :, start // block_size:end // block_size]
+            block_scores = block_queries @ keys.float().transpose(-1, -2)
+            scores.append(block_scores.transpose(2, 3).reshape(bsz, num_key_value_heads, groups * q_len, end - start))
+        scores.append(query.squeeze(2) @ self.key_residual[layer_idx].float().transpose(-1, -2))
+        scores = torch.cat(scores, dim=-1).view(bsz, num_key_value_heads, groups, q_len, kv_len)
+        if attention_mask is not None and attention_mask.dtype == torch.bool:
+            scores = scores.masked_fill(~attention_mask, torch.finfo(scores.dtype).min)
+        elif attention_mask is not None:
+            scores = scores + attention_mask.unsqueeze(2)
+        probs = scores.softmax(dim=-1).view(bsz, num_key_value_heads, groups * q_len, kv_len)
+
+        output = probs[..., num_quantized:] @ self.value_residual[layer_idx].float()
+        for start, end in chunks:
+            num_blocks = (end - start) // block_size
+            block_probs = probs[..., start:end].reshape(bsz, num_key_value_heads, groups * q_len, num_blocks, block_size)
+            block_probs = block_probs.transpose(2, 3) * self.value_scales[layer_idx][:, :, start // block_size:end // block_size]
+            values = self.value_cache[layer_idx][:, :, start:end].view(bsz, num_key_value_heads, num_blocks, block_size, head_dim)
+            output += (block_probs @ values.float()).sum(dim=2)
+        return output.view(bsz, num_heads, q_len, head_dim).to(query_states.dtype)
+
+    def get_seq_length(self, layer_idx = 0):
+        if len(self.key_cache) <= layer_idx:
+            return 0
+        return self.num_quantized[layer_idx] + self.key_residual[layer_idx].shape[-2]
+
+    def get_max_length(self):
+        return None
+
+    def nbytes(self):
+        """Bytes held by the cache: the int8 storage, its scales and the unquantized tail."""
+        tensors = self.key_cache + self.value_cache + self.key_scales + self.value_scales
+        tensors += self.key_residual + self.value_residual
+        return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+    def reorder_cache(self, beam_idx):
+        """Reorders the cache for beam search, given the selected beam indices."""
+        for tensors in (
+            self.key_cache, self.value_cache, self.key_scales, self.value_scales, self.key_residual, self.value_residual
+        ):
+            for layer_idx, tensor in enumerate(tensors):
+                tensors[layer_idx] = tensor.index_select(0, beam_idx.to(tensor.device))
+
+
+class DeepseekPagedCache(Cache):
+    """
+    KV cache for many concurrent sequences of different lengths, kept in a global pool of fixed-size blocks: per layer
+    `(num_blocks, block_size, num_key_value_heads, head_dim)` keys and values. Every sequence owns a block table, the
+    list of its blocks in order; blocks come from and go back to a free list in O(1), so memory is only held for
+    tokens actually cached (at most `block_size - 1` slots of waste per sequence).
+
+    Each forward pass is planned by `begin_step(seq_ids, num_new_tokens)`: row `b` of the batch belongs to
+    `seq_ids[b]` and adds `num_new_tokens[b]` tokens, right-padded to the longest row. In `update` the valid new keys
+    and values are written into their blocks and the cached tokens of every row are gathered through the block tables,
+    left-padded to the longest row, in front of the new ones. `begin_step` returns the matching 2D `attention_mask` and
+    `position_ids` for the model.
+    """
+
+    def __init__(self, config, num_blocks, block_size = 16, device = None, dtype = None):
+        super().__init__()
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.num_key_value_heads = config.num_key_value_heads // _tensor_parallel_world(config)[1]
+        self.head_dim = config.hidden_size // config.num_attention_heads
+        block_shape = (num_blocks, block_size, self.num_key_value_heads, self.head_dim)
+        devices = device if isinstance(device, (list, tuple)) else [device] * config.num_hidden_layers
+        self.key_blocks = [torch.zeros(block_shape, dtype=dtype, device=device) for device in devices]
+        self.value_blocks = [torch.zeros(block_shape, dtype=dtype, device=device) for device in devices]
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+        self.block_refs = [0] * num_blocks
+        self.block_tables = {}
+        self.seq_lens = {}
+        self._max_past = 0
+        self._seen_tokens = 0
+
+    def __len__(self):
+        return len(self.key_blocks)
+
+    @property
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    @property
+    def block_bytes(self):
+        """Bytes of keys and values one block holds over all layers."""
+        return 2 * len(self) * self.key_blocks[0][0].numel() * self.key_blocks[0].element_size()
+
+    def blocks_needed(self, seq_id, num_new_tokens):
+        """How many more blocks `seq_id` needs to append `num_new_tokens` tokens."""
+        total = self.seq_lens.get(seq_id, 0) + num_new_tokens
+        return max(-(-total // self.block_size) - len(self.block_tables.get(seq_id, ())), 0)
+
+    def add_sequence(self, seq_id, prefix_blocks = ()):
+        """
+        Starts a sequence, optionally on top of full blocks already holding the keys and values of its first
+        `len(prefix_blocks) * block_size` tokens (e.g. of another sequence with the same prefix). Blocks are reference
+        counted, so shared blocks stay allocated as long as any sequence uses them; being full, they are never written.
+        """
+        for block in prefix_blocks:
+            self.acquire_block(block)
+        self.block_tables[seq_id] = list(prefix_blocks)
+        self.seq_lens[seq_id] = len(prefix_blocks) * self.block_size
+
+    def free_sequence(self, seq_id):
+        """Releases the blocks of `seq_id`, the ones no other sequence uses go back to the free list."""
+        for block in reversed(self.block_tables.pop(seq_id)):
+            self.release_block(block)
+        del self.seq_lens[seq_id]
+
+    def acquire_block(self, block):
+        self.block_refs[block] += 1
+
+    def release_block(self, block):
+        self.block_refs[block] -= 1
+        if self.block_refs[block] == 0:
+            self.free_blocks.append(block)
+
+    def _allocate_block(self):
+        if not self.free_blocks:
+            raise RuntimeError("DeepseekPagedCache is out of blocks")
+        block = self.free_blocks.pop()
+        self.block_refs[block] = 1
+        return block
+
+    def _slots(self, seq_id, start, end):
+        """Pool slot of every token position in `[start, end)` of a sequence."""
+        positions = torch.arange(start, end)
+        table = torch.tensor(self.block_tables[seq_id], dtype=torch.long)
+        return table[positions // self.block_size] * self.block_size + positions % self.block_size
+
+    def begin_step(self, seq_ids, num_new_tokens, packed = False):
+        """
+        Plans the next forward pass: allocates the blocks the new tokens need and precomputes the slots every layer
+        writes and gathers. Returns the `(attention_mask, position_ids)` of the step.
+
+        With `packed=True` the new tokens of all sequences are concatenated into a single row without any padding
+        (e.g. the prefill chunks and decode tokens of a continuous batch), and so are their cached tokens. The attention
+        mask is then a 4D `(1, 1, num_new, num_cached + num_new)` mask that keeps the sequences apart.
+        """
+        past_lens = [self.seq_lens[seq_id] for seq_id in seq_ids]
+        past_slots, write_slots = [], []
+        for seq_id, past_len, num_new in zip(seq_ids, past_lens, num_new_tokens):
+            for _ in range(self.blocks_needed(seq_id, num_new)):
+                self.block_tables[seq_id].append(self._allocate_block())
+            past_slots.append(self._slots(seq_id, 0, past_len))
+            write_slots.append(self._slots(seq_id, past_len, past_len + num_new))
+            self.seq_lens[seq_id] = past_len + num_new
+
+        if packed:
+            total_past, total_new = sum(past_lens), sum(num_new_tokens)
+            gather_slots = torch.cat(past_slots).unsqueeze(0)
+            write_rows = torch.arange(total_new)
+            attention_mask = torch.zeros(1, 1, total_new, total_past + total_new, dtype=self.key_blocks[0].dtype)
+            past_start = new_start = 0
+            for past_len, num_new in zip(past_lens, num_new_tokens):
+                rows = slice(new_start, new_start + num_new)
+                attention_mask[0, 0, rows, past_start:past_start + past_len] = 1
+                attention_mask[0, 0, rows, total_past + new_start:total_past + new_start + num_new] = torch.ones(
+                    num_new, num_new
+                ).tril()
+                past_start += past_len
+                new_start += num_new
+            position_ids = torch.cat(
+                [torch.arange(past_len, past_len + num_new) for past_len, num_new in zip(past_lens, num_new_tokens)]
+            ).unsqueeze(0)
+            self._max_past = total_past
+            self._seen_tokens += total_new
+        else:
+            max_past, max_new = max(past_lens), max(num_new_tokens)
+            gather_slots = torch.zeros(len(seq_ids), max_past, dtype=torch.long)
+            attention_mask = torch.zeros(len(seq_ids), max_past + max_new, dtype=torch.long)
+            write_rows = []
+            for row, (slots, past_len, num_new) in enumerate(zip(past_slots, past_lens, num_new_tokens)):
+                gather_slots[row, max_past - past_len:] = slots
+                write_rows.append(torch.arange(num_new) + row * max_new)
+                attention_mask[row, max_past - past_len:max_past + num_new] = 1
+            write_rows = torch.cat(write_rows)
+            position_ids = torch.tensor(past_lens).unsqueeze(1) + torch.arange(max_new)
+            self._max_past = max_past
+            self._seen_tokens += max_new
+
+        device = self.key_blocks[0].device
+        self._gather_slots = gather_slots.to(device)
+        self._write_slots = torch.cat(write_slots).to(device)
+        self._write_rows = write_rows.to(device)
+        return attention_mask.to(device), position_ids.to(device)
+
+    def update(self, key_states, value_states, layer_idx, cache_kwargs = None):
+        bsz, num_heads, q_len, head_dim = key_states.shape
+        states = []
+        for new_states, blocks in ((key_states, self.key_blocks[layer_idx]), (value_states, self.value_blocks[layer_idx])):
+            pool = blocks.view(-1, num_heads, head_dim)
+            gather_slots, write_slots, write_rows = (
+                slots.to(pool.device) for slots in (self._gather_slots, self._write_slots, self._write_rows)
+            )
+            new_tokens = new_states.transpose(1, 2).reshape(bsz * q_len, num_heads, head_dim)
+            pool.index_copy_(0, write_slots, new_tokens.index_select(0, write_rows).to(pool.dtype))
+            cached = pool[gather_slots].transpose(1, 2).to(new_states.dtype)
+            states.append(torch.cat([cached, new_states], dim=2))
+        return tuple(states)
+
+    def get_seq_length(self, layer_idx = 0):
+        return self._max_past
+
+    def get_max_length(self):
+        return None
+
+
 # Copied from transformers.models.llama.modeling_llama.repeat_kv
 def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
     """
@@ -455,12 +2192,34 @@ class DeepseekAttention(nn.Module):
                 f" and `num_heads`: {self.num_heads})."
             )
 
+        # tensor parallelism: each rank runs its share of the heads (q/k/v column-parallel, o_proj row-parallel), the
+        # decoder layer sums the `o_proj` outputs over the ranks
+        self.tp_rank, self.tp_size = _tensor_parallel_world(config)
+        if self.num_key_value_heads % self.tp_size:
+            raise ValueError(
+                f"num_key_value_heads ({self.num_key_value_heads}) must be divisible by the tensor-parallel size ({self.tp_size})"
+            )
+        self.num_heads //= self.tp_size
+        self.num_key_value_heads //= self.tp_size
+        if self.tp_size > 1:
+            self._register_load_state_dict_pre_hook(self._shard_state_dict)
+
         self.q_proj = nn.Linear(self.hidden_size, self.num_heads * self.head_dim, bias=config.attention_bias)
         self.k_proj = nn.Linear(self.hidden_size, self.num_key_value_heads * self.head_dim, bias=config.attention_bias)
         self.v_proj = nn.Linear(self.hidden_size, self.num_key_value_heads * self.head_dim, bias=config.attention_bias)
         self.o_proj = nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=config.attention_bias)
         self._init_rope()
 
+    def _shard_state_dict(self, state_dict, prefix, *args):
+        num_heads, num_key_value_heads = self.config.num_attention_heads, self.config.num_key_value_heads
+        shards = {
+            "q_proj": (0, num_heads * self.head_dim, 1),
+            "k_proj": (0, num_key_value_heads * self.head_dim, 1),
+            "v_proj": (0, num_key_value_heads * self.head_dim, 1),
+            "o_proj": (1, num_heads * self.head_dim, 1),
+        }
+        _tensor_parallel_shard_state_dict(state_dict, prefix, shards, self.tp_rank, self.tp_size)
+
     def _init_rope(self):
         if self.config.rope_scaling is None:
             self.rotary_emb = DeepseekRotaryEmbedding(
@@ -546,32 +2305,39 @@ class DeepseekAttention(nn.Module):
         cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
-        if past_key_value is not None:
-            cache_kwargs = {"sin": sin, "cos": cos}  # Specific to RoPE models
-            key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
-
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        if isinstance(past_key_value, DeepseekQuantizedCache) and not output_attentions:
+            # the int8 cache is dequantized a few blocks at a time inside the attention computation
+            attn_output = past_key_value.attend(
+                query_states, key_states, value_states, self.layer_idx, attention_mask, is_causal=self.is_causal
+            )
+            attn_weights = None
+        else:
+            if past_key_value is not None:
+                cache_kwargs = {"sin": sin, "cos": cos}  # Specific to RoPE models
+                key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+            key_states = repeat_kv(key_states, self.num_key_value_groups)
+            value_states = repeat_kv(value_states, self.num_key_value_groups)
 
-        if attn_weights.size() != (bsz, self.num_heads, q_len, kv_seq_len):
-            raise ValueError(
-                f"Attention weights should be of size {(bsz, self.num_heads, q_len, kv_seq_len)}, but is"
-                f" {attn_weights.size()}"
-            )
+            attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
 
-        if attention_mask is not None:
-            if attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
+            if attn_weights.size() != (bsz, self.num_heads, q_len, kv_seq_len):
                 raise ValueError(
-                    f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
+                    f"Attention weights should be of size {(bsz, self.num_heads, q_len, kv_seq_len)}, but is"
+                    f" {attn_weights.size()}"
                 )
-            attn_weights = attn_weights + attention_mask
 
-        # upcast attention to fp32
-        attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
-        attn_weights = nn.functional.dropout(attn_weights, p=self.attention_dropout, training=self.training)
-        attn_output = torch.matmul(attn_weights, value_states)
+            if attention_mask is not None:
+                if attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
+                    raise ValueError(
+                        f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
+                    )
+                attn_weights = attn_weights + attention_mask
+
+            # upcast attention to fp32
+            attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+            attn_weights = nn.functional.dropout(attn_weights, p=self.attention_dropout, training=self.training)
+            attn_output = torch.matmul(attn_weights, value_states)
 
         if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
             raise ValueError(
@@ -581,7 +2347,7 @@ class DeepseekAttention(nn.Module):
 
         attn_output = attn_output.transpose(1, 2).contiguous()
 
-        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+        attn_output = attn_output.reshape(bsz, q_len, self.num_heads * self.head_dim)
 
         if self.config.pretraining_tp > 1:
             attn_output = attn_output.split(self.hidden_size // self.config.pretraining_tp, dim=2)
@@ -694,7 +2460,7 @@ class DeepseekFlashAttention2(DeepseekAttention):
             query_states, key_states, value_states, attention_mask, q_len, dropout=dropout_rate
         )
 
-        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size).contiguous()
+        attn_output = attn_output.reshape(bsz, q_len, self.num_heads * self.head_dim).contiguous()
         attn_output = self.o_proj(attn_output)
 
         if not output_attentions:
@@ -850,6 +2616,21 @@ class DeepseekSdpaAttention(DeepseekAttention):
 
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
+        if attention_mask is not None:
+            if attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
+                raise ValueError(
+                    f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
+                )
+
+        if isinstance(past_key_value, DeepseekQuantizedCache):
+            # the int8 cache is dequantized a few blocks at a time inside the attention computation
+            attn_output = past_key_value.attend(
+                query_states, key_states, value_states, self.layer_idx, attention_mask, is_causal=self.is_causal
+            )
+            attn_output = attn_output.transpose(1, 2).contiguous()
+            attn_output = attn_output.reshape(bsz, q_len, self.num_heads * self.head_dim)
+            return self.o_proj(attn_output), None, past_key_value
+
         if past_key_value is not None:
             cache_kwargs = {"sin": sin, "cos": cos}  # Specific to RoPE models
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
@@ -857,12 +2638,6 @@ class DeepseekSdpaAttention(DeepseekAttention):
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
 
-        if attention_mask is not None:
-            if attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
-                raise ValueError(
-                    f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
-                )
-
         # SDPA with memory-efficient backend is currently (torch==2.1.2) bugged with non-contiguous inputs with custom attn_mask,
         # Reference: https://github.com/pytorch/pytorch/issues/112577.
         if query_states.device.type == "cuda" and attention_mask is not None:
@@ -881,7 +2656,7 @@ class DeepseekSdpaAttention(DeepseekAttention):
         )
 
         attn_output = attn_output.transpose(1, 2).contiguous()
-        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+        attn_output = attn_output.reshape(bsz, q_len, self.num_heads * self.head_dim)
 
         attn_output = self.o_proj(attn_output)
 
@@ -902,11 +2677,19 @@ class DeepseekDecoderLayer(nn.Module):
 
         self.self_attn = Deepseek_ATTENTION_CLASSES[config._attn_implementation](config=config, layer_idx=layer_idx)
 
-        self.mlp = DeepseekMoE(config) if (config.n_routed_experts is not None and  \
+        self.mlp = DeepseekMoE(config, layer_idx) if (config.n_routed_experts is not None and  \
                                            layer_idx >= config.first_k_dense_replace and layer_idx % config.moe_layer_freq == 0) \
                                         else DeepseekMLP(config)
         self.input_layernorm = DeepseekRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.post_attention_layernorm = DeepseekRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        self.tp_rank, self.tp_size = _tensor_parallel_world(config)
+
+    def _tensor_parallel_reduce(self, hidden_states):
+        # with tensor parallelism the row-parallel `o_proj` / `down_proj` of every rank give partial sums, one
+        # all-reduce per block (for a MoE layer over the routed and shared experts together)
+        if self.tp_size > 1:
+            torch.distributed.all_reduce(hidden_states)
+        return hidden_states
 
     def forward(
         self,
@@ -950,13 +2733,17 @@ class DeepseekDecoderLayer(nn.Module):
             use_cache=use_cache,
             **kwargs,
         )
-        hidden_states = residual + hidden_states
+        hidden_states = residual + self._tensor_parallel_reduce(hidden_states)
 
         # Fully Connected
         residual = hidden_states
         hidden_states = self.post_attention_layernorm(hidden_states)
-        hidden_states = self.mlp(hidden_states)
-        hidden_states = residual + hidden_states
+        if isinstance(self.mlp, DeepseekMoE):
+            # the gate picks the copies of replicated experts from the token positions
+            hidden_states = self.mlp(hidden_states, position_ids=position_ids)
+        else:
+            hidden_states = self.mlp(hidden_states)
+        hidden_states = residual + self._tensor_parallel_reduce(hidden_states)
 
         outputs = (hidden_states,)
 
@@ -969,6 +2756,68 @@ class DeepseekDecoderLayer(nn.Module):
         return outputs
 
 
+@contextlib.contextmanager
+def empty_parameters():
+    """
+    Creates the parameters of the modules built inside on the meta device: they take no memory and their random
+    initialization is a no-op, while buffers (e.g. the rotary caches) are built as usual. The parameters are then
+    materialized by `load_state_dict(state_dict, assign=True)`, see [`DeepseekPreTrainedModel.from_checkpoint`].
+    """
+    register_parameter = nn.Module.register_parameter
+
+    def register_empty_parameter(module, name, param):
+        if param is not None and param.device.type != "meta":
+            param = nn.Parameter(param.to("meta"), requires_grad=param.requires_grad)
+        register_parameter(module, name, param)
+
+    nn.Module.register_parameter = register_empty_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+# the arguments of `from_pretrained` that locate the checkpoint files rather than configure the model
+_HUB_KWARGS = (
+    "cache_dir", "force_download", "resume_download", "proxies", "local_files_only", "token", "revision", "subfolder",
+)
+
+
+def _checkpoint_files(pretrained_model_name_or_path, **kwargs):
+    """The weight files of a local or hub checkpoint, safetensors first, sharded or not."""
+    for index_name, weights_name in ((SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME), (WEIGHTS_INDEX_NAME, WEIGHTS_NAME)):
+        index = cached_file(pretrained_model_name_or_path, index_name, _raise_exceptions_for_missing_entries=False, **kwargs)
+        if index is not None:
+            with open(index) as f:
+                shards = sorted(set(json.load(f)["weight_map"].values()))
+            return [cached_file(pretrained_model_name_or_path, shard, **kwargs) for shard in shards]
+        weights = cached_file(pretrained_model_name_or_path, weights_name, _raise_exceptions_for_missing_entries=False, **kwargs)
+        if weights is not None:
+            return [weights]
+    raise OSError(f"no safetensors or pytorch_model.bin weights found in {pretrained_model_name_or_path}")
+
+
+def _load_checkpoint_file(path, dtype = None):
+    """
+    Tensors of one weight file, the floating point weights cast to `dtype` one at a time. Other tensors, e.g. the
+    fp16 scales of quantized experts, keep their dtype.
+    """
+    if path.endswith(".safetensors"):
+        from safetensors import safe_open
+
+        with safe_open(path, framework="pt") as f:
+            state_dict = {key: f.get_tensor(key) for key in f.keys()}
+    else:
+        state_dict = torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    for key, tensor in state_dict.items():
+        if dtype is not None and key.endswith(".weight") and tensor.is_floating_point():
+            state_dict[key] = tensor.to(dtype)
+        elif not tensor.is_floating_point():
+            # packed quantized weights, copied as the int8 kernel needs the alignment of PyTorch's allocator
+            state_dict[key] = tensor.clone()
+    return state_dict
+
+
 Deepseek_START_DOCSTRING = r"""
     This model inherits from [`PreTrainedModel`]. Check the superclass documentation for the generic methods the
     library implements for all its model (such as downloading or saving, resizing the input embeddings, pruning heads
@@ -1010,6 +2859,101 @@ class DeepseekPreTrainedModel(PreTrainedModel):
             module.weight.data.normal_(mean=0.0, std=std)
             if module.padding_idx is not None:
                 module.weight.data[module.padding_idx].zero_()
+        elif isinstance(module, DeepseekGroupedExperts):
+            for weight in module.parameters():
+                weight.data.normal_(mean=0.0, std=std)
+
+    def _check_gate_up_halves(self, pretrained_model_name_or_path):
+        """Raises for the `gate_proj`/`up_proj` checkpoint tensors still waiting for their other half after loading."""
+        halves = []
+        for module in self.modules():
+            if isinstance(module, DeepseekMLP):
+                halves.extend(module._gate_up_halves)
+                module._gate_up_halves.clear()
+        if halves:
+            raise ValueError(
+                f"{pretrained_model_name_or_path} has only one of `gate_proj`/`up_proj` for {halves}, their fused "
+                f"`gate_up_proj` cannot be loaded"
+            )
+
+    @classmethod
+    def from_pretrained(cls, pretrained_model_name_or_path, *args, **kwargs):
+        """
+        [`PreTrainedModel.from_pretrained`], which loads the checkpoint shard by shard through the state dict hooks:
+        with `config.fuse_gate_up_proj` a half of `gate_proj`/`up_proj` left without the other one raises.
+        """
+        loaded = super().from_pretrained(pretrained_model_name_or_path, *args, **kwargs)
+        (loaded[0] if isinstance(loaded, tuple) else loaded)._check_gate_up_halves(pretrained_model_name_or_path)
+        return loaded
+
+    def save_pretrained(self, save_directory, *args, **kwargs):
+        """
+        [`PreTrainedModel.save_pretrained`] (sharded safetensors by default) with the layout of the routed experts
+        recorded in the config first, see [`DeepseekModel.update_expert_config`]: `from_pretrained` and
+        `from_checkpoint` then rebuild the copies, quantized and pruned experts of the variant and load the packed
+        quantized weights, scales and zero points as they are.
+        """
+        base_model = getattr(self, self.base_model_prefix, self)
+        if isinstance(base_model, DeepseekModel):
+            base_model.update_expert_config()
+        return super().save_pretrained(save_directory, *args, **kwargs)
+
+    @classmethod
+    def from_checkpoint(cls, pretrained_model_name_or_path, config = None, torch_dtype = None, **kwargs):
+        """
+        Loads a checkpoint without building the model twice: the model is constructed with [`empty_parameters`], so
+        no weight is allocated or randomly initialized (64 experts per MoE layer and the gates' `kaiming_uniform_`),
+        and every parameter is then the checkpoint tensor itself (`load_state_dict(..., assign=True)`), cast to
+        `torch_dtype`. Peak memory stays about one copy of the weights. The state dict hooks still run, so the config
+        may ask for fused, grouped, replicated or tensor-parallel layouts of a plain checkpoint.
+
+        Args:
+            pretrained_model_name_or_path (`str`): a local checkpoint folder or a hub model id.
+            config ([`DeepseekConfig`], *optional*): defaults to the checkpoint's, updated with `kwargs`.
+            torch_dtype (`torch.dtype`, *optional*): dtype of the floating point weights, the checkpoint's if unset.
+            kwargs: the hub arguments of `from_pretrained` (`revision`, `cache_dir`, `token`, ...), used to fetch both
+                the config and the weights; the others update the config.
+        """
+        hub_kwargs = {key: kwargs.pop(key) for key in _HUB_KWARGS if key in kwargs}
+        if config is None:
+            config = DeepseekConfig.from_pretrained(pretrained_model_name_or_path, **hub_kwargs, **kwargs)
+        else:
+            config = copy.deepcopy(config)
+            for key, value in kwargs.items():
+                setattr(config, key, value)
+
+        default_dtype = torch.get_default_dtype()
+        if torch_dtype is not None:
+            torch.set_default_dtype(torch_dtype)
+        try:
+            with empty_parameters():
+                model = cls(config)
+        finally:
+            torch.set_default_dtype(default_dtype)
+
+        state_dict = {}
+        for path in _checkpoint_files(pretrained_model_name_or_path, **hub_kwargs):
+            state_dict.update(_load_checkpoint_file(path, torch_dtype))
+        if not any(key.startswith(cls.base_model_prefix + ".") for key in model.state_dict()):
+            # a bare `DeepseekModel` from a `DeepseekForCausalLM` checkpoint
+            prefix = cls.base_model_prefix + "."
+            state_dict = {key[len(prefix):]: value for key, value in state_dict.items() if key.startswith(prefix)}
+        unexpected_keys = model.load_state_dict(state_dict, strict=False, assign=True).unexpected_keys
+        del state_dict
+        model._check_gate_up_halves(pretrained_model_name_or_path)
+        model.tie_weights()
+
+        missing = [
+            name for name, tensor in list(model.named_parameters()) + list(model.named_buffers())
+            if tensor.device.type == "meta"
+        ]
+        if missing:
+            raise ValueError(f"{pretrained_model_name_or_path} has no weights for {missing}")
+        if unexpected_keys:
+            logger.warning(f"Unused weights of {pretrained_model_name_or_path}: {unexpected_keys}")
+        if torch_dtype is not None:
+            model.config.torch_dtype = torch_dtype
+        return model.eval()
 
 
 Deepseek_INPUTS_DOCSTRING = r"""
@@ -1108,6 +3052,8 @@ class DeepseekModel(DeepseekPreTrainedModel):
         self.norm = DeepseekRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
 
         self.gradient_checkpointing = False
+        self.routing_recorder = None
+        self.skip_layers = frozenset()
         # Initialize weights and apply final processing
         self.post_init()
 
@@ -1117,6 +3063,135 @@ class DeepseekModel(DeepseekPreTrainedModel):
     def set_input_embeddings(self, value):
         self.embed_tokens = value
 
+    def start_routing_trace(self, **kwargs):
+        """
+        Starts recording the routing of every MoE layer into a new [`RoutingRecorder`], built with `kwargs`, and
+        returns it. Replaces forward hooks on the gates.
+        """
+        moe_layers = [layer.mlp for layer in self.layers if isinstance(layer.mlp, DeepseekMoE)]
+        # the copies of replicated experts are recorded as experts of their own, past the `n_routed_experts` originals
+        num_experts = max([moe.gate.n_routed_experts + moe.gate.num_replicas for moe in moe_layers], default=0)
+        self.routing_recorder = RoutingRecorder(
+            [moe.layer_idx for moe in moe_layers], self.config.num_experts_per_tok, num_experts, **kwargs
+        )
+        for moe in moe_layers:
+            moe.routing_recorder = self.routing_recorder
+        return self.routing_recorder
+
+    def stop_routing_trace(self):
+        """Stops recording, flushes what is pending and returns the [`RoutingRecorder`]."""
+        recorder = self.routing_recorder
+        for layer in self.layers:
+            if isinstance(layer.mlp, DeepseekMoE):
+                layer.mlp.routing_recorder = None
+        self.routing_recorder = None
+        if recorder is not None:
+            recorder.close()
+        return recorder
+
+    def moe_layer(self, layer_idx):
+        """The [`DeepseekMoE`] of decoder layer `layer_idx`."""
+        mlp = self.layers[layer_idx].mlp
+        if not isinstance(mlp, DeepseekMoE):
+            raise ValueError(f"decoder layer {layer_idx} has no routed experts")
+        return mlp
+
+    def update_expert_config(self):
+        """
+        Records the current layout of the routed experts in the config: `expert_replicas` from their copies, and
+        `expert_precisions` / `expert_quant_group_size` from the quantized and pruned ones, so that the model is rebuilt
+        as the same variant from a saved checkpoint. The surgery methods below call it.
+        """
+        expert_replicas, expert_precisions, quantized = {}, {}, []
+        for layer in self.layers:
+            moe = layer.mlp
+            if not isinstance(moe, DeepseekMoE):
+                continue
+            sources = moe.replica_sources
+            if sources:
+                expert_replicas[moe.layer_idx] = {expert_idx: sources.count(expert_idx) for expert_idx in sorted(set(sources))}
+            if isinstance(moe.experts, nn.ModuleList):
+                precisions = {expert_idx: _expert_precision(expert) for expert_idx, expert in enumerate(moe.experts)}
+                precisions = {expert_idx: precision for expert_idx, precision in precisions.items() if precision != "bf16"}
+                if precisions:
+                    expert_precisions[moe.layer_idx] = precisions
+                quantized.extend(module for module in moe.experts.modules() if isinstance(module, DeepseekQuantLinear))
+        # the one `group_size` argument (`None` for the per-bits default) every quantized projection was built with
+        group_sizes = [None] + sorted({module.group_size for module in quantized})
+        group_size = next(
+            (
+                group_size
+                for group_size in group_sizes
+                if all(
+                    module.group_size == DeepseekQuantLinear.resolve_group_size(group_size, module.bits, module.in_features)
+                    for module in quantized
+                )
+            ),
+            False,
+        )
+        if group_size is False:
+            raise ValueError(f"the quantized experts must share one group size to be saved, got {group_sizes[1:]}")
+        self.config.expert_replicas = expert_replicas or None
+        self.config.expert_precisions = expert_precisions or None
+        if quantized:
+            self.config.expert_quant_group_size = group_size
+        return self.config
+
+    def replace_expert(self, layer_idx, expert_idx, expert, gate_weight = None):
+        """Replaces one routed expert in place, see [`DeepseekMoE.replace_expert`]."""
+        self.moe_layer(layer_idx).replace_expert(expert_idx, expert, gate_weight)
+        self.update_expert_config()
+        return self
+
+    def quantize_experts(self, experts, bits = 8, group_size = None):
+        """Quantizes the routed experts of `experts` (`{layer_idx: [expert_idx, ...]}`) in place."""
+        for layer_idx, expert_ids in experts.items():
+            self.moe_layer(layer_idx).quantize_experts(expert_ids, bits, group_size)
+        self.update_expert_config()
+        return self
+
+    def prune_experts(self, experts):
+        """Prunes the routed experts of `experts` (`{layer_idx: [expert_idx, ...]}`) in place."""
+        for layer_idx, expert_ids in experts.items():
+            self.moe_layer(layer_idx).prune_experts(expert_ids)
+        self.update_expert_config()
+        return self
+
+    def replicate_experts(self, replicas):
+        """
+        Sets the extra copies of the routed experts of `replicas` (`{layer_idx: {expert_idx: num_replicas}}`) in place,
+        see [`DeepseekMoE.replicate_experts`].
+        """
+        for layer_idx, layer_replicas in replicas.items():
+            self.moe_layer(layer_idx).replicate_experts(layer_replicas)
+        self.update_expert_config()
+        return self
+
+    def reorder_experts(self, orders):
+        """Permutes the routed experts of `orders` (`{layer_idx: order}`) in place, see [`DeepseekMoE.reorder_experts`]."""
+        for layer_idx, order in orders.items():
+            self.moe_layer(layer_idx).reorder_experts(order)
+        self.update_expert_config()
+        return self
+
+    @contextlib.contextmanager
+    def draft_mode(self, skip_layers = (), skip_routed_experts = False):
+        """
+        Runs the model as its own cheaper draft, for self-speculative decoding: the decoder layers in `skip_layers` are
+        left out (their KV cache is not written) and, with `skip_routed_experts`, MoE layers only run their shared
+        experts.
+        """
+        moe_layers = [layer.mlp for layer in self.layers if isinstance(layer.mlp, DeepseekMoE)]
+        self.skip_layers = frozenset(skip_layers)
+        for moe in moe_layers:
+            moe.skip_routed_experts = skip_routed_experts
+        try:
+            yield self
+        finally:
+            self.skip_layers = frozenset()
+            for moe in moe_layers:
+                moe.skip_routed_experts = False
+
     @add_start_docstrings_to_model_forward(Deepseek_INPUTS_DOCSTRING)
     def forward(
         self,
@@ -1160,7 +3235,9 @@ class DeepseekModel(DeepseekPreTrainedModel):
             use_legacy_cache = not isinstance(past_key_values, Cache)
             if use_legacy_cache:
                 past_key_values = DynamicCache.from_legacy_cache(past_key_values)
-            past_key_values_length = past_key_values.get_usable_length(seq_length)
+            # skipped layers of a draft pass hold fewer cached tokens than the others
+            first_layer = next((idx for idx in range(len(self.layers)) if idx not in self.skip_layers), 0)
+            past_key_values_length = past_key_values.get_usable_length(seq_length, first_layer)
 
         if position_ids is None:
             device = input_ids.device if input_ids is not None else inputs_embeds.device
@@ -1169,10 +3246,20 @@ class DeepseekModel(DeepseekPreTrainedModel):
             )
             position_ids = position_ids.unsqueeze(0)
 
+        if self.routing_recorder is not None:
+            self.routing_recorder.begin_step(position_ids.expand(batch_size, seq_length))
+
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids)
 
-        if self._use_flash_attention_2:
+        if attention_mask is not None and attention_mask.dim() == 4:
+            # custom 4d mask (1 = attend), e.g. several sequences packed into one row
+            if self._use_flash_attention_2:
+                raise ValueError("4D attention masks are not supported with flash_attention_2")
+            attention_mask = _prepare_4d_causal_attention_mask(
+                attention_mask, (batch_size, seq_length), inputs_embeds, past_key_values_length
+            )
+        elif self._use_flash_attention_2:
             # 2d mask is passed through the layers
             attention_mask = attention_mask if (attention_mask is not None and 0 in attention_mask) else None
         elif self._use_sdpa and not output_attentions:
@@ -1198,7 +3285,9 @@ class DeepseekModel(DeepseekPreTrainedModel):
         all_self_attns = () if output_attentions else None
         next_decoder_cache = None
 
-        for decoder_layer in self.layers:
+        for layer_idx, decoder_layer in enumerate(self.layers):
+            if layer_idx in self.skip_layers:
+                continue
             if output_hidden_states:
                 all_hidden_states += (hidden_states,)
 
@@ -1257,10 +3346,32 @@ class DeepseekForCausalLM(DeepseekPreTrainedModel):
         self.model = DeepseekModel(config)
         self.vocab_size = config.vocab_size
         self.lm_head = nn.Linear(config.hidden_size, config.vocab_size, bias=False)
+        self._static_cache = None
 
         # Initialize weights and apply final processing
         self.post_init()
 
+    def _setup_cache(self, cache_cls, max_batch_size, max_cache_len = None):
+        """Called by `generate(..., cache_implementation="static")`, preallocates a [`DeepseekStaticCache`]."""
+        self._static_cache = DeepseekStaticCache(
+            self.config,
+            max_batch_size,
+            max_cache_len,
+            device=[layer.self_attn.o_proj.weight.device for layer in self.model.layers],
+            dtype=self.dtype,
+        )
+
+    def _reset_cache(self):
+        self._static_cache = None
+
+    def generate(self, *args, **kwargs):
+        # `generate` only calls `_reset_cache` when it returns, a static cache left by one that raised would otherwise
+        # be picked up by the next call whatever its `cache_implementation`
+        try:
+            return super().generate(*args, **kwargs)
+        finally:
+            self._reset_cache()
+
     def get_input_embeddings(self):
         return self.model.embed_tokens
 
@@ -1413,11 +3524,20 @@ class DeepseekForCausalLM(DeepseekPreTrainedModel):
                 position_ids = position_ids[:, -input_ids.shape[1] :]
 
         # if `inputs_embeds` are passed, we only want to use them in the 1st generation step
-        if inputs_embeds is not None and past_key_values is None:
+        if inputs_embeds is not None and (
+            past_key_values is None or (isinstance(past_key_values, Cache) and past_key_values.get_seq_length() == 0)
+        ):
             model_inputs = {"inputs_embeds": inputs_embeds}
         else:
             model_inputs = {"input_ids": input_ids}
 
+        # the first step of `generate(..., cache_implementation="static")` starts filling the preallocated cache
+        if past_key_values is None and self._static_cache is not None:
+            past_key_values = self._static_cache
+            past_key_values.reset()
+        elif past_key_values is None and self.config.kv_cache_dtype == "int8":
+            past_key_values = DeepseekQuantizedCache()
+
         model_inputs.update(
             {
                 "position_ids": position_ids,
@@ -0,0 +1,259 @@
+import os
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from transformers.cache_utils import DynamicCache
+
+from configuration_deepseek import DeepseekConfig
+from modeling_deepseek import DeepseekForCausalLM
+
+
+def layer_costs(config):
+    """
+    Weights every decoder layer multiplies per token: the attention projections plus the dense MLP, or for a MoE
+    layer the gate, the shared experts and `num_experts_per_tok` routed experts.
+    """
+    hidden_size = config.hidden_size
+    head_dim = hidden_size // config.num_attention_heads
+    attention = 2 * hidden_size * hidden_size + 2 * hidden_size * config.num_key_value_heads * head_dim
+    costs = []
+    for layer_idx in range(config.num_hidden_layers):
+        if (config.n_routed_experts is not None and layer_idx >= config.first_k_dense_replace
+                and layer_idx % config.moe_layer_freq == 0):
+            experts = config.num_experts_per_tok + (config.n_shared_experts or 0)
+            mlp = 3 * hidden_size * config.moe_intermediate_size * experts + hidden_size * config.n_routed_experts
+        else:
+            mlp = 3 * hidden_size * config.intermediate_size
+        costs.append(attention + mlp)
+    return costs
+
+
+def partition_layers(config, num_stages):
+    """
+    Splits the decoder layers into `num_stages` contiguous `(start, end)` ranges minimizing the cost of the slowest
+    stage (`layer_costs`, the last stage also paying for `lm_head`), so dense and MoE layers are weighed by their
+    per-token compute rather than counted.
+    """
+    costs = layer_costs(config)
+    num_layers = len(costs)
+    if not 1 <= num_stages <= num_layers:
+        raise ValueError(f"cannot split {num_layers} decoder layers into {num_stages} pipeline stages")
+    prefix = [0]
+    for cost in costs:
+        prefix.append(prefix[-1] + cost)
+    head = config.hidden_size * config.vocab_size
+
+    # best[s][j]: cost of the slowest stage when layers [0, j) form s stages, split[s][j]: start of the s-th stage
+    best = [[float("inf")] * (num_layers + 1) for _ in range(num_stages + 1)]
+    split = [[0] * (num_layers + 1) for _ in range(num_stages + 1)]
+    best[0][0] = 0
+    for stage in range(1, num_stages + 1):
+        for end in range(stage, num_layers + 1):
+            for start in range(stage - 1, end):
+                cost = max(best[stage - 1][start], prefix[end] - prefix[start] + (head if end == num_layers else 0))
+                if cost < best[stage][end]:
+                    best[stage][end], split[stage][end] = cost, start
+
+    stages, end = [], num_layers
+    for stage in range(num_stages, 0, -1):
+        stages.append((split[stage][end], end))
+        end = split[stage][end]
+    return stages[::-1]
+
+
+class PipelineStage:
+    """
+    One rank's stage of pipeline-parallel inference of a [`DeepseekForCausalLM`] over the default `torch.distributed`
+    process group: the rank keeps the decoder layers of its range from `partition_layers` (the first stage also the
+    embeddings, the last one the final norm and `lm_head`) and drops the others, so every rank holds about
+    `1 / world_size` of the model.
+
+    `generate` splits the batch into micro-batches that flow through the stages concurrently, hidden states going to
+    the next rank and the greedy tokens of the last rank back to the first one for the next step, so with at least as
+    many micro-batches as stages no stage waits for the others to finish the whole batch, unlike the layer-by-layer
+    dispatch of `device_map="auto"`.
+    """
+
+    def __init__(self, model, stages = None):
+        self.rank, self.num_stages = dist.get_rank(), dist.get_world_size()
+        self.stages = partition_layers(model.config, self.num_stages) if stages is None else stages
+        self.first, self.last = self.rank == 0, self.rank == self.num_stages - 1
+
+        start, end = self.stages[self.rank]
+        layers = list(model.model.layers[start:end])
+        # the KV cache of a stage only holds its own layers
+        for layer_idx, layer in enumerate(layers):
+            layer.self_attn.layer_idx = layer_idx
+        model.model.layers = nn.ModuleList(layers)
+        if not self.first:
+            model.model.embed_tokens = None
+        if not self.last:
+            model.model.norm = nn.Identity()
+            model.lm_head = None
+        self.model = model
+
+    def _send(self, pending, micro_batch, tensor, dst):
+        # the previous send of a micro-batch is done before its next one, bounding the buffers in flight
+        if pending[micro_batch] is not None:
+            pending[micro_batch].wait()
+        pending[micro_batch] = dist.isend(tensor.contiguous(), dst)
+
+    def _recv(self, shape, dtype, src):
+        tensor = torch.empty(shape, dtype=dtype)
+        dist.recv(tensor, src)
+        return tensor
+
+    @torch.no_grad()
+    def generate(self, input_ids, attention_mask = None, max_new_tokens = 1, num_micro_batches = None):
+        """
+        Greedily decodes `max_new_tokens` tokens after the (left padded) `input_ids`, as `generate` with `do_sample=False`
+        but never stopping early. Every rank calls it with the same inputs and gets the same
+        `(batch_size, prompt_length + max_new_tokens)` tokens back.
+
+        Args:
+            num_micro_batches (`int`, *optional*): micro-batches the batch is split into, defaults to one per stage.
+                With 1 the stages run one after another.
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        num_micro_batches = self.num_stages if num_micro_batches is None else num_micro_batches
+        ids = list(input_ids.chunk(num_micro_batches))
+        masks = list(attention_mask.chunk(num_micro_batches))
+        caches = [DynamicCache() for _ in ids]
+        tokens = [[] for _ in ids]
+        pending = [None] * len(ids)
+        hidden_size, dtype = self.model.config.hidden_size, self.model.dtype
+
+        for step in range(max_new_tokens):
+            for micro_batch in range(len(ids)):
+                mask = masks[micro_batch]
+                batch_size, seq_len = mask.shape[0], ids[micro_batch].shape[-1] if step == 0 else 1
+                position_ids = (mask.long().cumsum(-1) - 1).masked_fill(mask == 0, 1)[:, -seq_len:]
+                inputs = dict(
+                    attention_mask=mask, position_ids=position_ids, past_key_values=caches[micro_batch], use_cache=True
+                )
+                if self.first:
+                    if step and not self.last:
+                        ids[micro_batch] = self._recv((batch_size, 1), torch.long, self.num_stages - 1)
+                    hidden_states = self.model.model(input_ids=ids[micro_batch], **inputs).last_hidden_state
+                else:
+                    hidden_states = self._recv((batch_size, seq_len, hidden_size), dtype, self.rank - 1)
+                    hidden_states = self.model.model(inputs_embeds=hidden_states, **inputs).last_hidden_state
+
+                if not self.last:
+                    self._send(pending, micro_batch, hidden_states, self.rank + 1)
+                else:
+                    next_tokens = self.model.lm_head(hidden_states[:, -1:]).argmax(-1)
+                    tokens[micro_batch].append(next_tokens)
+                    if self.first:
+                        ids[micro_batch] = next_tokens
+                    elif step + 1 < max_new_tokens:
+                        self._send(pending, micro_batch, next_tokens, 0)
+                masks[micro_batch] = torch.cat([mask, mask.new_ones(batch_size, 1)], dim=-1)
+
+        for work in pending:
+            if work is not None:
+                work.wait()
+        if self.last:
+            new_tokens = torch.cat([torch.cat(micro_batch, dim=-1) for micro_batch in tokens])
+        else:
+            new_tokens = torch.empty(input_ids.shape[0], max_new_tokens, dtype=torch.long)
+        dist.broadcast(new_tokens, self.num_stages - 1)
+        return torch.cat([input_ids, new_tokens], dim=-1)
+
+
+def tiny_config(**kwargs):
+    # tiny random model with the layout of deepseek-moe-16b (dense layer 0, shared + routed experts)
+    return DeepseekConfig(
+        vocab_size=1024,
+        hidden_size=256,
+        intermediate_size=704,
+        moe_intermediate_size=64,
+        num_hidden_layers=8,
+        num_attention_heads=8,
+        num_key_value_heads=8,
+        n_shared_experts=2,
+        n_routed_experts=64,
+        num_experts_per_tok=6,
+        first_k_dense_replace=1,
+        max_position_embeddings=512,
+        attn_implementation="sdpa",
+        **kwargs,
+    )
+
+
+def run(rank, args):
+    """
+    Every rank builds the same full model and its reference greedy tokens, then keeps its pipeline stage and checks
+    the pipelined tokens against the reference, timing them with one micro-batch per stage and with a single one.
+    """
+    if "RANK" not in os.environ:
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", str(args.port))
+        dist.init_process_group("gloo", rank=rank, world_size=args.world_size)
+    else:
+        dist.init_process_group("gloo")
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+    torch.manual_seed(0)
+    model = DeepseekForCausalLM(tiny_config()).eval()
+    input_ids = torch.randint(0, 1024, (args.batch_size, args.seq_len), generator=torch.Generator().manual_seed(0))
+    attention_mask = torch.ones_like(input_ids)
+    # left padding on every other sequence
+    attention_mask[::2, : args.seq_len // 4] = 0
+    with torch.no_grad():
+        reference = model.generate(
+            input_ids, attention_mask=attention_mask, max_new_tokens=args.max_new_tokens,
+            min_new_tokens=args.max_new_tokens, do_sample=False, pad_token_id=-1,
+        )
+    full_bytes = sum(param.numel() * param.element_size() for param in model.parameters())
+
+    stage = PipelineStage(model)
+    stage.generate(input_ids, attention_mask, 1)
+    results = []
+    for num_micro_batches in (args.micro_batches or world_size, 1):
+        dist.barrier()
+        start = time.perf_counter()
+        tokens = stage.generate(input_ids, attention_mask, args.max_new_tokens, num_micro_batches)
+        dist.barrier()
+        results.append((time.perf_counter() - start, torch.equal(tokens, reference)))
+    stage_bytes = torch.tensor([float(sum(param.numel() * param.element_size() for param in model.parameters()))])
+    gathered = [torch.empty_like(stage_bytes) for _ in range(world_size)]
+    dist.all_gather(gathered, stage_bytes)
+
+    if rank == 0:
+        num_tokens = args.batch_size * args.max_new_tokens
+        costs = layer_costs(model.config)
+        for r, ((start, end), nbytes) in enumerate(zip(stage.stages, torch.cat(gathered).tolist())):
+            print(f"stage {r}: layers [{start}, {end}), cost {sum(costs[start:end]):,}, {nbytes / 2 ** 20:.2f} MiB (full {full_bytes / 2 ** 20:.2f} MiB)")
+        (pipelined, same_pipelined), (sequential, same_sequential) = results
+        print(f"same greedy tokens: {same_pipelined} pipelined, {same_sequential} sequential")
+        print(f"{num_tokens / pipelined:.1f} tokens/s pipelined, {num_tokens / sequential:.1f} tokens/s one micro-batch")
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DEEPSEEK")
+    parser.add_argument("--world_size", type=int, default=2, help="input the number of stages, unless under torchrun")
+    parser.add_argument("--batch_size", type=int, default=8, help="input the number of sequences")
+    parser.add_argument("--seq_len", type=int, default=64, help="input the prompt length")
+    parser.add_argument("--max_new_tokens", type=int, default=8, help="input the number of generated tokens")
+    parser.add_argument("--micro_batches", type=int, default=None, help="input the number of micro-batches")
+    parser.add_argument("--port", type=int, default=29514, help="input the rendezvous port")
+    args = parser.parse_args()
+
+    if "RANK" in os.environ:
+        run(int(os.environ["RANK"]), args)
+    else:
+        mp.spawn(run, args=(args,), nprocs=args.world_size)
+
+
+"""
+python pipeline_parallel.py --world_size 4 --batch_size 8 --seq_len 64
+torchrun --nproc_per_node 4 pipeline_parallel.py --batch_size 32 --seq_len 256 --micro_batches 8
+"""
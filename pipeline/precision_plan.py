@@ -0,0 +1,264 @@
+import os
+import json
+import heapq
+import argparse
+
+import numpy as np
+
+
+PRECISIONS = ("bf16", "int8", "int4", "pruned")
+# relative reconstruction error `||W - dequantize(quantize(W))|| / ||W||` per precision, of `DeepseekQuantLinear` at
+# its default group sizes (per-channel int8, int4 in groups of 128) on Gaussian weights of the expert shape of
+# deepseek-moe-16b (hidden 2048, moe_intermediate 1408). Only a prior: `quantization_errors` measures the experts of a
+# checkpoint, which `plan_precision(..., errors=...)` then uses instead
+PRECISION_ERRORS = {"bf16": 0.0, "int8": 0.008, "int4": 0.1, "pruned": 1.0}
+
+
+def expert_nbytes(num_params, precision, group_size = None):
+    """
+    Bytes of an expert of `num_params` weights at `precision`, with the fp16 scale and zero point of every group.
+    `group_size=None` is the `DeepseekQuantLinear` default, whose per-channel int8 scales are negligible.
+    """
+    if precision == "bf16":
+        return 2 * num_params
+    if precision == "pruned":
+        return 0
+    bits = 8 if precision == "int8" else 4
+    if group_size is None:
+        return num_params * bits // 8 + (0 if bits == 8 else num_params // 128 * 3)
+    return num_params * bits // 8 + num_params // group_size * 3
+
+
+def load_importance(path, num_experts = 64):
+    """
+    `(num_layers, num_experts)` expert importance scores from the JSON output of `cal_important/eval_mt_model.py`
+    (`{layer: [[score per sample] per expert]}`, layers being MoE layer positions), averaged over the samples, and over
+    the files if `path` is a folder of them.
+    """
+    files = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".json")] if os.path.isdir(path) else [path]
+    scores = []
+    for file in files:
+        with open(file) as f:
+            file_data = json.load(f)
+        scores.append(np.stack([
+            [np.mean(samples) if len(samples) else 0.0 for samples in file_data[key][:num_experts]]
+            for key in sorted(file_data, key=int)
+        ]))
+    return np.mean(scores, axis=0)
+
+
+def quantization_errors(model, precisions = PRECISIONS, group_size = None):
+    """
+    `(num_layers, num_experts, len(precisions))` relative reconstruction error of every routed expert of the MoE layers
+    of `model` (a [`DeepseekForCausalLM`] with unquantized experts) at each precision: `||W - dequantize(quantize(W))||
+    / ||W||` over its three projections, with the quantizer of `DeepseekQuantLinear` at `group_size`. 0 for bf16, 1 for
+    pruned.
+    """
+    import torch
+    from modeling_deepseek import DeepseekMoE, DeepseekQuantLinear
+
+    def squared_error(weight, bits):
+        quantized = DeepseekQuantLinear(weight.shape[1], weight.shape[0], bits, group_size, device=weight.device)
+        quantized.qweight, quantized.scales, quantized.zeros = quantized.quantize_weight(weight, bits, group_size)
+        return (quantized.dequantize() - weight).pow(2).sum()
+
+    layers = [layer.mlp for layer in model.model.layers if isinstance(layer.mlp, DeepseekMoE)]
+    num_experts = model.config.n_routed_experts
+    shape = (len(layers), num_experts, len(precisions))
+    # bf16 and pruned as in `PRECISION_ERRORS`
+    errors = np.broadcast_to([PRECISION_ERRORS[precision] for precision in precisions], shape).copy()
+    with torch.no_grad():
+        for layer, mlp in enumerate(layers):
+            for expert_idx in range(num_experts):
+                expert = mlp.experts[expert_idx]
+                weights = [weight.float() for weight in (*expert.gate_up_weights(), expert.down_proj.weight)]
+                norm = sum(weight.pow(2).sum() for weight in weights).sqrt()
+                for level, precision in enumerate(precisions):
+                    if precision in ("int8", "int4"):
+                        error = sum(squared_error(weight, int(precision[3:])) for weight in weights).sqrt()
+                        errors[layer, expert_idx, level] = (error / norm).item()
+    return errors
+
+
+class PrecisionPlan:
+    """
+    Precision of every routed expert, `{layer_idx: [precision per expert]}` with decoder layer indices and precisions
+    from `PRECISIONS`. Saved as JSON; `apply` quantizes and prunes the experts of a loaded [`DeepseekForCausalLM`]
+    accordingly.
+    """
+
+    def __init__(self, layers, group_size = None):
+        self.layers = {int(layer_idx): list(precisions) for layer_idx, precisions in layers.items()}
+        self.group_size = group_size
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            plan = json.load(f)
+        return cls(plan["layers"], plan["group_size"])
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"group_size": self.group_size, "layers": self.layers}, f, indent=4)
+
+    def counts(self):
+        """Number of experts at each precision."""
+        precisions = [precision for layer in self.layers.values() for precision in layer]
+        return {precision: precisions.count(precision) for precision in PRECISIONS}
+
+    def nbytes(self, num_params):
+        return sum(
+            expert_nbytes(num_params, precision, self.group_size) for layer in self.layers.values() for precision in layer
+        )
+
+    def apply(self, model):
+        """Quantizes and prunes the routed experts of `model` in place."""
+        for layer_idx, precisions in self.layers.items():
+            mlp = model.model.layers[layer_idx].mlp
+            for precision, bits in (("int8", 8), ("int4", 4)):
+                expert_ids = [expert_idx for expert_idx, p in enumerate(precisions) if p == precision]
+                if expert_ids:
+                    mlp.quantize_experts(expert_ids, bits, self.group_size)
+            pruned = [expert_idx for expert_idx, p in enumerate(precisions) if p == "pruned"]
+            if pruned:
+                mlp.prune_experts(pruned)
+        return model
+
+
+def plan_precision(
+    budget_bytes,
+    num_params,
+    layer_ids,
+    load = None,
+    importance = None,
+    precisions = PRECISIONS,
+    group_size = None,
+    min_experts = 6,
+    errors = None,
+):
+    """
+    Assigns a precision to every routed expert so that they fit in `budget_bytes`, greedily: starting from the first
+    (highest) precision, the one-level step down of an expert adding the least error per byte saved is taken until the
+    budget is met. The error of expert `e` of a layer at precision `p` is `load[e] * importance[e] * errors[e, p]`, i.e.
+    how often the expert is routed to, how much its output matters and how much the precision perturbs its weights.
+
+    Args:
+        budget_bytes (`int`): memory for the routed experts of all layers.
+        num_params (`int`): weights of one expert, `3 * hidden_size * moe_intermediate_size`.
+        layer_ids (`list[int]`): decoder layer index of every MoE layer position.
+        load (`np.ndarray`, *optional*): `(num_layers, num_experts)` routing frequencies, e.g. `RoutingStats.load()`.
+            Uniform if unset.
+        importance (`np.ndarray`, *optional*): `(num_layers, num_experts)` importance scores, see `load_importance`.
+            Uniform if unset.
+        precisions (`tuple[str]`): the allowed precisions, from highest to lowest.
+        min_experts (`int`): experts every layer keeps unpruned, at least `num_experts_per_tok`.
+        errors (`np.ndarray`, *optional*): `(num_layers, num_experts, len(precisions))` error of every expert at each
+            precision, e.g. `quantization_errors(model, precisions, group_size)`. `PRECISION_ERRORS` if unset.
+    """
+    if load is None and importance is None:
+        raise ValueError("plan_precision needs routing frequencies, importance scores or both")
+    shape = (load if load is not None else importance).shape
+    weight = np.ones(shape) if load is None else np.asarray(load, dtype=np.float64)
+    if importance is not None:
+        # scores are compared across layers relative to each layer's mean
+        importance = np.asarray(importance, dtype=np.float64)
+        weight = weight * importance / np.maximum(importance.mean(axis=1, keepdims=True), 1e-12)
+    nbytes = [expert_nbytes(num_params, precision, group_size) for precision in precisions]
+    if errors is None:
+        errors = np.broadcast_to([PRECISION_ERRORS[precision] for precision in precisions], shape + (len(precisions),))
+
+    levels = np.zeros(shape, dtype=np.int64)
+    pruned = np.zeros(shape[0], dtype=np.int64)
+    total = nbytes[0] * levels.size
+
+    def push(heap, layer, expert):
+        level = levels[layer, expert]
+        if level + 1 < len(precisions):
+            saved = nbytes[level] - nbytes[level + 1]
+            cost = weight[layer, expert] * (errors[layer, expert, level + 1] - errors[layer, expert, level])
+            heapq.heappush(heap, (cost / max(saved, 1), layer, expert))
+
+    heap = []
+    for layer in range(shape[0]):
+        for expert in range(shape[1]):
+            push(heap, layer, expert)
+    while total > budget_bytes:
+        if not heap:
+            raise ValueError(f"the routed experts do not fit in {budget_bytes} bytes with precisions {precisions}")
+        _, layer, expert = heapq.heappop(heap)
+        level = levels[layer, expert] + 1
+        if precisions[level] == "pruned":
+            if shape[1] - pruned[layer] <= min_experts:
+                continue
+            pruned[layer] += 1
+        total -= nbytes[level - 1] - nbytes[level]
+        levels[layer, expert] = level
+        push(heap, layer, expert)
+
+    return PrecisionPlan(
+        {layer_idx: [precisions[level] for level in levels[layer]] for layer, layer_idx in enumerate(layer_ids)}, group_size
+    )
+
+
+if __name__ == "__main__":
+    from routing_stats import RoutingStats
+    from routing_trace import RoutingTrace
+
+    parser = argparse.ArgumentParser(description="DEEPSEEK")
+    parser.add_argument("output", type=str, help="input the path of the plan")
+    parser.add_argument("--trace", type=str, nargs="*", default=[], help="input the routing traces of the frequencies")
+    parser.add_argument("--importance", type=str, default=None, help="input the importance scores, a file or folder")
+    parser.add_argument("--budget_gb", type=float, required=True, help="input the memory budget of the routed experts")
+    parser.add_argument("--precisions", type=str, nargs="+", default=list(PRECISIONS), help="input the allowed precisions")
+    parser.add_argument("--group_size", type=int, default=None, help="input the quantization group size (default: per-channel int8, 128 for int4)")
+    parser.add_argument("--num_experts", type=int, default=64, help="input the number of routed experts")
+    parser.add_argument("--hidden_size", type=int, default=2048, help="input the hidden size")
+    parser.add_argument("--moe_intermediate_size", type=int, default=1408, help="input the expert intermediate size")
+    parser.add_argument("--first_k_dense_replace", type=int, default=1, help="input the number of dense layers")
+    parser.add_argument("--min_experts", type=int, default=6, help="input the unpruned experts kept per layer")
+    parser.add_argument(
+        "--model", type=str, default=None, help="input the checkpoint whose quantization errors are measured (default: PRECISION_ERRORS)"
+    )
+    args = parser.parse_args()
+
+    load, layer_ids = None, None
+    if args.trace:
+        traces = [RoutingTrace(path) for path in args.trace]
+        stats = [RoutingStats.from_trace(trace, args.num_experts) for trace in traces]
+        load, layer_ids = sum(stats[1:], stats[0]).load(), traces[0].layer_ids
+    importance = load_importance(args.importance, args.num_experts) if args.importance is not None else None
+    if layer_ids is None:
+        layer_ids = [args.first_k_dense_replace + layer for layer in range(importance.shape[0])]
+
+    num_params = 3 * args.hidden_size * args.moe_intermediate_size
+    precisions = tuple(precision for precision in PRECISIONS if precision in args.precisions)
+    errors = None
+    if args.model is not None:
+        import torch
+        from modeling_deepseek import DeepseekForCausalLM
+
+        errors = quantization_errors(
+            DeepseekForCausalLM.from_checkpoint(args.model, torch_dtype=torch.bfloat16), precisions, args.group_size
+        )
+    plan = plan_precision(
+        int(args.budget_gb * 2 ** 30),
+        num_params,
+        layer_ids,
+        load,
+        importance,
+        precisions,
+        args.group_size,
+        args.min_experts,
+        errors,
+    )
+    plan.save(args.output)
+    full = expert_nbytes(num_params, "bf16") * args.num_experts * len(layer_ids)
+    print(plan.counts())
+    print(f"routed experts {plan.nbytes(num_params) / 2 ** 30:.2f} GiB ({plan.nbytes(num_params) / full:.2f}x of bf16)")
+
+
+"""
+python precision_plan.py ./plan/mmlu_8gb.json --trace /mnt/deepseek/eval_raw/results/raw/mmlu/winogrande_debiased --importance /mnt/deepseek/cal_important/resutls/mmlu_new --budget_gb 8
+python precision_plan.py ./plan/mmlu_6gb.json --trace /mnt/deepseek/eval_raw/results/raw/mmlu/winogrande_debiased --importance /mnt/deepseek/cal_important/resutls/mmlu_new --budget_gb 6 --model deepseek-ai/deepseek-moe-16b-base
+python precision_plan.py ./plan/mmlu_5gb.json --importance /mnt/deepseek/cal_important/resutls/mmlu_new --budget_gb 5 --precisions bf16 int4 pruned
+"""
@@ -0,0 +1,113 @@
+import heapq
+
+
+class RadixNode:
+    """One full block of tokens of a cached prefix: its token ids, the paged-cache block holding their KV states."""
+
+    def __init__(self, tokens, block, parent):
+        self.tokens = tokens
+        self.block = block
+        self.parent = parent
+        self.children = {}
+        self.last_access = 0
+
+
+class PrefixCache:
+    """
+    Radix tree over the token blocks of prompts computed by a [`DeepseekPagedCache`] (from `modeling_deepseek`), one
+    node per full `block_size` tokens, keeping a reference on each node's block. A new sequence sharing a prefix with
+    an earlier one starts on top of the longest cached run of full blocks (`match`) and only prefills the rest.
+
+    The tree holds at most `max_bytes` of blocks; over the budget, or when the paged cache runs out of blocks
+    (`evict`), least recently used leaves that no running sequence references are dropped.
+    """
+
+    def __init__(self, cache, max_bytes = None):
+        self.cache = cache
+        self.block_size = cache.block_size
+        self.max_blocks = cache.num_blocks if max_bytes is None else max_bytes // cache.block_bytes
+        self.root = RadixNode((), None, None)
+        self.num_blocks = 0
+        self._clock = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.queries = 0
+        self.query_tokens = 0
+        self.hit_tokens = 0
+        self.evicted_blocks = 0
+
+    @property
+    def hit_rate(self):
+        """Share of the looked-up prompt tokens whose KV states came from the cache."""
+        return self.hit_tokens / max(self.query_tokens, 1)
+
+    def _blocks(self, token_ids):
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            yield tuple(token_ids[start:start + self.block_size])
+
+    def match(self, token_ids, max_blocks = None):
+        """Blocks of the longest cached prefix of `token_ids`, at most `max_blocks` of them."""
+        self._clock += 1
+        node, blocks = self.root, []
+        for tokens in self._blocks(token_ids):
+            if (max_blocks is not None and len(blocks) == max_blocks) or tokens not in node.children:
+                break
+            node = node.children[tokens]
+            node.last_access = self._clock
+            blocks.append(node.block)
+        return blocks
+
+    def record(self, num_tokens, num_cached):
+        """Counts one lookup of `num_tokens` prompt tokens of which `num_cached` were served from the cache."""
+        self.queries += 1
+        self.query_tokens += num_tokens
+        self.hit_tokens += num_cached
+
+    def insert(self, token_ids, blocks):
+        """Adds the full blocks of a computed sequence, `blocks` being its block table. Existing nodes are kept."""
+        self._clock += 1
+        node = self.root
+        for tokens, block in zip(self._blocks(token_ids), blocks):
+            if tokens not in node.children:
+                self.cache.acquire_block(block)
+                node.children[tokens] = RadixNode(tokens, block, node)
+                self.num_blocks += 1
+            node = node.children[tokens]
+            node.last_access = self._clock
+        self.trim()
+
+    def trim(self):
+        """Evicts down to the byte budget, as far as blocks are not used by running sequences."""
+        if self.num_blocks > self.max_blocks:
+            self.evict(self.num_blocks - self.max_blocks)
+
+    def _evictable(self, node):
+        return not node.children and self.cache.block_refs[node.block] == 1
+
+    def evict(self, num_blocks):
+        """Frees up to `num_blocks` blocks of least recently used leaves. Returns how many were freed."""
+        leaves = [(node.last_access, id(node), node) for node in self._nodes() if self._evictable(node)]
+        heapq.heapify(leaves)
+        freed = 0
+        while leaves and freed < num_blocks:
+            _, _, node = heapq.heappop(leaves)
+            parent = node.parent
+            del parent.children[node.tokens]
+            self.cache.release_block(node.block)
+            self.num_blocks -= 1
+            freed += 1
+            if parent is not self.root and self._evictable(parent):
+                heapq.heappush(leaves, (parent.last_access, id(parent), parent))
+        self.evicted_blocks += freed
+        return freed
+
+    def _nodes(self):
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            yield node
+
+    def clear(self):
+        self.evict(self.num_blocks)
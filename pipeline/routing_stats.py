@@ -0,0 +1,112 @@
+import argparse
+
+import numpy as np
+
+from routing_trace import RoutingTraceSet
+
+
+class RoutingStats:
+    """
+    Streaming routing statistics of the MoE layers, accumulated from `(num_tokens, top_k)` expert-id chunks with
+    `np.bincount`: per-layer expert histograms and top-k co-occurrence matrices. Everything else (load gap, entropy,
+    diffs) is derived from those counts, so statistics of several traces combine with `+`. Expert ids
+    `>= num_experts` (assignments dropped by the capacity limit) are not counted. In the trace of a model with
+    replicated experts, the copies count as experts of their own from `n_routed_experts` on.
+    """
+
+    def __init__(self, num_layers, num_experts = 64):
+        self.num_layers = num_layers
+        self.num_experts = num_experts
+        self.counts = np.zeros((num_layers, num_experts), dtype=np.int64)
+        self.cooccurrence = np.zeros((num_layers, num_experts, num_experts), dtype=np.int64)
+
+    @classmethod
+    def from_trace(cls, trace, num_experts = None, chunk_tokens = 1 << 20):
+        """
+        Accumulates every layer of a `routing_trace.RoutingTrace`, `chunk_tokens` rows at a time. `num_experts`
+        defaults to the expert slots of the trace, fewer would drop the traffic of the last ones (e.g. expert copies).
+        """
+        if num_experts is not None and num_experts < trace.num_experts:
+            raise ValueError(f"the trace in {trace.path} has {trace.num_experts} expert slots, got num_experts={num_experts}")
+        stats = cls(trace.num_layers, trace.num_experts if num_experts is None else num_experts)
+        for layer in range(trace.num_layers):
+            for expert_ids in trace.chunks(layer, chunk_tokens):
+                stats.update(layer, expert_ids)
+        return stats
+
+    def update(self, layer, expert_ids):
+        """Adds a `(num_tokens, top_k)` chunk of expert ids of MoE layer position `layer`."""
+        num_experts = self.num_experts
+        expert_ids = np.asarray(expert_ids, dtype=np.int64)
+        # one extra bin takes the dropped assignments
+        expert_ids = np.minimum(expert_ids, num_experts)
+        self.counts[layer] += np.bincount(expert_ids.ravel(), minlength=num_experts + 1)[:num_experts]
+        # every ordered pair of distinct top-k slots of a token
+        top_k = expert_ids.shape[-1]
+        first, second = np.nonzero(~np.eye(top_k, dtype=bool))
+        pairs = expert_ids[:, first] * (num_experts + 1) + expert_ids[:, second]
+        pairs = np.bincount(pairs.ravel(), minlength=(num_experts + 1) ** 2).reshape(num_experts + 1, num_experts + 1)
+        self.cooccurrence[layer] += pairs[:num_experts, :num_experts]
+        return self
+
+    def __add__(self, other):
+        stats = RoutingStats(self.num_layers, self.num_experts)
+        stats.counts = self.counts + other.counts
+        stats.cooccurrence = self.cooccurrence + other.cooccurrence
+        return stats
+
+    def load(self):
+        """`(num_layers, num_experts)` share of the assignments of each layer that went to each expert."""
+        return self.counts / np.maximum(self.counts.sum(axis=1, keepdims=True), 1)
+
+    def max_expert(self):
+        """The most loaded expert of each layer."""
+        return self.counts.argmax(axis=1)
+
+    def load_gap(self):
+        """Per-layer ratio of the most loaded expert's assignments to the average per expert."""
+        average = self.counts.sum(axis=1) / self.num_experts
+        return self.counts.max(axis=1) / np.maximum(average, 1e-12)
+
+    def entropy(self):
+        """Per-layer entropy (bits) of the expert load, `log2(num_experts)` for a perfectly balanced layer."""
+        load = self.load()
+        return -(load * np.log2(np.where(load > 0, load, 1))).sum(axis=1)
+
+    def cooccurrence_rate(self):
+        """`cooccurrence` normalized by the assignments of the row expert: P(expert j selected | expert i selected)."""
+        return self.cooccurrence / np.maximum(self.counts[:, :, None], 1)
+
+    def diff(self, other):
+        """
+        Per-layer comparison with the statistics of another dataset: the total variation distance between the two
+        load distributions and the change in load gap and entropy.
+        """
+        return {
+            "load_distance": 0.5 * np.abs(self.load() - other.load()).sum(axis=1),
+            "load_gap": self.load_gap() - other.load_gap(),
+            "entropy": self.entropy() - other.entropy(),
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DEEPSEEK")
+    parser.add_argument("folder", type=str, help="input the folder of the routing traces, one per dataset")
+    parser.add_argument("--num_experts", type=int, default=64, help="input the number of routed experts")
+    args = parser.parse_args()
+
+    traces = RoutingTraceSet(args.folder)
+    dataset_stats = {dataset: RoutingStats.from_trace(trace, args.num_experts) for dataset, trace in traces.items()}
+    total = sum(dataset_stats.values(), RoutingStats(*next(iter(dataset_stats.values())).counts.shape))
+    print(f"all: gap {total.load_gap().mean():.4f}, entropy {total.entropy().mean():.4f}")
+    for dataset, stats in dataset_stats.items():
+        diff = stats.diff(total)
+        print(
+            f"{dataset}: gap {stats.load_gap().mean():.4f}, entropy {stats.entropy().mean():.4f}, "
+            f"distance to all {diff['load_distance'].mean():.4f}"
+        )
+
+
+"""
+python routing_stats.py /mnt/deepseek/eval_raw/results/raw/mmlu --num_experts 64
+"""
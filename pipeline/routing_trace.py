@@ -0,0 +1,169 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+
+class RoutingTrace:
+    """
+    Reader of a columnar routing trace, as written by `RoutingRecorder(flush_dir=...)` of `modeling_deepseek` or by
+    `convert_json_trace`. Every column is a raw file memory-mapped on first use, so slicing by layer or by sample only
+    reads those rows:
+
+        manifest.json               layer_ids, top_k, num_experts, num_tokens and the column dtypes
+        sample_offsets.npy          first token of every sample
+        positions.bin               (num_tokens,) position ids
+        expert_ids.{layer_idx}.bin  (num_tokens, top_k) selected experts of a layer
+        weights.{layer_idx}.bin     (num_tokens, top_k) their gate weights (absent in converted JSON traces)
+
+    `layer` arguments are MoE layer positions, i.e. indices into `layer_ids`. Expert ids run over `num_experts` slots,
+    the copies of replicated experts following the routed experts, and the id `num_experts` (`dropped_id`) marks
+    dropped assignments.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.layer_ids = self.manifest["layer_ids"]
+        self.top_k = self.manifest["top_k"]
+        self.num_experts = self.manifest["num_experts"]
+        self.num_tokens = self.manifest["num_tokens"]
+        offsets_path = os.path.join(path, "sample_offsets.npy")
+        offsets = np.load(offsets_path) if os.path.exists(offsets_path) else np.zeros(1, dtype=np.int64)
+        self.sample_offsets = np.append(offsets, self.num_tokens)
+        self._columns = {}
+
+    @property
+    def dropped_id(self):
+        return self.num_experts
+
+    @property
+    def num_layers(self):
+        return len(self.layer_ids)
+
+    @property
+    def num_samples(self):
+        return len(self.sample_offsets) - 1
+
+    def __len__(self):
+        return self.num_samples
+
+    def _column(self, name, shape):
+        if name not in self._columns:
+            column_path = os.path.join(self.path, f"{name}.bin")
+            if not os.path.exists(column_path):
+                raise FileNotFoundError(f"the trace in {self.path} has no `{name}` column")
+            dtype = self.manifest[f"{name.split('.')[0]}_dtype"]
+            self._columns[name] = np.memmap(column_path, dtype=dtype, mode="r", shape=shape)
+        return self._columns[name]
+
+    def _rows(self, samples):
+        if samples is None:
+            return slice(0, self.num_tokens)
+        if isinstance(samples, slice):
+            start, stop, step = samples.indices(self.num_samples)
+            if step != 1:
+                raise ValueError("samples must be a contiguous range")
+            return slice(int(self.sample_offsets[start]), int(self.sample_offsets[max(stop, start)]))
+        return slice(int(self.sample_offsets[samples]), int(self.sample_offsets[samples + 1]))
+
+    def expert_ids(self, layer, samples = None):
+        """`(num_tokens, top_k)` experts selected at MoE layer position `layer`, for all, one or a range of samples."""
+        return self._column(f"expert_ids.{self.layer_ids[layer]}", (self.num_tokens, self.top_k))[self._rows(samples)]
+
+    def weights(self, layer, samples = None):
+        return self._column(f"weights.{self.layer_ids[layer]}", (self.num_tokens, self.top_k))[self._rows(samples)]
+
+    def positions(self, samples = None):
+        return self._column("positions", (self.num_tokens,))[self._rows(samples)]
+
+    def sample(self, sample_idx):
+        """`(num_layers, num_tokens, top_k)` experts of one sample, the per-sample layout of the old JSON traces."""
+        return np.stack([self.expert_ids(layer, sample_idx) for layer in range(self.num_layers)])
+
+    def __iter__(self):
+        for sample_idx in range(self.num_samples):
+            yield self.sample(sample_idx)
+
+    def chunks(self, layer, chunk_tokens = 1 << 20):
+        """Yields the experts of MoE layer position `layer` in blocks of at most `chunk_tokens` rows."""
+        expert_ids = self.expert_ids(layer)
+        for start in range(0, self.num_tokens, chunk_tokens):
+            yield expert_ids[start:start + chunk_tokens]
+
+
+class RoutingTraceSet:
+    """The routing traces of a results folder, one [`RoutingTrace`] sub-directory per dataset."""
+
+    def __init__(self, root):
+        self.root = root
+        self.datasets = sorted(
+            name for name in os.listdir(root) if os.path.exists(os.path.join(root, name, "manifest.json"))
+        )
+
+    def __len__(self):
+        return len(self.datasets)
+
+    def __getitem__(self, dataset):
+        return RoutingTrace(os.path.join(self.root, dataset))
+
+    def items(self):
+        for dataset in self.datasets:
+            yield dataset, self[dataset]
+
+
+def convert_json_trace(json_path, path, num_experts = 64, layer_ids = None):
+    """
+    Converts a `{sample: [moe_layer][token][top_k]}` JSON trace, as written by earlier versions of
+    `eval_raw/eval_raw_model.py`, into a columnar trace in `path`. Such traces hold no gate weights or positions,
+    positions are rebuilt as `0..num_tokens - 1` per sample.
+    """
+    with open(json_path) as f:
+        samples = [np.asarray(routing, dtype=np.int64) for routing in json.load(f).values()]
+    num_layers, _, top_k = samples[0].shape
+    layer_ids = list(range(1, num_layers + 1)) if layer_ids is None else list(layer_ids)
+    id_dtype = np.uint8 if num_experts < 256 else np.int16
+    os.makedirs(path, exist_ok=True)
+    for layer, layer_idx in enumerate(layer_ids):
+        np.concatenate([routing[layer] for routing in samples]).astype(id_dtype).tofile(
+            os.path.join(path, f"expert_ids.{layer_idx}.bin")
+        )
+    lengths = np.array([routing.shape[1] for routing in samples], dtype=np.int64)
+    np.concatenate([np.arange(length, dtype=np.int32) for length in lengths]).tofile(os.path.join(path, "positions.bin"))
+    np.save(os.path.join(path, "sample_offsets.npy"), np.cumsum(lengths) - lengths)
+    manifest = {
+        "layer_ids": layer_ids,
+        "top_k": int(top_k),
+        "num_experts": num_experts,
+        "num_tokens": int(lengths.sum()),
+        "expert_ids_dtype": np.dtype(id_dtype).name,
+        "positions_dtype": "int32",
+    }
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return RoutingTrace(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DEEPSEEK")
+    parser.add_argument("json_folder", type=str, help="input the folder of the JSON traces")
+    parser.add_argument("output_folder", type=str, help="input the folder of the columnar traces")
+    parser.add_argument("--num_experts", type=int, default=64, help="input the number of routed experts")
+    args = parser.parse_args()
+
+    for file in sorted(os.listdir(args.json_folder)):
+        if not file.endswith(".json"):
+            continue
+        trace = convert_json_trace(
+            os.path.join(args.json_folder, file),
+            os.path.join(args.output_folder, file[: -len(".json")]),
+            num_experts=args.num_experts,
+        )
+        print(f"{file}: {trace.num_samples} samples, {trace.num_tokens} tokens")
+
+
+"""
+python routing_trace.py /mnt/deepseek/eval_raw/resutls/raw/mmlu /mnt/deepseek/eval_raw/results/raw/mmlu
+"""
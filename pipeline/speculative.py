@@ -0,0 +1,179 @@
+import time
+import argparse
+
+import torch
+from transformers.cache_utils import DynamicCache
+
+from configuration_deepseek import DeepseekConfig
+from modeling_deepseek import DeepseekForCausalLM
+
+
+def crop_cache(cache, max_length):
+    """Drops the cached tokens after `max_length`, in every layer holding more."""
+    if hasattr(cache, "crop"):
+        cache.crop(max_length)
+        return
+    for layer_idx in range(len(cache.key_cache)):
+        cache.key_cache[layer_idx] = cache.key_cache[layer_idx][..., :max_length, :]
+        cache.value_cache[layer_idx] = cache.value_cache[layer_idx][..., :max_length, :]
+    cache._seen_tokens = min(cache._seen_tokens, max_length)
+
+
+class SelfSpeculativeDecoder:
+    """
+    Speculative decoding of a [`DeepseekForCausalLM`] with itself as the draft: the draft is the same model run in
+    `DeepseekModel.draft_mode`, without the decoder layers in `skip_layers` and/or without the routed experts of the MoE
+    layers, so no second checkpoint is held in memory. Each round the draft proposes up to `num_draft_tokens` tokens
+    one by one, and the full model scores all of them in one forward pass.
+
+    Drafts are accepted by speculative sampling (Leviathan et al., 2023): draft token `x` with draft probability `q(x)`
+    is kept with probability `min(1, p(x) / q(x))` under the full model's `p`, and the first rejected one is replaced by
+    a sample of `max(p - q, 0)` (renormalized), which makes every emitted token exactly distributed as in plain
+    sampling from `p`. With `temperature=0` this is greedy decoding: a draft is kept iff it is the full model's argmax.
+    The draft and the verification share one KV cache, the draft's entries are cropped before verifying.
+    """
+
+    def __init__(self, model, skip_layers = (), skip_routed_experts = False, num_draft_tokens = 4, seed = 0):
+        self.model = model
+        self.skip_layers = tuple(skip_layers)
+        self.skip_routed_experts = skip_routed_experts
+        self.num_draft_tokens = num_draft_tokens
+        self.generator = torch.Generator().manual_seed(seed)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.rounds = 0
+        self.drafted_tokens = 0
+        self.accepted_tokens = 0
+        self.generated_tokens = 0
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted_tokens / max(self.drafted_tokens, 1)
+
+    def _forward(self, input_ids, position, cache):
+        position_ids = torch.arange(position, position + input_ids.shape[-1], device=input_ids.device).unsqueeze(0)
+        return self.model(input_ids=input_ids, position_ids=position_ids, past_key_values=cache, use_cache=True).logits[0].float()
+
+    def _probs(self, logits, temperature):
+        if temperature == 0:
+            return torch.nn.functional.one_hot(logits.argmax(-1), logits.shape[-1]).float()
+        return torch.softmax(logits / temperature, dim=-1)
+
+    def _sample(self, probs):
+        return int(torch.multinomial(probs.cpu(), 1, generator=self.generator))
+
+    @torch.no_grad()
+    def generate(self, input_ids, max_new_tokens = 128, temperature = 0.0, eos_token_id = None):
+        """Generates from a `(1, prompt_len)` prompt, returns the new token ids as a list."""
+        eos_token_id = self.model.config.eos_token_id if eos_token_id is None else eos_token_id
+        device = input_ids.device
+        cache = DynamicCache()
+        probs = self._probs(self._forward(input_ids, 0, cache)[-1], temperature)
+        tokens = [self._sample(probs)]
+        num_cached = input_ids.shape[-1]
+        while len(tokens) < max_new_tokens and eos_token_id not in tokens:
+            # the last token is not in the cache yet, it starts both the draft and the verification
+            num_draft = min(self.num_draft_tokens, max_new_tokens - len(tokens) - 1)
+            draft_tokens, draft_probs = [], []
+            with self.model.model.draft_mode(self.skip_layers, self.skip_routed_experts):
+                for step in range(num_draft):
+                    last_token = (draft_tokens or tokens)[-1]
+                    logits = self._forward(torch.tensor([[last_token]], device=device), num_cached + step, cache)
+                    draft_probs.append(self._probs(logits[-1], temperature))
+                    draft_tokens.append(self._sample(draft_probs[-1]))
+            crop_cache(cache, num_cached)
+
+            verify_ids = torch.tensor([[tokens[-1]] + draft_tokens], device=device)
+            target_probs = self._probs(self._forward(verify_ids, num_cached, cache), temperature)
+            num_accepted = 0
+            for draft_token, p, q in zip(draft_tokens, target_probs, draft_probs):
+                if torch.rand((), generator=self.generator) * q[draft_token] >= p[draft_token]:
+                    next_token = self._sample(torch.clamp(p - q, min=0))
+                    break
+                num_accepted += 1
+            else:
+                next_token = self._sample(target_probs[num_draft])
+            num_cached += 1 + num_accepted
+            crop_cache(cache, num_cached)
+
+            self.rounds += 1
+            self.drafted_tokens += num_draft
+            self.accepted_tokens += num_accepted
+            tokens += draft_tokens[:num_accepted] + [next_token]
+
+        tokens = tokens[:max_new_tokens]
+        if eos_token_id in tokens:
+            tokens = tokens[:tokens.index(eos_token_id) + 1]
+        self.generated_tokens += len(tokens)
+        return tokens
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DEEPSEEK")
+    parser.add_argument("--model_name", type=str, default=None, help="input the checkpoint, a tiny random model if unset")
+    parser.add_argument("--prompt", type=str, default="An attention function can be described as", help="input the prompt")
+    parser.add_argument("--skip_layers", type=int, nargs="*", default=[], help="input the layers the draft skips")
+    parser.add_argument("--skip_routed_experts", action="store_true", help="input whether the draft skips routed experts")
+    parser.add_argument("--num_draft_tokens", type=int, default=4, help="input the number of tokens drafted per round")
+    parser.add_argument("--max_new_tokens", type=int, default=64, help="input the number of generated tokens")
+    parser.add_argument("--temperature", type=float, default=0.0, help="input the sampling temperature, 0 for greedy")
+    args = parser.parse_args()
+    torch.manual_seed(0)
+
+    if args.model_name is not None:
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+
+        tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+        model = AutoModelForCausalLM.from_pretrained(
+            args.model_name, torch_dtype=torch.bfloat16, device_map="auto", trust_remote_code=True
+        ).eval()
+        input_ids = tokenizer(args.prompt, return_tensors="pt").input_ids.to(model.device)
+    else:
+        # tiny random model with the layout of deepseek-moe-16b (dense layer 0, shared + routed experts)
+        config = DeepseekConfig(
+            vocab_size=1024,
+            hidden_size=256,
+            intermediate_size=704,
+            moe_intermediate_size=64,
+            num_hidden_layers=8,
+            num_attention_heads=8,
+            num_key_value_heads=8,
+            n_shared_experts=2,
+            n_routed_experts=64,
+            num_experts_per_tok=6,
+            first_k_dense_replace=1,
+            max_position_embeddings=512,
+            attn_implementation="sdpa",
+        )
+        model = DeepseekForCausalLM(config).eval()
+        input_ids = torch.randint(0, config.vocab_size, (1, 32))
+
+    eos_token_id = -1 if args.model_name is None else None
+    decoder = SelfSpeculativeDecoder(model, args.skip_layers, args.skip_routed_experts, args.num_draft_tokens)
+    start = time.perf_counter()
+    tokens = decoder.generate(input_ids, args.max_new_tokens, args.temperature, eos_token_id=eos_token_id)
+    speculative_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        reference = model.generate(
+            input_ids,
+            max_new_tokens=len(tokens),
+            min_new_tokens=len(tokens),
+            do_sample=False,
+            pad_token_id=model.config.eos_token_id,
+        )[0, input_ids.shape[-1]:].tolist()
+    plain_time = time.perf_counter() - start
+
+    print(f"acceptance rate {decoder.acceptance_rate:.4f}, {len(tokens) / decoder.rounds:.2f} tokens per full forward")
+    print(f"speculative: {len(tokens) / speculative_time:.1f} tokens/s, plain: {len(tokens) / plain_time:.1f} tokens/s")
+    print(f"speedup {plain_time / speculative_time:.2f}x")
+    if args.temperature == 0:
+        print(f"same tokens as greedy generate: {tokens == reference}")
+
+
+"""
+python speculative.py --skip_routed_experts --num_draft_tokens 4 --max_new_tokens 64
+python speculative.py --model_name deepseek-ai/deepseek-moe-16b-base --skip_layers 8 10 12 14 16 18 20 22 24 26 --num_draft_tokens 4
+"""
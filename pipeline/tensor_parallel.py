@@ -0,0 +1,114 @@
+import os
+import time
+import argparse
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from configuration_deepseek import DeepseekConfig
+from modeling_deepseek import DeepseekForCausalLM
+
+
+def tiny_config(**kwargs):
+    # tiny random model with the layout of deepseek-moe-16b (dense layer 0, shared + routed experts)
+    return DeepseekConfig(
+        vocab_size=1024,
+        hidden_size=256,
+        intermediate_size=704,
+        moe_intermediate_size=64,
+        num_hidden_layers=4,
+        num_attention_heads=8,
+        num_key_value_heads=8,
+        n_shared_experts=2,
+        n_routed_experts=64,
+        num_experts_per_tok=6,
+        first_k_dense_replace=1,
+        max_position_embeddings=512,
+        attn_implementation="sdpa",
+        **kwargs,
+    )
+
+
+def layer_bytes(model):
+    return sum(tensor.numel() * tensor.element_size() for tensor in model.model.layers.parameters())
+
+
+def timed(fn, repeats):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = fn()
+    return result, (time.perf_counter() - start) / repeats
+
+
+def run(rank, args):
+    """
+    Every rank builds the same full model and its reference outputs, then builds the tensor-parallel model
+    (`tensor_parallel=True`) from the full state dict and checks its logits and greedy tokens against the reference on
+    the same batch.
+    """
+    if "RANK" not in os.environ:
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", str(args.port))
+        dist.init_process_group("gloo", rank=rank, world_size=args.world_size)
+    else:
+        dist.init_process_group("gloo")
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+    torch.manual_seed(0)
+    model = DeepseekForCausalLM(tiny_config()).eval()
+    # tensor parallelism splits every sequence over the ranks, they all run the same batch
+    input_ids = torch.randint(0, 1024, (args.batch_size, args.seq_len), generator=torch.Generator().manual_seed(0))
+    generate_kwargs = dict(
+        max_new_tokens=args.max_new_tokens, min_new_tokens=args.max_new_tokens, do_sample=False, pad_token_id=-1
+    )
+    with torch.no_grad():
+        reference, full_time = timed(lambda: model(input_ids).logits, args.repeats)
+        reference_tokens = model.generate(input_ids, **generate_kwargs)
+    full_bytes = layer_bytes(model)
+
+    sharded = DeepseekForCausalLM(tiny_config(tensor_parallel=True)).eval()
+    sharded.load_state_dict(model.state_dict())
+    del model
+
+    with torch.no_grad():
+        logits, sharded_time = timed(lambda: sharded(input_ids).logits, args.repeats)
+        tokens = sharded.generate(input_ids, **generate_kwargs)
+    results = torch.tensor([(logits - reference).abs().max().item(), float(torch.equal(tokens, reference_tokens))])
+    gathered = [torch.empty_like(results) for _ in range(world_size)]
+    dist.all_gather(gathered, results)
+
+    if rank == 0:
+        num_tokens = args.batch_size * args.seq_len
+        for r, (diff, same_tokens) in enumerate(torch.stack(gathered).tolist()):
+            print(f"rank {r}: max logit diff {diff:.2e}, same greedy tokens: {bool(same_tokens)}")
+        print(f"decoder layers per rank {layer_bytes(sharded) / 2 ** 20:.2f} MiB (full {full_bytes / 2 ** 20:.2f} MiB)")
+        print(
+            f"prefill {num_tokens / sharded_time:.1f} tokens/s tensor parallel, "
+            f"{num_tokens / full_time:.1f} tokens/s single rank"
+        )
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DEEPSEEK")
+    parser.add_argument("--world_size", type=int, default=2, help="input the number of processes, unless under torchrun")
+    parser.add_argument("--batch_size", type=int, default=2, help="input the number of sequences")
+    parser.add_argument("--seq_len", type=int, default=64, help="input the prompt length")
+    parser.add_argument("--max_new_tokens", type=int, default=8, help="input the number of generated tokens")
+    parser.add_argument("--repeats", type=int, default=5, help="input the number of timed forward passes")
+    parser.add_argument("--port", type=int, default=29513, help="input the rendezvous port")
+    args = parser.parse_args()
+
+    if "RANK" in os.environ:
+        run(int(os.environ["RANK"]), args)
+    else:
+        mp.spawn(run, args=(args,), nprocs=args.world_size)
+
+
+"""
+python tensor_parallel.py --world_size 2 --batch_size 2 --seq_len 64
+torchrun --nproc_per_node 8 tensor_parallel.py --batch_size 4 --seq_len 256
+"""
@@ -0,0 +1,62 @@
+import os
+import sys
+
+import pytest
+import torch
+
+# the pipeline modules are imported top-level, as the scripts next to them do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from configuration_deepseek import DeepseekConfig  # noqa: E402
+from modeling_deepseek import DeepseekForCausalLM  # noqa: E402
+
+
+def tiny_config(**kwargs):
+    # dense layer 0, then MoE layers with 8 routed experts (top-2) and 2 shared experts
+    config = dict(
+        vocab_size=128,
+        hidden_size=64,
+        intermediate_size=96,
+        moe_intermediate_size=32,
+        num_hidden_layers=3,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        n_shared_experts=2,
+        n_routed_experts=8,
+        num_experts_per_tok=2,
+        first_k_dense_replace=1,
+        max_position_embeddings=128,
+        attn_implementation="eager",
+    )
+    config.update(kwargs)
+    return DeepseekConfig(**config)
+
+
+@pytest.fixture
+def base_model():
+    """The baseline: `nn.ModuleList` experts run by `moe_infer`, eager attention and the default dynamic cache."""
+    torch.manual_seed(0)
+    return DeepseekForCausalLM(tiny_config()).eval()
+
+
+@pytest.fixture
+def variant(base_model):
+    """Builds a model with config overrides and loads the weights of `base_model` into it."""
+
+    def build(**kwargs):
+        model = DeepseekForCausalLM(tiny_config(**kwargs)).eval()
+        model.load_state_dict(base_model.state_dict())
+        return model
+
+    return build
+
+
+@pytest.fixture
+def input_ids():
+    return torch.randint(0, 128, (2, 9), generator=torch.Generator().manual_seed(0))
+
+
+def greedy(model, input_ids, max_new_tokens = 6, **kwargs):
+    return model.generate(
+        input_ids, max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=0, eos_token_id=-1, **kwargs
+    )
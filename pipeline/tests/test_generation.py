@@ -0,0 +1,97 @@
+import time
+
+import pytest
+import torch
+
+from conftest import greedy
+from generation_engine import GenerationEngine
+from speculative import SelfSpeculativeDecoder
+
+
+def make_prompts(lengths, prefix = ()):
+    generator = torch.Generator().manual_seed(0)
+    return [list(prefix) + torch.randint(0, 128, (length,), generator=generator).tolist() for length in lengths]
+
+
+def reference_outputs(model, prompts, max_new_tokens):
+    return [greedy(model, torch.tensor([prompt]), max_new_tokens)[0, len(prompt):].tolist() for prompt in prompts]
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+@pytest.mark.parametrize(
+    "num_blocks, max_batch_tokens",
+    # chunked prefill with a small token budget, preemption with few blocks
+    [(64, 512), (16, 8), (9, 4)],
+)
+def test_engine_matches_generate(variant, attn_implementation, num_blocks, max_batch_tokens):
+    model = variant(attn_implementation=attn_implementation)
+    prompts = make_prompts((5, 23, 3, 9, 2))
+    engine = GenerationEngine(model, num_blocks, block_size=4, max_batch_tokens=max_batch_tokens, eos_token_id=-1)
+    assert engine.generate(prompts, max_new_tokens=6) == reference_outputs(model, prompts, 6)
+    assert engine.cache.num_free_blocks == num_blocks
+
+
+def test_engine_stream_and_cancel(base_model):
+    prompts = make_prompts((5, 9, 3))
+    reference = reference_outputs(base_model, prompts, 6)
+    engine = GenerationEngine(base_model, 64, block_size=4, eos_token_id=-1).start()
+    try:
+        request_ids = [engine.submit(prompt, 6) for prompt in prompts]
+        engine.cancel(request_ids[1])
+        outputs = [list(engine.stream(request_id)) for request_id in request_ids]
+    finally:
+        engine.stop()
+    assert outputs[0] == reference[0] and outputs[2] == reference[2]
+    # the background thread may get some tokens of the cancelled request out first
+    assert outputs[1] == reference[1][:len(outputs[1])]
+    assert engine.cache.num_free_blocks == 64
+
+
+def test_engine_waits_for_blocks(variant):
+    model = variant(attn_implementation="sdpa")
+    prefix = make_prompts((13,))[0]
+    engine = GenerationEngine(model, 4, block_size=4, eos_token_id=-1, prefix_cache=True)
+    engine.generate([prefix], max_new_tokens=2)
+    steps = []
+    step = engine.step
+    engine.step = lambda: steps.append(None) or step()
+    engine.start()
+    try:
+        # the cached prefix holds 3 of the 4 blocks, the rest of the prompt does not fit next to it
+        request_id = engine.submit(prefix + make_prompts((10,))[0], 2)
+        time.sleep(0.2)
+        assert len(steps) <= 1
+        engine.cancel(request_id)
+        assert list(engine.stream(request_id)) == []
+    finally:
+        engine.stop()
+
+
+def test_prefix_cache(variant):
+    model = variant(attn_implementation="sdpa")
+    prefix = make_prompts((13,))[0]
+    prompts = make_prompts((5, 2, 0, 9), prefix) + [prefix[:8]]
+    reference = reference_outputs(model, prompts, 6)
+    engine = GenerationEngine(model, 64, block_size=4, eos_token_id=-1, prefix_cache=True)
+    # one at a time, so that later prompts hit the blocks of earlier ones
+    assert [engine.generate([prompt], max_new_tokens=6)[0] for prompt in prompts] == reference
+    assert engine.generate(prompts, max_new_tokens=6) == reference
+    prefix_cache = engine.prefix_cache
+    assert prefix_cache.hit_rate > 0
+    assert engine.cache.num_free_blocks + prefix_cache.num_blocks == 64
+    prefix_cache.clear()
+    assert engine.cache.num_free_blocks == 64
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+@pytest.mark.parametrize(
+    "kwargs",
+    [{"skip_layers": [1]}, {"skip_routed_experts": True}, {"skip_layers": [0], "skip_routed_experts": True}],
+)
+def test_speculative_greedy_matches_generate(variant, attn_implementation, kwargs):
+    model = variant(attn_implementation=attn_implementation)
+    input_ids = torch.randint(0, 128, (1, 9), generator=torch.Generator().manual_seed(0))
+    reference = greedy(model, input_ids, max_new_tokens=12)[0, 9:].tolist()
+    decoder = SelfSpeculativeDecoder(model, num_draft_tokens=3, **kwargs)
+    assert decoder.generate(input_ids, 12, eos_token_id=-1) == reference
+    assert 0 <= decoder.acceptance_rate <= 1
@@ -0,0 +1,101 @@
+import pytest
+import torch
+
+from conftest import greedy
+from modeling_deepseek import DeepseekPagedCache, DeepseekQuantizedCache, DeepseekStaticCache
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+def test_static_cache_matches_dynamic(variant, input_ids, attn_implementation):
+    model = variant(attn_implementation=attn_implementation)
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, :3] = 0
+    reference = greedy(model, input_ids, attention_mask=attention_mask)
+    assert torch.equal(greedy(model, input_ids, attention_mask=attention_mask, cache_implementation="static"), reference)
+    cache = DeepseekStaticCache(model.config, 2, 32)
+    assert torch.equal(greedy(model, input_ids, attention_mask=attention_mask, past_key_values=cache), reference)
+    assert model._static_cache is None
+
+
+def test_static_cache_is_dropped_when_generate_raises(base_model, input_ids):
+    reference = greedy(base_model, input_ids)
+    forward = base_model.model.forward
+    calls = []
+
+    def failing_forward(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == 3:
+            raise RuntimeError("failed decode step")
+        return forward(*args, **kwargs)
+
+    base_model.model.forward = failing_forward
+    with pytest.raises(RuntimeError, match="failed decode step"):
+        greedy(base_model, input_ids, cache_implementation="static")
+    base_model.model.forward = forward
+    assert base_model._static_cache is None
+    assert torch.equal(greedy(base_model, input_ids), reference)
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+def test_paged_cache_matches_generate(variant, attn_implementation):
+    model = variant(attn_implementation=attn_implementation)
+    generator = torch.Generator().manual_seed(0)
+    prompts = [torch.randint(0, 128, (length,), generator=generator) for length in (5, 11, 3)]
+    reference = [greedy(model, prompt[None], max_new_tokens=5)[0, len(prompt):].tolist() for prompt in prompts]
+
+    cache = DeepseekPagedCache(model.config, num_blocks=16, block_size=4)
+    seq_ids = list(range(len(prompts)))
+    for seq_id in seq_ids:
+        cache.add_sequence(seq_id)
+    # right-padded prefill, then one token per sequence and step
+    inputs = torch.zeros(len(prompts), max(len(prompt) for prompt in prompts), dtype=torch.long)
+    for row, prompt in enumerate(prompts):
+        inputs[row, :len(prompt)] = prompt
+    attention_mask, position_ids = cache.begin_step(seq_ids, [len(prompt) for prompt in prompts])
+    with torch.no_grad():
+        logits = model(
+            input_ids=inputs, attention_mask=attention_mask, position_ids=position_ids, past_key_values=cache, use_cache=True
+        ).logits
+    next_tokens = torch.stack([logits[row, len(prompt) - 1].argmax() for row, prompt in enumerate(prompts)])
+    generated = [[token.item()] for token in next_tokens]
+    for _ in range(4):
+        attention_mask, position_ids = cache.begin_step(seq_ids, [1] * len(prompts))
+        with torch.no_grad():
+            logits = model(
+                input_ids=next_tokens[:, None],
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=cache,
+                use_cache=True,
+            ).logits
+        next_tokens = logits[:, -1].argmax(-1)
+        for tokens, token in zip(generated, next_tokens):
+            tokens.append(token.item())
+    assert generated == reference
+
+    for seq_id in seq_ids:
+        cache.free_sequence(seq_id)
+    assert cache.num_free_blocks == 16
+
+
+@pytest.mark.parametrize("attn_implementation", ["eager", "sdpa"])
+def test_quantized_cache(variant, attn_implementation):
+    model = variant(attn_implementation=attn_implementation)
+    input_ids = torch.randint(0, 128, (2, 40), generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        reference = model(input_ids).logits
+        # blocks larger than the prompt are never quantized, the cache is then exact
+        exact = model(input_ids, past_key_values=DeepseekQuantizedCache(block_size=64), use_cache=True).logits
+        cache = DeepseekQuantizedCache(block_size=8, read_blocks=2)
+        prefill = model(input_ids[:, :-4], past_key_values=cache, use_cache=True).logits
+        decode = [model(input_ids[:, i:i + 1], past_key_values=cache, use_cache=True).logits for i in range(36, 40)]
+    torch.testing.assert_close(exact, reference, rtol=0, atol=1e-5)
+    # the prefill attends to its own states before they are quantized
+    torch.testing.assert_close(prefill, reference[:, :-4], rtol=0, atol=1e-5)
+    assert cache.get_seq_length() == 40
+    # the decode steps attend to 4 int8 blocks of 8 positions
+    error = (torch.cat(decode, dim=1) - reference[:, -4:]).abs().max()
+    assert error < 0.02 * reference.abs().max()
+
+    model.config.kv_cache_dtype = "int8"
+    assert greedy(model, input_ids[:, :8]).shape == (2, 14)
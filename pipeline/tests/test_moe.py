@@ -0,0 +1,124 @@
+import pytest
+import safetensors.torch
+import torch
+
+from conftest import greedy
+from modeling_deepseek import DeepseekForCausalLM, DeepseekMoE
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"moe_grouped_gemm": True},
+        {"moe_static_routing": True},
+        {"fuse_gate_up_proj": True},
+        {"fuse_gate_up_proj": True, "moe_grouped_gemm": True},
+    ],
+)
+def test_dispatch_matches_moe_infer(base_model, variant, input_ids, kwargs):
+    model = variant(**kwargs)
+    with torch.no_grad():
+        torch.testing.assert_close(model(input_ids).logits, base_model(input_ids).logits, rtol=0, atol=1e-5)
+        # decode steps route a single token per row
+        torch.testing.assert_close(model(input_ids[:, :1]).logits, base_model(input_ids[:, :1]).logits, rtol=0, atol=1e-5)
+    assert torch.equal(greedy(model, input_ids), greedy(base_model, input_ids))
+
+
+@pytest.mark.parametrize("per_expert_devices", [("cpu",), ()])
+@pytest.mark.parametrize("num_tokens", [2, 6])
+def test_grouped_dispatch_over_active_experts(base_model, variant, input_ids, num_tokens, per_expert_devices):
+    # a few active experts with uneven loads and a dropped assignment (index 8), below and above 8 pairs
+    expert_ids = torch.tensor([1, 5, 5, 8, 1, 3, 5, 1, 3, 8, 5, 1])[:2 * num_tokens]
+    weights = torch.rand(2 * num_tokens, 1, generator=torch.Generator().manual_seed(0))
+    weights = weights.masked_fill(expert_ids[:, None] == 8, 0)
+    x = torch.randn(num_tokens, 64, generator=torch.Generator().manual_seed(0))
+    model = variant(moe_grouped_gemm=True)
+    for layer in model.model.layers[1:]:
+        # batched over the active experts on the CPU too, as on an accelerator
+        layer.mlp.experts.per_expert_devices = per_expert_devices
+    expected = base_model.model.layers[1].mlp.moe_infer(x, expert_ids, weights)
+    with torch.no_grad():
+        output = model.model.layers[1].mlp.grouped_experts_forward(x, expert_ids, weights)
+        torch.testing.assert_close(output, expected, rtol=0, atol=1e-6)
+    assert torch.equal(greedy(model, input_ids), greedy(base_model, input_ids))
+
+
+def test_group_experts_in_place(base_model, variant, input_ids):
+    model = variant()
+    for layer in model.model.layers:
+        if isinstance(layer.mlp, DeepseekMoE):
+            layer.mlp.group_experts()
+    with torch.no_grad():
+        torch.testing.assert_close(model(input_ids).logits, base_model(input_ids).logits, rtol=0, atol=1e-5)
+
+
+def test_sorted_dispatch_training(base_model, variant, input_ids):
+    with torch.no_grad():
+        reference = base_model(input_ids).logits
+    grouped = variant(moe_grouped_gemm=True)
+    base_model.train()
+    grouped.train()
+    output = base_model(input_ids, labels=input_ids)
+    torch.testing.assert_close(output.logits, reference, rtol=0, atol=1e-5)
+    output.loss.backward()
+    grouped(input_ids, labels=input_ids).loss.backward()
+
+    experts = base_model.model.layers[1].mlp.experts
+    grads = torch.stack([
+        expert.down_proj.weight.grad if expert.down_proj.weight.grad is not None else torch.zeros_like(expert.down_proj.weight)
+        for expert in experts
+    ])
+    torch.testing.assert_close(grouped.model.layers[1].mlp.experts.down_proj.grad, grads, rtol=0, atol=1e-6)
+
+
+def test_capacity_without_overflow_is_a_no_op(base_model, variant, input_ids):
+    model = variant(moe_capacity_factor=8.0)
+    with torch.no_grad():
+        torch.testing.assert_close(model(input_ids).logits, base_model(input_ids).logits, rtol=0, atol=1e-5)
+    assert model.model.layers[1].mlp.gate.dropped_assignments.item() == 0
+    assert model.model.layers[1].mlp.gate.dropped_tokens.item() == 0
+
+
+@pytest.mark.parametrize("policy", ["drop", "reroute"])
+def test_capacity_overflow(variant, input_ids, policy):
+    reference = variant(moe_capacity_factor=0.5, moe_overflow_policy=policy)
+    gate = reference.model.layers[1].mlp.gate
+    routed = []
+    hook = gate.register_forward_hook(lambda module, input, output: routed.append(output[0]))
+    with torch.no_grad():
+        expected = reference(input_ids).logits
+    hook.remove()
+    dropped = routed[0] == 8
+    assert gate.dropped_assignments.item() == dropped.sum().item()
+    assert gate.dropped_tokens.item() == dropped.all(dim=1).sum().item()
+    if policy == "drop":
+        assert gate.dropped_assignments.item() > 0
+    for kwargs in ({"moe_grouped_gemm": True}, {"moe_static_routing": True}):
+        model = variant(moe_capacity_factor=0.5, moe_overflow_policy=policy, **kwargs)
+        with torch.no_grad():
+            torch.testing.assert_close(model(input_ids).logits, expected, rtol=0, atol=1e-5)
+        assert torch.equal(model.model.layers[1].mlp.gate.dropped_assignments, gate.dropped_assignments)
+        assert torch.equal(model.model.layers[1].mlp.gate.dropped_tokens, gate.dropped_tokens)
+
+
+def test_fused_gate_up_needs_both_halves(base_model, variant, input_ids, tmp_path):
+    state_dict = base_model.state_dict()
+    missing = {key: value for key, value in state_dict.items() if key != "model.layers.1.mlp.experts.3.up_proj.weight"}
+    model = variant(fuse_gate_up_proj=True)
+    with pytest.raises(RuntimeError, match="experts.3.gate_up_proj.weight"):
+        model.load_state_dict(missing)
+
+    # halves coming in separate calls, as from different checkpoint shards
+    model.load_state_dict({key: value for key, value in state_dict.items() if "up_proj" not in key}, strict=False)
+    model.load_state_dict({key: value for key, value in state_dict.items() if "up_proj" in key}, strict=False)
+    with torch.no_grad():
+        torch.testing.assert_close(model(input_ids).logits, base_model(input_ids).logits, rtol=0, atol=1e-5)
+
+    # a checkpoint without the other half
+    base_model.save_pretrained(tmp_path)
+    state_dict = safetensors.torch.load_file(tmp_path / "model.safetensors")
+    del state_dict["model.layers.1.mlp.experts.3.up_proj.weight"]
+    safetensors.torch.save_file(state_dict, tmp_path / "model.safetensors", metadata={"format": "pt"})
+    for load in (DeepseekForCausalLM.from_pretrained, DeepseekForCausalLM.from_checkpoint):
+        with pytest.raises(ValueError, match="experts.3.gate_proj.weight"):
+            load(tmp_path, fuse_gate_up_proj=True)
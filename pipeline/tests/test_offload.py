@@ -0,0 +1,100 @@
+import gc
+
+import numpy as np
+import pytest
+import torch
+
+from conftest import greedy, tiny_config
+from expert_prefetch import CoactivationPredictor, ExpertPrefetcher
+from modeling_deepseek import DeepseekExpertCache, DeepseekExpertStore, DeepseekForCausalLM
+
+
+def offloaded(base_model, store_dir, max_bytes = None):
+    model = DeepseekForCausalLM(tiny_config(moe_offload_dir=str(store_dir), moe_offload_max_bytes=max_bytes)).eval()
+    state_dict = {key: value for key, value in base_model.state_dict().items() if ".mlp.experts." not in key}
+    model.load_state_dict(state_dict)
+    return model
+
+
+def test_offloaded_experts_match_resident(base_model, input_ids, tmp_path):
+    DeepseekExpertStore.save(tmp_path / "store", base_model)
+    base_model.save_pretrained(tmp_path / "model", max_shard_size="100KB")
+    DeepseekExpertStore.save_from_checkpoint(tmp_path / "from_checkpoint", tmp_path / "model")
+    for layer_idx in (1, 2):
+        saved = torch.load(DeepseekExpertStore.layer_file(tmp_path / "store", layer_idx))
+        converted = torch.load(DeepseekExpertStore.layer_file(tmp_path / "from_checkpoint", layer_idx))
+        assert saved.keys() == converted.keys()
+        assert all(torch.equal(saved[name], converted[name]) for name in saved)
+
+    # an expert and a half fit, every layer misses and evicts
+    expert_bytes = 3 * 64 * 32 * 4
+    model = offloaded(base_model, tmp_path / "store", max_bytes=expert_bytes * 3 // 2)
+    with torch.no_grad():
+        torch.testing.assert_close(model(input_ids).logits, base_model(input_ids).logits, rtol=0, atol=1e-5)
+    assert torch.equal(greedy(model, input_ids), greedy(base_model, input_ids))
+    cache = model.model.layers[1].mlp.experts.store.cache
+    assert len(cache) == 1 and cache.evictions > 0
+
+    model.train()
+    with pytest.raises(ValueError):
+        model(input_ids)
+
+
+
+def test_stores_are_shared_per_budget(base_model, tmp_path):
+    DeepseekExpertStore.save(tmp_path, base_model)
+    first, second = offloaded(base_model, tmp_path), offloaded(base_model, tmp_path)
+    bounded = offloaded(base_model, tmp_path, max_bytes=1 << 20)
+    store = first.model.layers[1].mlp.experts.store
+    assert second.model.layers[2].mlp.experts.store is store
+    assert bounded.model.layers[1].mlp.experts.store is not store
+    assert bounded.model.layers[1].mlp.experts.store.cache.max_bytes == 1 << 20
+
+    del first, second, bounded, store
+    gc.collect()
+    assert len(DeepseekExpertStore._stores) == 0
+
+
+def test_prefetcher_keeps_outputs(base_model, input_ids, tmp_path):
+    DeepseekExpertStore.save(tmp_path, base_model)
+    model = offloaded(base_model, tmp_path)
+    routing = np.random.default_rng(0).integers(0, 8, size=(2, 50, 2))
+    predictor = CoactivationPredictor(2, 8).fit([routing])
+    assert predictor.counts.sum() == 50 * 2 * 2
+    with torch.no_grad(), ExpertPrefetcher(model, predictor, num_predicted=3):
+        logits = model(input_ids).logits
+    torch.testing.assert_close(logits, base_model(input_ids).logits, rtol=0, atol=1e-5)
+    # the guesses are loaded on top of the missed experts, without counting as lookups
+    cache = model.model.layers[2].mlp.experts.store.cache
+    assert len(cache) >= cache.misses
+
+
+def test_prefetch_is_not_a_lookup():
+    weights = {"weight": torch.zeros(4)}
+    cache = DeepseekExpertCache(max_bytes=None)
+    cache.prefetch("guess", lambda: weights)
+    cache.prefetch("guess", lambda: pytest.fail("loaded twice"))
+    assert "guess" in cache and (cache.hits, cache.misses) == (0, 0)
+    assert cache.get("guess", lambda: pytest.fail("missed")) is weights
+    assert (cache.hits, cache.misses) == (1, 0)
+
+
+def test_prefetch_never_evicts():
+    weights = {"weight": torch.zeros(4)}
+    cache = DeepseekExpertCache(max_bytes=32)
+    cache.get("used", lambda: weights)
+    cache.prefetch("guess", lambda: weights)
+    # full: a further guess is not loaded
+    cache.prefetch("skipped", lambda: pytest.fail("loaded into a full cache"))
+    assert "guess" in cache and "skipped" not in cache
+    assert (cache.hits, cache.misses, cache.evictions) == (0, 1, 0)
+
+    # the guess went in at the least recently used end, a new expert evicts it first
+    cache.get("other", lambda: weights)
+    assert "used" in cache and "guess" not in cache and cache.evictions == 1
+
+    # a guess larger than the room left is dropped
+    cache = DeepseekExpertCache(max_bytes=24)
+    cache.get("used", lambda: weights)
+    cache.prefetch("guess", lambda: weights)
+    assert "guess" not in cache and cache.num_bytes == 16
@@ -0,0 +1,91 @@
+import os
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from conftest import greedy, tiny_config
+from modeling_deepseek import DeepseekForCausalLM, DeepseekMoE
+from pipeline_parallel import PipelineStage, partition_layers
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run(rank, port, check):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=2)
+    torch.manual_seed(0)
+    check(rank, DeepseekForCausalLM(tiny_config()).eval())
+    # no `destroy_process_group()`: after point-to-point sends, gloo may hang tearing the group down while the other
+    # rank exits, the group goes with the spawned process
+
+
+def spawn(check):
+    mp.spawn(run, args=(free_port(), check), nprocs=2)
+
+
+def check_tensor_parallel(rank, model):
+    input_ids = torch.randint(0, 128, (2, 9), generator=torch.Generator().manual_seed(0))
+    sharded = DeepseekForCausalLM(tiny_config(tensor_parallel=True)).eval()
+    sharded.load_state_dict(model.state_dict())
+    with torch.no_grad():
+        torch.testing.assert_close(sharded(input_ids).logits, model(input_ids).logits, rtol=0, atol=1e-5)
+    assert torch.equal(greedy(sharded, input_ids), greedy(model, input_ids))
+
+
+def check_expert_parallel(rank, model):
+    # every rank runs its own tokens, the experts are split between the ranks
+    input_ids = torch.randint(0, 128, (2, 9), generator=torch.Generator().manual_seed(rank))
+    sharded = DeepseekForCausalLM(tiny_config(moe_expert_parallel=True)).eval()
+    sharded.load_state_dict(model.state_dict())
+    assert sorted(sharded.model.layers[1].mlp.experts) == [str(expert_idx) for expert_idx in range(4 * rank, 4 * rank + 4)]
+    with torch.no_grad():
+        torch.testing.assert_close(sharded(input_ids).logits, model(input_ids).logits, rtol=0, atol=1e-5)
+    assert torch.equal(greedy(sharded, input_ids), greedy(model, input_ids))
+
+    # sharding a loaded model in place trains as the full model on both ranks' tokens
+    model.train()
+    model(input_ids, labels=input_ids).loss.backward()
+    grad = model.model.layers[1].mlp.experts[5].down_proj.weight.grad.clone()
+    dist.all_reduce(grad)
+    model.zero_grad()
+    for layer in model.model.layers:
+        if isinstance(layer.mlp, DeepseekMoE):
+            layer.mlp.shard_experts()
+    model(input_ids, labels=input_ids).loss.backward()
+    if rank == 1:
+        torch.testing.assert_close(model.model.layers[1].mlp.experts["5"].down_proj.weight.grad, grad, rtol=1e-4, atol=1e-6)
+
+
+def check_pipeline_parallel(rank, model):
+    input_ids = torch.randint(0, 128, (4, 9), generator=torch.Generator().manual_seed(0))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[::2, :3] = 0
+    reference = greedy(model, input_ids, attention_mask=attention_mask, min_new_tokens=6)
+    stage = PipelineStage(model)
+    assert stage.stages == partition_layers(model.config, 2) and len(model.model.layers) < 3
+    for num_micro_batches in (2, 1):
+        assert torch.equal(stage.generate(input_ids, attention_mask, 6, num_micro_batches), reference)
+
+
+def test_partition_layers():
+    config = tiny_config(num_hidden_layers=6)
+    for num_stages in range(1, 7):
+        stages = partition_layers(config, num_stages)
+        assert len(stages) == num_stages and stages[0][0] == 0 and stages[-1][1] == 6
+        assert all(start < end for start, end in stages)
+        assert all(end == start for (_, end), (start, _) in zip(stages, stages[1:]))
+    with pytest.raises(ValueError):
+        partition_layers(config, 7)
+
+
+@pytest.mark.parametrize("check", [check_tensor_parallel, check_expert_parallel, check_pipeline_parallel])
+def test_parallel_matches_single_process(check):
+    spawn(check)
@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+import torch
+from torch import nn
+
+from conftest import greedy, tiny_config
+from modeling_deepseek import DeepseekForCausalLM, DeepseekQuantLinear, quantize_expert_state_dict
+from precision_plan import PrecisionPlan, expert_nbytes, plan_precision, quantization_errors
+
+
+def reference_output(module, x):
+    return (x.float() @ module.dequantize().t()).to(x.dtype)
+
+
+@pytest.mark.parametrize("bits, group_size", [(8, None), (8, 32), (4, None), (4, 32), (4, 16)])
+@pytest.mark.parametrize("num_rows", [1, 5, DeepseekQuantLinear.kernel_rows + 8])
+@pytest.mark.parametrize("dtype", [torch.bfloat16, torch.float32])
+def test_quant_linear_paths(bits, group_size, num_rows, dtype):
+    # packed kernels (bf16, few rows) and blockwise dequantization (otherwise) compute the same product
+    torch.manual_seed(0)
+    linear = nn.Linear(128, 96, bias=False)
+    module = DeepseekQuantLinear.from_linear(linear, bits, group_size)
+    module.block_rows = 40
+    x = torch.randn(num_rows, 128).to(dtype)
+    output = module(x)
+    assert output.shape == (num_rows, 96) and output.dtype == dtype
+    torch.testing.assert_close(output.float(), reference_output(module, x).float(), rtol=2e-2, atol=2e-2)
+    error = (module.dequantize() - linear.weight).abs().max() / linear.weight.abs().max()
+    assert error < (0.01 if bits == 8 else 0.1)
+
+
+def test_quant_linear_group_size():
+    assert DeepseekQuantLinear(128, 8, bits=8).group_size == 128
+    assert DeepseekQuantLinear(256, 8, bits=4).group_size == 128
+    assert DeepseekQuantLinear(64, 8, bits=4).group_size == 64
+    with pytest.raises(ValueError):
+        DeepseekQuantLinear(96, 8, bits=8, group_size=64)
+
+
+def test_int4_keeps_portable_weight():
+    torch.manual_seed(0)
+    module = DeepseekQuantLinear.from_linear(nn.Linear(128, 64, bias=False), bits=4)
+    qweight = module.qweight.clone()
+    x = torch.randn(2, 128, dtype=torch.bfloat16)
+    output = module(x)
+    assert torch.equal(module.qweight, qweight)
+    assert set(module.state_dict()) == {"qweight", "scales", "zeros"}
+    reloaded = DeepseekQuantLinear(128, 64, bits=4)
+    reloaded.load_state_dict(module.state_dict())
+    assert torch.equal(reloaded(x), output)
+
+
+def test_quantized_experts(base_model, variant, input_ids):
+    experts = {1: [0, 3, 5], 2: [1, 2]}
+    quantized = variant()
+    quantized.model.quantize_experts(experts, bits=8)
+    with torch.no_grad():
+        reference = base_model(input_ids).logits
+        logits = quantized(input_ids).logits
+    assert (logits - reference).abs().max() < 0.02 * reference.abs().max()
+    assert quantized.config.expert_precisions == {1: {0: "int8", 3: "int8", 5: "int8"}, 2: {1: "int8", 2: "int8"}}
+
+    # a model built for the variant loads the converted bf16 checkpoint
+    loaded = DeepseekForCausalLM(tiny_config(expert_precisions=quantized.config.expert_precisions)).eval()
+    loaded.load_state_dict(quantize_expert_state_dict(base_model.state_dict(), bits=8, experts=experts))
+    with torch.no_grad():
+        torch.testing.assert_close(loaded(input_ids).logits, logits, rtol=0, atol=1e-6)
+    assert torch.equal(greedy(loaded, input_ids), greedy(quantized, input_ids))
+
+
+def test_precision_plan(base_model, input_ids):
+    num_params = 3 * 64 * 32
+    load = np.random.default_rng(0).random((2, 8))
+    budget = 8 * expert_nbytes(num_params, "int8") + 6 * expert_nbytes(num_params, "int4")
+    plan = plan_precision(budget, num_params, [1, 2], load=load, min_experts=4)
+    assert plan.nbytes(num_params) <= budget
+    assert all(layer.count("pruned") <= 4 for layer in plan.layers.values())
+    # the least loaded experts are reduced first
+    for layer, precisions in zip(load, plan.layers.values()):
+        ranks = [["bf16", "int8", "int4", "pruned"].index(precision) for precision in precisions]
+        assert ranks[int(layer.argmax())] == min(ranks)
+
+    plan.apply(base_model)
+    base_model.model.update_expert_config()
+    expected = {
+        layer_idx: {expert_idx: precision for expert_idx, precision in enumerate(precisions) if precision != "bf16"}
+        for layer_idx, precisions in plan.layers.items()
+    }
+    assert base_model.config.expert_precisions == {layer_idx: layer for layer_idx, layer in expected.items() if layer}
+    with torch.no_grad():
+        assert torch.isfinite(base_model(input_ids).logits).all()
+
+
+def test_quantization_errors(variant):
+    model = variant()
+    errors = quantization_errors(model, group_size=32)
+    assert errors.shape == (2, 8, 4)
+    assert (errors[..., 0] == 0).all() and (errors[..., 3] == 1).all()
+    assert (0 < errors[..., 1]).all() and (errors[..., 1] < errors[..., 2]).all() and (errors[..., 2] < 1).all()
+    # the error of the weights the quantized expert actually holds
+    expert = model.model.layers[2].mlp.experts[5]
+    weights = [weight.clone() for weight in (*expert.gate_up_weights(), expert.down_proj.weight)]
+    expert.quantize(4, 32)
+    dequantized = [expert.gate_proj.dequantize(), expert.up_proj.dequantize(), expert.down_proj.dequantize()]
+    error = sum((quantized - weight).pow(2).sum() for quantized, weight in zip(dequantized, weights)).sqrt()
+    norm = sum(weight.pow(2).sum() for weight in weights).sqrt()
+    assert errors[1, 5, 2] == pytest.approx((error / norm).item(), rel=1e-5)
+
+    # an expert that quantizes badly keeps its precision
+    num_params = 3 * 64 * 32
+    errors[0, 3, 1:] = 1
+    budget = 8 * expert_nbytes(num_params, "int8") + 8 * expert_nbytes(num_params, "int4")
+    plan = plan_precision(budget, num_params, [1, 2], load=np.ones((2, 8)), errors=errors)
+    assert plan.layers[1][3] == "bf16" and "bf16" not in plan.layers[1][:3] + plan.layers[1][4:]
+
+
+def test_precision_plan_save_load(tmp_path):
+    plan = PrecisionPlan({1: ["bf16", "int8", "int4", "pruned"]}, group_size=32)
+    plan.save(tmp_path / "plan.json")
+    loaded = PrecisionPlan.load(tmp_path / "plan.json")
+    assert loaded.layers == plan.layers and loaded.group_size == 32
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+import torch
+
+from modeling_deepseek import DeepseekMoE
+from routing_stats import RoutingStats
+from routing_trace import RoutingTrace
+
+
+def record(model, samples, **kwargs):
+    recorder = model.model.start_routing_trace(**kwargs)
+    with torch.no_grad():
+        for sample in samples:
+            recorder.new_sample()
+            model(sample[None])
+    return model.model.stop_routing_trace()
+
+
+def test_recorder_matches_gate_hooks(base_model):
+    generator = torch.Generator().manual_seed(0)
+    samples = [torch.randint(0, 128, (length,), generator=generator) for length in (7, 3, 12)]
+    # the gate forward hooks the recorder replaces
+    routing = {}
+    hooks = [
+        layer.mlp.gate.register_forward_hook(
+            lambda module, input, output, layer_idx=layer_idx: routing.setdefault(layer_idx, []).append(output[:2])
+        )
+        for layer_idx, layer in enumerate(base_model.model.layers)
+        if isinstance(layer.mlp, DeepseekMoE)
+    ]
+    recorder = record(base_model, samples)
+    for hook in hooks:
+        hook.remove()
+
+    assert recorder.layer_ids == [1, 2] and recorder.num_tokens == 22
+    assert recorder.sample_offsets == [0, 7, 10]
+    np.testing.assert_array_equal(recorder.positions[7:10], np.arange(3))
+    for column, layer_idx in enumerate(recorder.layer_ids):
+        topk_idx, topk_weight = (torch.cat(outputs) for outputs in zip(*routing[layer_idx]))
+        np.testing.assert_array_equal(recorder.expert_ids[:, column], topk_idx.numpy())
+        np.testing.assert_array_equal(recorder.weights[:, column], topk_weight.half().numpy())
+    expert_ids, weights = recorder.sample(1)
+    assert expert_ids.shape == weights.shape == (2, 3, 2)
+    assert base_model.model.routing_recorder is None
+
+
+def test_flushed_trace_matches_recorder(base_model, tmp_path):
+    generator = torch.Generator().manual_seed(0)
+    samples = [torch.randint(0, 128, (length,), generator=generator) for length in (7, 3, 12)]
+    recorder = record(base_model, samples)
+    # flushed every few tokens, so the columns are appended to several times
+    flushed = record(base_model, samples, flush_dir=str(tmp_path), flush_tokens=4)
+    assert flushed.num_tokens == 0
+
+    trace = RoutingTrace(str(tmp_path))
+    assert trace.layer_ids == [1, 2] and trace.num_samples == 3 and trace.num_tokens == 22
+    for layer in range(trace.num_layers):
+        np.testing.assert_array_equal(trace.expert_ids(layer), recorder.expert_ids[:, layer])
+        np.testing.assert_array_equal(trace.weights(layer), recorder.weights[:, layer])
+    np.testing.assert_array_equal(trace.positions(1), np.arange(3))
+    for sample_idx in range(3):
+        np.testing.assert_array_equal(trace.sample(sample_idx), recorder.sample(sample_idx)[0])
+
+    with pytest.raises(ValueError, match="not empty"):
+        record(base_model, samples, flush_dir=str(tmp_path))
+    # only the files of the previous trace are removed
+    (tmp_path / "config.json").write_text("{}")
+    record(base_model, samples[:1], flush_dir=str(tmp_path), overwrite=True)
+    assert RoutingTrace(str(tmp_path)).num_tokens == 7
+    assert (tmp_path / "config.json").exists()
+
+
+def test_routing_stats(base_model, tmp_path):
+    samples = [torch.randint(0, 128, (10,), generator=torch.Generator().manual_seed(0))]
+    record(base_model, samples, flush_dir=str(tmp_path))
+    stats = RoutingStats.from_trace(RoutingTrace(str(tmp_path)), chunk_tokens=3)
+    assert stats.counts.shape == (2, 8)
+    assert (stats.counts.sum(axis=1) == 10 * 2).all()
+    # each token pairs its two experts both ways
+    assert (stats.cooccurrence.sum(axis=(1, 2)) == 10 * 2).all()
+    np.testing.assert_allclose(stats.load().sum(axis=1), 1)
+
+    dropped = RoutingStats(1, num_experts=4).update(0, [[0, 4], [1, 0]])
+    assert dropped.counts.tolist() == [[2, 1, 0, 0]]
+    assert (dropped + dropped).counts.tolist() == [[4, 2, 0, 0]]
+
+
+def test_trace_records_expert_copies(variant, tmp_path):
+    model = variant(expert_replicas={1: {0: 2}, 2: {3: 1}})
+    samples = [torch.randint(0, 128, (40,), generator=torch.Generator().manual_seed(0))]
+    record(model, samples, flush_dir=str(tmp_path))
+    trace = RoutingTrace(str(tmp_path))
+    # the copies get expert ids of their own, from `n_routed_experts` on
+    assert trace.num_experts == 10
+    assert (trace.expert_ids(0) >= 8).any()
+    stats = RoutingStats.from_trace(trace)
+    assert stats.counts.shape == (2, 10) and (stats.counts.sum(axis=1) == 40 * 2).all()
@@ -0,0 +1,99 @@
+import pytest
+import torch
+
+from conftest import greedy
+from modeling_deepseek import DeepseekForCausalLM, DeepseekMLP
+
+
+def logits(model, input_ids):
+    with torch.no_grad():
+        return model(input_ids).logits
+
+
+@pytest.mark.parametrize("policy", ["hash", "least_loaded"])
+@pytest.mark.parametrize("kwargs", [{}, {"moe_grouped_gemm": True}])
+def test_replicas_match_base(base_model, variant, input_ids, policy, kwargs):
+    reference = logits(base_model, input_ids)
+    replicas = {1: {0: 2, 5: 1}, 2: {3: 1}}
+    built = variant(expert_replicas=replicas, expert_replica_policy=policy, **kwargs)
+    assert len(built.model.layers[1].mlp.experts) == 11
+    routed = []
+    hook = built.model.layers[1].mlp.gate.register_forward_hook(lambda module, input, output: routed.append(output[0]))
+    first = logits(built, input_ids)
+    hook.remove()
+    torch.testing.assert_close(first, reference, rtol=0, atol=1e-5)
+    # the copies take some of the assignments of their expert
+    assert (routed[0] >= 8).any()
+    # the copy a token goes to does not depend on what ran before
+    logits(built, input_ids[:, :4])
+    assert torch.equal(logits(built, input_ids), first)
+    assert torch.equal(greedy(built, input_ids), greedy(base_model, input_ids))
+
+    if not kwargs:
+        model = variant(expert_replica_policy=policy)
+        model.model.replicate_experts(replicas)
+        assert model.config.expert_replicas == replicas
+        torch.testing.assert_close(logits(model, input_ids), reference, rtol=0, atol=1e-5)
+        model.model.replicate_experts({1: {}, 2: {}})
+        assert not model.config.expert_replicas and len(model.model.layers[1].mlp.experts) == 8
+
+
+def test_reorder_and_replace_keep_logits(base_model, variant, input_ids):
+    reference = logits(base_model, input_ids)
+    model = variant(expert_replicas={1: {2: 1}})
+    model.model.reorder_experts({1: [7, 2, 0, 1, 3, 4, 6, 5]})
+    torch.testing.assert_close(logits(model, input_ids), reference, rtol=0, atol=1e-5)
+
+    base_moe = base_model.model.layers[2].mlp
+    expert = DeepseekMLP(model.config, intermediate_size=model.config.moe_intermediate_size)
+    expert.load_state_dict(base_moe.experts[4].state_dict())
+    model.model.replace_expert(2, 4, expert, gate_weight=base_moe.gate.weight[4])
+    model.model.replace_expert(1, 1, base_model.model.layers[1].mlp.experts[2].state_dict())
+    torch.testing.assert_close(logits(model, input_ids), reference, rtol=0, atol=1e-5)
+    with pytest.raises(ValueError):
+        model.model.replace_expert(1, 8, expert)
+
+
+@pytest.mark.parametrize("bits", [None, 8, 4])
+def test_replace_pruned_expert(base_model, variant, input_ids, bits):
+    model = variant()
+    model.model.prune_experts({1: [3, 6]})
+    assert model.config.expert_precisions == {1: {3: "pruned", 6: "pruned"}}
+    pruned = logits(model, input_ids)
+    assert not torch.allclose(pruned, logits(base_model, input_ids))
+
+    source = variant()
+    if bits is not None:
+        source.model.quantize_experts({1: [3, 6]}, bits=bits)
+    for expert_idx in (3, 6):
+        model.model.replace_expert(1, expert_idx, source.model.layers[1].mlp.experts[expert_idx].state_dict())
+    assert model.config.expert_precisions == source.config.expert_precisions
+    assert model.model.layers[1].mlp.gate.expert_mask is None or not model.model.layers[1].mlp.gate.expert_mask.any()
+    torch.testing.assert_close(logits(model, input_ids), logits(source, input_ids), rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("load", ["from_pretrained", "from_checkpoint"])
+def test_save_and_reload_variant(variant, input_ids, tmp_path, load):
+    model = variant(expert_replicas={1: {0: 1}})
+    model.model.quantize_experts({1: [1, 2], 2: [5]}, bits=8)
+    model.model.quantize_experts({2: [0]}, bits=4)
+    model.model.prune_experts({2: [7]})
+    model.save_pretrained(tmp_path)
+    reloaded = getattr(DeepseekForCausalLM, load)(tmp_path).eval()
+    assert reloaded.config.expert_replicas == {1: {0: 1}}
+    assert reloaded.config.expert_precisions == model.config.expert_precisions
+    torch.testing.assert_close(logits(reloaded, input_ids), logits(model, input_ids), rtol=0, atol=1e-6)
+    assert torch.equal(greedy(reloaded, input_ids), greedy(model, input_ids))
+
+
+def test_from_checkpoint(base_model, input_ids, tmp_path):
+    base_model.save_pretrained(tmp_path / "model", max_shard_size="100KB")
+    loaded = DeepseekForCausalLM.from_checkpoint(tmp_path, subfolder="model", local_files_only=True)
+    assert not any(tensor.is_meta for tensor in loaded.state_dict().values())
+    torch.testing.assert_close(logits(loaded, input_ids), logits(base_model, input_ids), rtol=0, atol=1e-6)
+
+    # the config may ask for another layout of the plain checkpoint
+    grouped = DeepseekForCausalLM.from_checkpoint(tmp_path / "model", moe_grouped_gemm=True)
+    torch.testing.assert_close(logits(grouped, input_ids), logits(base_model, input_ids), rtol=0, atol=1e-5)
+    bf16 = DeepseekForCausalLM.from_checkpoint(tmp_path / "model", torch_dtype=torch.bfloat16)
+    assert bf16.model.embed_tokens.weight.dtype == torch.bfloat16